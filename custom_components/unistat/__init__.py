@@ -6,7 +6,7 @@ import asyncio
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.const import Platform
 from homeassistant.core import HomeAssistant
-from .model_params import PARAM_VERSION, UniStatModelParamsStore
+from .model_params import PARAM_MINOR_VERSION, PARAM_VERSION, UniStatModelParamsStore
 from .const import DOMAIN
 
 from .coordinator import (
@@ -15,6 +15,7 @@ from .coordinator import (
     UnistatData,
     UnistatConfigEntry,
 )
+from .worker import UniStatWorker
 
 PLATFORMS: tuple[Platform] = (Platform.CLIMATE, Platform.BINARY_SENSOR, Platform.SENSOR)
 
@@ -25,13 +26,18 @@ async def async_setup_entry(hass: HomeAssistant, entry: UnistatConfigEntry) -> b
     parameter_store = UniStatModelParamsStore(
         hass,
         version=PARAM_VERSION,
+        minor_version=PARAM_MINOR_VERSION,
         key=f"{DOMAIN}/model_params",
     )
     control_coordinator = UnistatControlCoordinator(hass, entry)
     learning_coordinator = UnistatLearningCoordinator(hass, entry)
 
+    worker = UniStatWorker()
+    entry.async_on_unload(worker.shutdown)
+
     entry.runtime_data = UnistatData(
         parameter_store=parameter_store,
+        worker=worker,
         coordinator_control=control_coordinator,
         coordinator_learning=learning_coordinator,
     )
@@ -10,6 +10,8 @@ from .const import (
     CONF_ROOM_SETTINGS,
     TITLE,
 )
+from .coordinator import UnistatConfigEntry, UnistatControlCoordinator
+from .history import room_signal
 from homeassistant.components.climate import (
     ClimateEntity,
     HVACMode,
@@ -18,25 +20,17 @@ from homeassistant.components.climate import (
     ATTR_TEMPERATURE,
     PRESET_NONE,
 )
-from homeassistant.config_entries import ConfigEntry
 from homeassistant.const import (
     UnitOfTemperature,
     CONF_TEMPERATURE_UNIT,
-    STATE_UNAVAILABLE,
-    STATE_UNKNOWN,
     EVENT_HOMEASSISTANT_START,
 )
 from homeassistant.core import (
     CoreState,
     Event,
-    EventStateChangedData,
     HomeAssistant,
-    State,
     callback,
 )
-from homeassistant.helpers.event import (
-    async_track_state_change_event,
-)
 from homeassistant.helpers.restore_state import RestoreEntity
 from homeassistant.helpers.entity_platform import AddConfigEntryEntitiesCallback
 
@@ -59,7 +53,7 @@ _LOGGER = logging.getLogger(__name__)
 
 async def async_setup_entry(
     hass: HomeAssistant,
-    config_entry: ConfigEntry,
+    config_entry: UnistatConfigEntry,
     async_add_entities: AddConfigEntryEntitiesCallback,
 ) -> None:
     """Initialize UniStat config entry."""
@@ -82,6 +76,7 @@ async def async_setup_entry(
                 temperature_entity_id=room_sensors[CONF_TEMP_ENTITY],
                 humidity_entity_id=room_sensors.get(CONF_HUMIDITY_ENTITY, None),
                 presets=None,  # TODO add preset support
+                coordinator=config_entry.runtime_data.coordinator_control,
             )
         )
     async_add_entities(climate_entities)
@@ -105,6 +100,7 @@ class UniStatClimateEntity(ClimateEntity, RestoreEntity):
         unique_id: str,
         temp_unit: UnitOfTemperature,
         temperature_entity_id: str,
+        coordinator: UnistatControlCoordinator,
         humidity_entity_id: str | None = None,
         climate_entity_id: str | None = None,
         presets: Dict[str, Dict] | None = None,
@@ -141,6 +137,9 @@ class UniStatClimateEntity(ClimateEntity, RestoreEntity):
         self._presets_inv = {v: k for k, v in presets.items()}
 
         # UniStatClimateEntity specific members
+        self._room = name
+        # Sensor readings are kept by the control coordinator
+        self._coordinator = coordinator
         # Entities
         self._temperature_entity_id = temperature_entity_id
         self._climate_entity_id = climate_entity_id
@@ -150,20 +149,12 @@ class UniStatClimateEntity(ClimateEntity, RestoreEntity):
         """Run when entity about to be added."""
         await super().async_added_to_hass()
 
-        # Add listener
+        # Readings come through the coordinator's subscription to all room sensors
         self.async_on_remove(
-            async_track_state_change_event(
-                self.hass,
-                [self._temperature_entity_id],
-                self._async_temperature_changed,
+            self._coordinator.async_add_room_listener(
+                self._room, self._async_sensors_updated
             )
         )
-        if self._humidity_entity_id:
-            self.async_on_remove(
-                async_track_state_change_event(
-                    self.hass, [self._humidity_entity_id], self._async_humidity_changed
-                )
-            )
 
         def _default_temperature():
             return (
@@ -175,22 +166,12 @@ class UniStatClimateEntity(ClimateEntity, RestoreEntity):
         @callback
         def _async_startup(_: Event | None = None) -> None:
             """Init on startup."""
-            sensor_state = self.hass.states.get(self._temperature_entity_id)
-            if sensor_state and sensor_state.state not in (
-                STATE_UNAVAILABLE,
-                STATE_UNKNOWN,
-            ):
-                self._async_update_temp(sensor_state)
-                self.async_write_ha_state()
-
-            if self._humidity_entity_id:
-                sensor_state = self.hass.states.get(self._humidity_entity_id)
-                if sensor_state and sensor_state.state not in (
-                    STATE_UNAVAILABLE,
-                    STATE_UNKNOWN,
-                ):
-                    self._async_update_temp(sensor_state)
-                    self.async_write_ha_state()
+            for entity_id in (self._temperature_entity_id, self._humidity_entity_id):
+                if entity_id:
+                    self._coordinator.async_process_sensor_state(
+                        self.hass.states.get(entity_id)
+                    )
+            self._async_sensors_updated()
 
             # TODO set initial heating/cooling/humidity control states
 
@@ -233,49 +214,19 @@ class UniStatClimateEntity(ClimateEntity, RestoreEntity):
         if not self._attr_hvac_mode:
             self._attr_hvac_mode = HVACMode.OFF
 
-    async def _async_humidity_changed(
-        self, event: Event[EventStateChangedData]
-    ) -> None:
-        """Handle humidity changes."""
-        new_state = event.data["new_state"]
-        if new_state is None or new_state.state in (STATE_UNAVAILABLE, STATE_UNKNOWN):
-            return
-
-        self._async_update_humidity(new_state)
-        self.async_write_ha_state()
-
-    async def _async_temperature_changed(
-        self, event: Event[EventStateChangedData]
-    ) -> None:
-        """Handle temperature changes."""
-        new_state = event.data["new_state"]
-        if new_state is None or new_state.state in (STATE_UNAVAILABLE, STATE_UNKNOWN):
-            return
-
-        self._async_update_temp(new_state)
-        self.async_write_ha_state()
-
     @callback
-    def _async_update_temp(self, state: State) -> None:
-        """Update thermostat with latest state from sensor."""
-        try:
-            temperature = float(state.state)
-            if temperature < -100 or temperature > 150:
-                raise ValueError(f"Sensor has illegal state {state.state}")  # noqa: TRY301
+    def _async_sensors_updated(self) -> None:
+        """Update thermostat with the latest readings of its sensors."""
+        temperature = self._coordinator.latest_reading(room_signal(self._room))
+        if temperature is not None:
             self._attr_current_temperature = temperature
-        except ValueError as ex:
-            _LOGGER.error("Unable to update from sensor: %s", ex)
-
-    @callback
-    def _async_update_humidity(self, state: State) -> None:
-        """Update thermostat with latest state from sensor."""
-        try:
-            humidity = float(state.state)
-            if humidity < 0 or humidity > 100:
-                raise ValueError(f"Sensor has illegal state {state.state}")  # noqa: TRY301
-            self._attr_current_humidity = humidity
-        except ValueError as ex:
-            _LOGGER.error("Unable to update from sensor: %s", ex)
+        if self._humidity_entity_id:
+            humidity = self._coordinator.latest_reading(
+                room_signal(self._room, CONF_HUMIDITY_ENTITY)
+            )
+            if humidity is not None:
+                self._attr_current_humidity = humidity
+        self.async_write_ha_state()
 
     async def async_set_hvac_mode(self, hvac_mode):
         """Set hvac mode."""
@@ -285,6 +236,7 @@ class UniStatClimateEntity(ClimateEntity, RestoreEntity):
         self._attr_hvac_mode = hvac_mode
         # Ensure we update the current operation after changing the mode
         self.async_write_ha_state()
+        self._coordinator.async_request_solve()
 
     async def async_turn_on(self):
         """Turn the entity on."""
@@ -308,6 +260,7 @@ class UniStatClimateEntity(ClimateEntity, RestoreEntity):
         self._attr_preset_mode = self._presets_inv.get(temperature, PRESET_NONE)
         self._attr_target_temperature = temperature
         self.async_write_ha_state()
+        self._coordinator.async_request_solve()
 
     async def async_set_preset_mode(self, preset_mode):
         """Set new preset mode."""
@@ -1,27 +1,122 @@
 """Unistat DataUpdateCoordinator."""
 
+import asyncio
+import threading
 from datetime import timedelta
 from dataclasses import dataclass
+from functools import partial
 import logging
 from collections import defaultdict
+from types import MappingProxyType
+from typing import Any, Final
 
+import numpy as np
+import numpy.typing as npt
 
+
+from homeassistant.components.climate import (
+    ATTR_TEMPERATURE,
+    DOMAIN as CLIMATE_DOMAIN,
+    HVACMode,
+)
 from homeassistant.config_entries import ConfigEntry
+from homeassistant.const import STATE_UNAVAILABLE, STATE_UNKNOWN
+from homeassistant.core import (
+    CALLBACK_TYPE,
+    Event,
+    EventStateChangedData,
+    State,
+    callback,
+)
 from homeassistant.helpers import entity_registry as er
+from homeassistant.helpers.debounce import Debouncer
 from homeassistant.helpers.device_registry import DeviceEntryType, DeviceInfo
+from homeassistant.helpers.event import async_track_state_change_event
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator
-from homeassistant.helpers.storage import Store
-from .const import DOMAIN, TITLE
-from .thermal_model import UniStatSystemModel
+from homeassistant.helpers.storage import STORAGE_DIR, Store
+from homeassistant.util import dt as dt_util
+from .const import (
+    CONF_APPLIANCE_TYPE,
+    CONF_AREAS,
+    CONF_CONTROL_MODE,
+    CONF_HUMIDITY_ENTITY,
+    CONF_ROOM_SETTINGS,
+    CONF_TEMP_ENTITY,
+    DOMAIN,
+    SWITCH_APPLIANCE_TYPES,
+    TITLE,
+    ControlMode,
+)
+from .history import HISTORY_DIR, HISTORY_MAX_GAP, RingBuffer, room_signal
+from .learning import (
+    ESTIMATOR_ADOPT_TOLERANCE,
+    ESTIMATOR_SAVE_DELAY,
+    LEARNING_WINDOW,
+    OnlineParamEstimator,
+    async_load_training_data,
+    fit_model_params_multistart,
+    read_current_state,
+)
+from .model_params import STORE_ESTIMATOR, STORE_MODEL_PARAMS, UniStatModelParams
+from .scheduler import UniStatScheduler
+from .worker import ComputeCancelled, UniStatWorker
+from .mpc import (
+    EXPLICIT_MAX_CONTROLS,
+    EXPLICIT_MAX_ROOMS,
+    MPC_COMPRESSION_THRESHOLD,
+    MPC_ENERGY_WEIGHTS,
+    UniStatExplicitMPC,
+    UniStatMPC,
+)
+from .thermal_model import DEFAULT_TIME_STEP, UniStatSystemModel
 
 _LOGGER = logging.getLogger(__name__)
 
+SENSOR_WRITE_DELAY: Final = 1.0  # seconds that room entity updates are coalesced over
+# Events between the control ticks re-solve at most once per cooldown
+CONTROL_RESOLVE_COOLDOWN: Final = 30.0  # seconds
+CONTROL_RESOLVE_TEMP_JUMP: Final = (
+    1.0  # degrees, room temperature change that re-solves
+)
+# Plausible range of each room sensor reading
+SENSOR_LIMITS: Final = MappingProxyType(
+    {
+        CONF_TEMP_ENTITY: (-100.0, 150.0),
+        CONF_HUMIDITY_ENTITY: (0.0, 100.0),
+    }
+)
+
+
+def _has_switches(model: UniStatSystemModel) -> bool:
+    return any(
+        c[CONF_APPLIANCE_TYPE] in SWITCH_APPLIANCE_TYPES for c in model._control_layout
+    )
+
+
+def _tabulate_control_law(
+    model: UniStatSystemModel,
+    setpoints: npt.NDArray,
+    room_weights: npt.NDArray,
+    energy_weight: float,
+    cancel: threading.Event,
+) -> UniStatExplicitMPC:
+    """Explicit MPC of a small house, from on/off schedules if it has switch appliances"""
+    if _has_switches(model):
+        scheduler = UniStatScheduler(model)
+        return UniStatExplicitMPC(
+            scheduler.mpc, setpoints, room_weights, energy_weight, scheduler, cancel
+        )
+    return UniStatExplicitMPC(
+        UniStatMPC(model), setpoints, room_weights, energy_weight, cancel=cancel
+    )
+
 
 @dataclass
 class UnistatData:
     """Data for the UniStat integration."""
 
     parameter_store: Store
+    worker: UniStatWorker
     coordinator_learning: "UnistatLearningCoordinator"
     coordinator_control: "UnistatControlCoordinator"
 
@@ -35,7 +130,12 @@ class UnistatCoordinator(DataUpdateCoordinator):
     config_entry: UnistatConfigEntry
 
     def __init__(
-        self, hass, name: str, config_entry, update_interval: timedelta | None
+        self,
+        hass,
+        name: str,
+        config_entry,
+        update_interval: timedelta | None,
+        request_refresh_debouncer: Debouncer | None = None,
     ):
         """Initialize coordinator."""
         self.data = defaultdict(lambda: "unknown")
@@ -46,6 +146,7 @@ class UnistatCoordinator(DataUpdateCoordinator):
             config_entry=config_entry,
             update_interval=update_interval,
             always_update=False,
+            request_refresh_debouncer=request_refresh_debouncer,
         )
 
     @property
@@ -70,10 +171,29 @@ class UnistatCoordinator(DataUpdateCoordinator):
         self._integration_entities = er.async_entries_for_config_entry(
             self._entity_registry, self.config_entry.entry_id
         )
-        model_params = await self.config_entry.runtime_data.parameter_store.async_load()
-        self._model = UniStatSystemModel(
-            self.config_entry.data, model_params=model_params
+        await self._async_load_model()
+
+    async def _async_compute(
+        self, job: str, target, *args, cancellable: bool = False
+    ) -> Any:
+        """Runs CPU heavy work in the compute worker, a newer job of the same kind replaces it and
+        raises ComputeCancelled"""
+        return await self.config_entry.runtime_data.worker.async_run(
+            f"{self.name}: {job}", target, *args, cancellable=cancellable
+        )
+
+    async def _async_load_model(self) -> dict:
+        """Builds the model from the parameter store, returns the stored data"""
+        stored = await self.config_entry.runtime_data.parameter_store.async_load() or {}
+        self._model = await self._async_compute(
+            "model",
+            partial(
+                UniStatSystemModel,
+                self.config_entry.data,
+                model_params=stored.get(STORE_MODEL_PARAMS),
+            ),
         )
+        return stored
 
 
 class UnistatControlCoordinator(UnistatCoordinator):
@@ -81,23 +201,378 @@ class UnistatControlCoordinator(UnistatCoordinator):
 
     def __init__(self, hass, config_entry):
         """Initialize coordinator."""
+        # Solves as soon as the first event of a burst arrives, the rest of the burst is folded
+        # into one more solve after the cooldown
+        self._resolve_debouncer = Debouncer(
+            hass, _LOGGER, cooldown=CONTROL_RESOLVE_COOLDOWN, immediate=True
+        )
         super().__init__(
             hass,
             name=f"{TITLE} Control Coordinator",
             config_entry=config_entry,
             update_interval=timedelta(minutes=5),
+            request_refresh_debouncer=self._resolve_debouncer,
+        )
+
+        self._last_measurement = None
+        # Reloading the fitted parameters and adopting the online estimate both swap the model
+        self._model_lock = asyncio.Lock()
+        self._mpc: UniStatMPC | None = None
+        self._explicit: UniStatExplicitMPC | None = None
+        # Setpoints, room weights and energy weight of the latest plan, and the key of the table
+        # being built
+        self._explicit_problem: tuple[npt.NDArray, npt.NDArray, float] | None = None
+        self._explicit_pending: bytes | None = None
+        self._scheduler: UniStatScheduler | None = None
+        self._readings: dict[str, RingBuffer] = {}
+        # Room sensors, room and sensor type per entity id
+        self._sensors: dict[str, list[tuple[str, str]]] = defaultdict(list)
+        for room, settings in config_entry.data[CONF_ROOM_SETTINGS].items():
+            for sensor in SENSOR_LIMITS:
+                if entity_id := settings.get(sensor):
+                    self._sensors[entity_id].append((room, sensor))
+        self._room_listeners: dict[str, list[CALLBACK_TYPE]] = defaultdict(list)
+        self._updated_rooms: set[str] = set()
+        self._write_debouncer = Debouncer(
+            hass,
+            _LOGGER,
+            cooldown=SENSOR_WRITE_DELAY,
+            immediate=False,
+            function=self._async_notify_rooms,
         )
 
     @property
     def model_params(self):
         return self._model.model_params
 
+    @property
+    def estimator(self) -> OnlineParamEstimator:
+        return self._estimator
+
+    async def _async_setup(self):
+        await super()._async_setup()
+        # One subscription covers every room sensor
+        self.config_entry.async_on_unload(
+            async_track_state_change_event(
+                self.hass, list(self._sensors), self._async_sensor_changed
+            )
+        )
+        self.config_entry.async_on_unload(self._write_debouncer.async_shutdown)
+
+    @callback
+    def async_request_solve(self) -> None:
+        """Re-solves ahead of the next control tick, bursts of requests are rate limited to one
+        solve per CONTROL_RESOLVE_COOLDOWN"""
+        self._resolve_debouncer.async_schedule_call()
+
+    @callback
+    def async_add_room_listener(
+        self, room: str, update_callback: CALLBACK_TYPE
+    ) -> CALLBACK_TYPE:
+        """Calls update_callback after new readings of the room's sensors, returns a function
+        that removes the listener"""
+        self._room_listeners[room].append(update_callback)
+
+        @callback
+        def remove_listener() -> None:
+            self._room_listeners[room].remove(update_callback)
+
+        return remove_listener
+
+    @callback
+    def _async_sensor_changed(self, event: Event[EventStateChangedData]) -> None:
+        if self.async_process_sensor_state(event.data["new_state"]):
+            self._write_debouncer.async_schedule_call()
+
+    @callback
+    def async_process_sensor_state(self, state: State | None) -> bool:
+        """Buffers a room sensor state, returns True if it was a valid reading"""
+        if state is None or state.state in (STATE_UNAVAILABLE, STATE_UNKNOWN):
+            return False
+        valid = False
+        for room, sensor in self._sensors.get(state.entity_id, ()):
+            low, high = SENSOR_LIMITS[sensor]
+            try:
+                value = float(state.state)
+                if not low <= value <= high:
+                    raise ValueError(f"Sensor has illegal state {state.state}")  # noqa: TRY301
+            except ValueError as ex:
+                _LOGGER.error("Unable to update from sensor: %s", ex)
+                continue
+            signal = room_signal(room, sensor)
+            last = self.latest_reading(signal)
+            if (
+                sensor == CONF_TEMP_ENTITY
+                and last is not None
+                and abs(value - last) >= CONTROL_RESOLVE_TEMP_JUMP
+            ):
+                self.async_request_solve()
+            self.async_record_reading(signal, state, value)
+            self._updated_rooms.add(room)
+            valid = True
+        return valid
+
+    @callback
+    def _async_notify_rooms(self) -> None:
+        """Lets each room with new readings update once"""
+        rooms, self._updated_rooms = self._updated_rooms, set()
+        for room in rooms:
+            for update_callback in list(self._room_listeners.get(room, ())):
+                update_callback()
+
+    @callback
+    def async_record_reading(self, signal: str, state: State, value: float) -> None:
+        """Adds a sensor reading to the live buffer of a signal"""
+        if (buffer := self._readings.get(signal)) is None:
+            buffer = self._readings[signal] = RingBuffer()
+        buffer.append(state.last_updated_timestamp, value)
+
+    def latest_reading(self, signal: str) -> float | None:
+        """The latest reading of a signal, None if nothing has been recorded"""
+        if not (buffer := self._readings.get(signal)):
+            return None
+        return float(buffer.latest(1)[1][0])
+
+    def readings(self, signal: str) -> RingBuffer | None:
+        """The latest readings of a signal, None if nothing has been recorded"""
+        return self._readings.get(signal)
+
     async def async_update_model(self):
-        return await self._async_setup()
+        """Reloads the fitted parameters, restarting the online estimator from them"""
+        await self._async_load_model()
+
+    async def _async_load_model(self) -> dict:
+        async with self._model_lock:
+            stored = await super()._async_load_model()
+            self._fitted_params = self._model.model_params
+            estimator = stored.get(STORE_ESTIMATOR)
+            if (
+                stored.get(STORE_MODEL_PARAMS, {}).get("conf_data")
+                != self.config_entry.data
+            ):
+                estimator = None
+            self._estimator = OnlineParamEstimator.from_dict(
+                self._fitted_params, estimator
+            )
+            await self._async_adopt_estimate()
+        return stored
+
+    async def _async_adopt_estimate(self) -> bool:
+        """Switches the control model to the online estimate once it has moved far enough"""
+        current = self._model.model_params.to_vector()
+        estimate = self._estimator.model_params.to_vector()
+        if np.allclose(estimate, current, rtol=ESTIMATOR_ADOPT_TOLERANCE, atol=0):
+            return False
+        self._model = await self._async_compute(
+            "estimate",
+            UniStatSystemModel,
+            self.config_entry.data,
+            self._estimator.model_params,
+        )
+        return True
+
+    def _checkpoint_data(self) -> dict:
+        return {
+            STORE_MODEL_PARAMS: self._fitted_params.asdict(),
+            STORE_ESTIMATOR: self._estimator.as_dict(),
+        }
 
     async def _async_update_data(self):
-        """Fetch data from API endpoint."""
-        self.data
+        """Update the online parameter estimate from the latest measurements."""
+        now = dt_util.utcnow()
+        states, controls = read_current_state(self.hass, self._model)
+        data = defaultdict(lambda: "unknown")
+        num_rooms = self._model.model_params.num_rooms
+        rooms = slice(1, num_rooms + 1)
+        # Room temperatures are the latest buffered readings. A sensor that hasn't reported for a
+        # long time has likely stopped working, its room floats and isn't measured
+        stale = np.zeros(num_rooms, dtype=bool)
+        for i, room in enumerate(self.config_entry.data[CONF_AREAS]):
+            if not (buffer := self._readings.get(room_signal(room))):
+                states[i + 1] = np.nan
+                continue
+            times, values = buffer.latest(1)
+            states[i + 1] = values[0]
+            stale[i] = now.timestamp() - times[0] > HISTORY_MAX_GAP
+
+        if self._last_measurement is not None:
+            last_time, last_states, last_controls = self._last_measurement
+            dt = (now - last_time).total_seconds()
+            # Controls are only known at the ticks, skip intervals where they may have been held
+            # for more than one control step, or that an early re-solve cut short
+            if DEFAULT_TIME_STEP / 2 <= dt <= 2 * DEFAULT_TIME_STEP:
+                # Stale rooms keep their last reading as an input but aren't observed
+                error = self._estimator.update(
+                    self._model, last_states, last_controls, states[rooms], dt, ~stale
+                )
+                if error is not None:
+                    data["model_error"] = error
+                    try:
+                        async with self._model_lock:
+                            await self._async_adopt_estimate()
+                    except ComputeCancelled:
+                        # Keep controlling with the current model, the estimate is adopted later
+                        _LOGGER.debug("Adopting the online estimate was cancelled")
+                    self.config_entry.runtime_data.parameter_store.async_delay_save(
+                        self._checkpoint_data, ESTIMATOR_SAVE_DELAY
+                    )
+
+        self._last_measurement = (now, states, controls)
+
+        data["sensor_failure"] = not np.all(np.isfinite(states[: num_rooms + 1]))
+        setpoints, room_weights = self._room_setpoints()
+        room_weights[stale] = 0
+        if data["sensor_failure"] or not np.any(room_weights):
+            return data
+
+        try:
+            await self._async_plan(data, states, controls, now, setpoints, room_weights)
+        except ComputeCancelled:
+            # A newer update is solving from fresher measurements
+            _LOGGER.debug("Control solve was replaced by a newer one")
+            return self.data
+        return data
+
+    async def _async_plan(
+        self,
+        data: dict,
+        states: npt.NDArray,
+        controls: npt.NDArray,
+        now,
+        setpoints: npt.NDArray,
+        room_weights: npt.NDArray,
+    ) -> None:
+        """Solves for the controls from the current state, adding the plan to data"""
+        num_rooms = self._model.model_params.num_rooms
+        if self._mpc is None or self._mpc.model is not self._model:
+            # The prediction matrices only change with the model parameters
+            controller = (
+                UniStatMPC.compressed
+                if self._model.num_controls >= MPC_COMPRESSION_THRESHOLD
+                else UniStatMPC
+            )
+            self._mpc = await self._async_compute("mpc", controller, self._model)
+        mode = self.config_entry.data.get(CONF_CONTROL_MODE, ControlMode.COMFORT)
+        energy_weight = MPC_ENERGY_WEIGHTS[mode]
+        active = room_weights > 0
+        # Floating rooms aren't tracked, any fixed target keeps the explicit table valid
+        targets = np.where(active, setpoints, np.mean(setpoints[active]))
+
+        explicit = None
+        if self._uses_explicit:
+            # The table is built off the control path, after each fit and whenever the setpoint
+            # offsets or weights change, the online controllers plan until it is ready
+            self._explicit_problem = (targets, room_weights, energy_weight)
+            explicit = self._explicit
+            if explicit is None or not explicit.matches(
+                targets, room_weights, energy_weight
+            ):
+                explicit = None
+                key = UniStatExplicitMPC.key(targets, room_weights, energy_weight)
+                if key != self._explicit_pending:
+                    self._explicit_pending = key
+                    self.config_entry.async_create_background_task(
+                        self.hass, self.async_build_explicit(), f"{self.name} explicit"
+                    )
+
+        if explicit is not None:
+            controls = explicit.lookup(
+                states, targets, controls, self._time_since_change(now)
+            )
+        elif _has_switches(self._model):
+            # On/off appliances get a schedule that respects their minimum on and off times
+            if self._scheduler is None or self._scheduler.model is not self._model:
+                self._scheduler = await self._async_compute(
+                    "scheduler", UniStatScheduler, self._model
+                )
+            schedule = await self._async_compute(
+                "solve",
+                self._scheduler.solve,
+                states,
+                targets,
+                room_weights,
+                None,
+                energy_weight,
+                controls,
+                self._time_since_change(now),
+                cancellable=True,
+            )
+            data["schedule_optimal"] = schedule.optimal
+            controls = schedule.controls[0]
+        else:
+            solution = await self._async_compute(
+                "solve",
+                self._mpc.solve,
+                states,
+                targets,
+                room_weights,
+                None,
+                energy_weight,
+            )
+            controls = solution.controls[0]
+        data["control_plan"] = self._mpc.controls_by_entity(controls)
+        data["control_error"] = float(
+            np.sqrt(np.mean((states[1 : num_rooms + 1] - setpoints)[active] ** 2))
+        )
+
+    @property
+    def _uses_explicit(self) -> bool:
+        return (
+            self._model.model_params.num_rooms <= EXPLICIT_MAX_ROOMS
+            and self._model.num_controls <= EXPLICIT_MAX_CONTROLS
+        )
+
+    async def async_build_explicit(self) -> None:
+        """Tabulates the control law of a small house for the current model and the setpoint
+        offsets and weights of the latest plan"""
+        if not self._uses_explicit or self._explicit_problem is None:
+            return
+        key = UniStatExplicitMPC.key(*self._explicit_problem)
+        self._explicit_pending = key
+        try:
+            explicit = await self._async_compute(
+                "explicit",
+                _tabulate_control_law,
+                self._model,
+                *self._explicit_problem,
+                cancellable=True,
+            )
+        except ComputeCancelled:
+            _LOGGER.debug("Explicit MPC build was replaced by a newer one")
+            return
+        finally:
+            if self._explicit_pending == key:
+                self._explicit_pending = None
+        self._explicit = explicit
+
+    def _time_since_change(self, now) -> npt.NDArray:
+        """Seconds since each control entity last changed state, NaN if it is missing"""
+        elapsed = []
+        for eid, _ in self._model.control_outputs:
+            state = self.hass.states.get(eid)
+            elapsed.append(
+                np.nan if state is None else (now - state.last_changed).total_seconds()
+            )
+        return np.array(elapsed)
+
+    def _room_setpoints(self) -> tuple[npt.NDArray, npt.NDArray]:
+        """Target temperatures of the UniStat climate entities, with a weight of zero for rooms
+        that are off or have no target"""
+        registry = er.async_get(self.hass)
+        rooms = self.config_entry.data[CONF_AREAS]
+        setpoints = np.full(len(rooms), np.nan)
+        for i, room in enumerate(rooms):
+            entity_id = registry.async_get_entity_id(
+                CLIMATE_DOMAIN, DOMAIN, f"{self.config_entry.entry_id}_{room}"
+            )
+            state = self.hass.states.get(entity_id) if entity_id else None
+            if state is None or state.state in (HVACMode.OFF, STATE_UNAVAILABLE):
+                continue
+            try:
+                setpoints[i] = float(state.attributes[ATTR_TEMPERATURE])
+            except (KeyError, TypeError, ValueError):
+                continue
+        return setpoints, np.isfinite(setpoints).astype(float)
 
 
 class UnistatLearningCoordinator(UnistatCoordinator):
@@ -113,5 +588,53 @@ class UnistatLearningCoordinator(UnistatCoordinator):
         )
 
     async def _async_update_data(self):
-        """Fetch data from API endpoint."""
-        self.data
+        """Fit the model to the recorded history.
+
+        The fit searches from the current parameters, the defaults of the configuration and Latin
+        hypercube samples of the parameter bounds in case the current parameters sit in a poor local
+        minimum. The best starts are fitted in parallel processes, the best result is persisted and
+        the control coordinator is updated to use it.
+        """
+        end = dt_util.utcnow()
+        training_data = await async_load_training_data(
+            self.hass,
+            self._model,
+            end - LEARNING_WINDOW,
+            end,
+            cache_path=self.hass.config.path(STORAGE_DIR, DOMAIN, HISTORY_DIR),
+        )
+        if training_data is None:
+            return self.data
+
+        try:
+            starts = [
+                self._model.model_params.to_vector(),
+                UniStatModelParams.from_conf(self.config_entry.data).to_vector(),
+            ]
+            model_params, cost = await self._async_compute(
+                "fit",
+                fit_model_params_multistart,
+                self._model,
+                training_data,
+                starts,
+                cancellable=True,
+            )
+        except (ValueError, ComputeCancelled) as ex:
+            _LOGGER.warning("Skipping model fit: %s", ex)
+            return self.data
+
+        runtime_data = self.config_entry.runtime_data
+        await runtime_data.parameter_store.async_save(
+            {STORE_MODEL_PARAMS: model_params.asdict()}
+        )
+        try:
+            self._model = await self._async_compute(
+                "model", UniStatSystemModel, self.config_entry.data, model_params
+            )
+            await runtime_data.coordinator_control.async_update_model()
+            await runtime_data.coordinator_control.async_build_explicit()
+        except ComputeCancelled:
+            # The fit is stored, the models pick it up when they are next loaded
+            _LOGGER.warning("Loading the fitted model was cancelled")
+
+        return {"fit_cost": cost, "last_fit": end}
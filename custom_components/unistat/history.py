@@ -0,0 +1,487 @@
+"""Recorded sensor and control history for UniStat."""
+
+import numpy as np
+import numpy.typing as npt
+import logging
+import os
+
+from collections.abc import Callable
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Final
+
+from homeassistant.components.climate import HVACAction, HVACMode
+from homeassistant.components.recorder import get_instance, history
+from homeassistant.components.weather import ATTR_WEATHER_TEMPERATURE
+from homeassistant.const import STATE_ON, STATE_UNAVAILABLE, STATE_UNKNOWN
+from homeassistant.core import HomeAssistant, State, split_entity_id
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers.json import save_json
+from homeassistant.util import dt as dt_util
+from homeassistant.util.json import load_json_object
+
+from .const import (
+    CONF_AREAS,
+    CONF_HUMIDITY_ENTITY,
+    CONF_ROOM_SETTINGS,
+    CONF_SOLAR_FLUX_ENTITY,
+    CONF_TEMP_ENTITY,
+    CONF_WEATHER_ENTITY,
+    CONF_WEATHER_STATION,
+    CONF_WIND_DIRECTION_ENTITY,
+    CONF_WIND_SPEED_ENTITY,
+)
+from .thermal_model import DEFAULT_TIME_STEP, UniStatSystemModel
+
+_LOGGER = logging.getLogger(__name__)
+
+HISTORY_DIR: Final = "history"  # Next to the model parameter store
+HISTORY_INDEX_FILE: Final = "index.json"
+HISTORY_INDEX_VERSION: Final = 1
+
+SIGNAL_OUTSIDE_TEMP = "outside_temp"
+# Weather station sensors other than the outside temperature, keyed by signal name
+STATION_SIGNALS = {
+    "outside_humidity": CONF_HUMIDITY_ENTITY,
+    "wind_speed": CONF_WIND_SPEED_ENTITY,
+    "wind_direction": CONF_WIND_DIRECTION_ENTITY,
+    "solar_flux": CONF_SOLAR_FLUX_ENTITY,
+}
+
+LIVE_BUFFER_SIZE: Final = 1024  # Readings kept per signal by the control coordinator
+# Measured signals are interpolated between readings and become stale after this many seconds
+HISTORY_MAX_GAP: Final = 6 * 3600.0
+
+# Entity id, state conversion and whether the signal is linearly interpolated
+type Signal = tuple[str, Callable[[State], float], bool]
+
+
+def _control_value(state: State, mode: HVACMode) -> float:
+    """Converts a control entity state to a model input for the given mode"""
+    # Recorded states don't have a domain attribute
+    if split_entity_id(state.entity_id)[0] == "climate":
+        action = state.attributes.get("hvac_action")
+        target = HVACAction.HEATING if mode == HVACMode.HEAT else HVACAction.COOLING
+        return float(action == target)
+    return float(state.state == STATE_ON)
+
+
+def _float_state(state: State) -> float:
+    try:
+        return float(state.state)
+    except ValueError:
+        return np.nan
+
+
+def _outside_temp(state: State) -> float:
+    if split_entity_id(state.entity_id)[0] == "weather":
+        try:
+            return float(state.attributes[ATTR_WEATHER_TEMPERATURE])
+        except (KeyError, TypeError, ValueError):
+            return np.nan
+    return _float_state(state)
+
+
+def _model_entities(model: UniStatSystemModel) -> tuple[str, list[str], list[str]]:
+    """Returns the outside temperature, room temperature and control entity ids of a model"""
+    conf = model.model_params.conf_data
+    station = conf.get("weather_station", {}) if conf[CONF_WEATHER_STATION] else {}
+    outside_entity = station.get(CONF_TEMP_ENTITY, conf[CONF_WEATHER_ENTITY])
+    room_entities = [
+        conf[CONF_ROOM_SETTINGS][r][CONF_TEMP_ENTITY] for r in conf[CONF_AREAS]
+    ]
+    control_entities = list(dict.fromkeys(eid for eid, _ in model.control_outputs))
+    return outside_entity, room_entities, control_entities
+
+
+def room_signal(room: str, sensor: str = CONF_TEMP_ENTITY) -> str:
+    """Signal name of a room sensor, the temperature by default"""
+    return f"{room}_{sensor.removesuffix('_entity')}"
+
+
+def control_signal(entity_id: str, mode: HVACMode) -> str:
+    """Signal name of a model input"""
+    return f"{entity_id}_{mode}"
+
+
+def model_signals(model: UniStatSystemModel) -> dict[str, Signal]:
+    """Every signal the learner uses, keyed by name, with its entity id and state conversion.
+
+    These are the outside temperature, the configured room temperature and humidity sensors, the
+    model inputs and any other weather station sensors.
+    """
+    conf = model.model_params.conf_data
+    outside_entity, _, _ = _model_entities(model)
+    signals: dict[str, Signal] = {
+        SIGNAL_OUTSIDE_TEMP: (outside_entity, _outside_temp, True)
+    }
+    for room in conf[CONF_AREAS]:
+        for sensor in (CONF_TEMP_ENTITY, CONF_HUMIDITY_ENTITY):
+            if entity_id := conf[CONF_ROOM_SETTINGS][room].get(sensor):
+                signals[room_signal(room, sensor)] = (entity_id, _float_state, True)
+    for entity_id, mode in model.control_outputs:
+        signals[control_signal(entity_id, mode)] = (
+            entity_id,
+            lambda s, m=mode: _control_value(s, m),
+            False,
+        )
+    station = conf.get("weather_station", {}) if conf[CONF_WEATHER_STATION] else {}
+    for name, key in STATION_SIGNALS.items():
+        if entity_id := station.get(key):
+            signals[name] = (entity_id, _float_state, True)
+    return signals
+
+
+def resample(
+    times: npt.NDArray,
+    values: npt.NDArray,
+    grid: npt.NDArray,
+    linear: bool = False,
+    max_gap: float | None = None,
+) -> npt.NDArray:
+    """Resamples events (times, values), sorted by time, onto the timestamps of grid.
+
+    Values hold from one event to the next, or are linearly interpolated between events with
+    linear, a NaN value marks a period where the entity was unavailable. The result is NaN before
+    the first event, while the entity was unavailable and, with max_gap, wherever the nearest events
+    are more than max_gap seconds apart or the last one is more than max_gap seconds old.
+    """
+    if not times.size:
+        return np.full(grid.shape, np.nan)
+    idx = np.searchsorted(times, grid, side="right") - 1
+    prev = np.maximum(idx, 0)
+    out = values[prev].astype(float)
+    gap = grid - times[prev]
+    if linear:
+        has_next = idx + 1 < times.size
+        nxt = np.minimum(idx + 1, times.size - 1)
+        span = times[nxt] - times[prev]
+        # An entity that goes unavailable holds its last value up to then
+        interpolate = has_next & (span > 0) & np.isfinite(values[nxt])
+        frac = np.where(interpolate, gap / np.where(span > 0, span, 1), 0)
+        out += frac * np.where(interpolate, values[nxt] - out, 0)
+        gap = np.where(has_next, span, gap)
+    out[idx < 0] = np.nan
+    if max_gap is not None:
+        out[gap > max_gap] = np.nan
+    return out
+
+
+def _events(states: list[State], convert) -> tuple[npt.NDArray, npt.NDArray]:
+    """Event times and values of a list of states, NaN where the entity was unavailable"""
+    # Attribute changes, like the temperature of a weather entity, don't update last_changed
+    times = np.fromiter(
+        (s.last_updated.timestamp() for s in states), float, len(states)
+    )
+    values = np.fromiter(
+        (
+            np.nan if s.state in (STATE_UNAVAILABLE, STATE_UNKNOWN) else convert(s)
+            for s in states
+        ),
+        float,
+        len(states),
+    )
+    return times, values
+
+
+class RingBuffer:
+    """Preallocated buffer of the latest (timestamp, value) readings of a signal.
+
+    Every reading is written twice, capacity apart, so the latest readings are always one
+    contiguous slice. Appends are O(1) and windows are views into the buffer, valid until the next
+    append.
+    """
+
+    def __init__(self, capacity: int = LIVE_BUFFER_SIZE):
+        self._capacity = capacity
+        self._times = np.full(2 * capacity, np.nan)
+        self._values = np.full(2 * capacity, np.nan)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, time: float, value: float) -> None:
+        i = self._next
+        self._times[i] = self._times[i + self._capacity] = time
+        self._values[i] = self._values[i + self._capacity] = value
+        self._next = (i + 1) % self._capacity
+        self._count = min(self._count + 1, self._capacity)
+
+    def latest(self, count: int | None = None) -> tuple[npt.NDArray, npt.NDArray]:
+        """Times and values of the latest count readings, all of them by default, oldest first"""
+        count = self._count if count is None else min(count, self._count)
+        end = self._next + self._capacity
+        return self._times[end - count : end], self._values[end - count : end]
+
+
+@dataclass(frozen=True)
+class HistoryBlock:
+    """Recorded signals on a uniform time grid, one column per signal, NaN marks gaps where a
+    signal was missing, unavailable or stale."""
+
+    times: npt.NDArray  # (num_steps,) POSIX timestamps
+    signals: dict[str, npt.NDArray]  # (num_steps,) per signal name
+
+    @property
+    def num_steps(self) -> int:
+        return self.times.shape[0]
+
+    def __getitem__(self, signal: str) -> npt.NDArray:
+        """The column of a signal, all NaN if it wasn't loaded"""
+        if (column := self.signals.get(signal)) is None:
+            return np.full(self.times.shape, np.nan)
+        return column
+
+    def since(self, start: float) -> "HistoryBlock":
+        """The samples from start on"""
+        keep = slice(int(np.searchsorted(self.times, start - 1e-6)), None)
+        return HistoryBlock(
+            times=self.times[keep],
+            signals={name: column[keep] for name, column in self.signals.items()},
+        )
+
+    def valid(self, signal: str) -> npt.NDArray:
+        """Gap mask of a signal, True where it has a value"""
+        return np.isfinite(self[signal])
+
+
+def load_history(
+    hass: HomeAssistant,
+    signals: dict[str, Signal],
+    start: datetime,
+    end: datetime,
+    dt: float = DEFAULT_TIME_STEP,
+) -> HistoryBlock:
+    """Loads the history of every signal with a single recorder query and resamples it onto a
+    grid of dt seconds from start to end"""
+    entity_ids = list(dict.fromkeys(entity_id for entity_id, *_ in signals.values()))
+    states = history.get_significant_states(
+        hass,
+        start,
+        end,
+        entity_ids,
+        include_start_time_state=True,
+        significant_changes_only=False,
+    )
+    # The grid is aligned to multiples of dt so that later loads line up with it
+    grid = np.arange(np.ceil(start.timestamp() / dt) * dt, end.timestamp(), dt)
+    return HistoryBlock(
+        times=grid,
+        signals={
+            name: resample(
+                *_events(states.get(entity_id, []), convert),
+                grid,
+                linear=linear,
+                max_gap=HISTORY_MAX_GAP if linear else None,
+            )
+            for name, (entity_id, convert, linear) in signals.items()
+        },
+    )
+
+
+class UniStatHistoryStore:
+    """Columnar on-disk history, one .npy file per signal and a small JSON index.
+
+    Samples are on a grid of dt seconds, row i of every file is the sample at start + i * dt.
+    Windows are sliced from read only memory maps so only the rows that are used are read, and new
+    samples are appended to the end of each file in place. The index is written last, rows past
+    its count are left over from an interrupted append and are overwritten by the next one.
+    Trimming only moves the first live row, the files are rewritten once most rows are dead.
+    """
+
+    def __init__(self, path: str, signals: dict[str, Signal], dt: float):
+        self._path = path
+        self._signals = signals
+        self._dt = dt
+        self._start = 0.0
+        self._offset = 0
+        self._num_steps = 0
+
+    @property
+    def start(self) -> float:
+        """Timestamp of the first live sample"""
+        return self._start + self._offset * self._dt
+
+    @property
+    def end(self) -> float:
+        """Timestamp of the next sample to append"""
+        return self._start + (self._offset + self._num_steps) * self._dt
+
+    @property
+    def num_steps(self) -> int:
+        return self._num_steps
+
+    def _file(self, i: int) -> str:
+        return os.path.join(self._path, f"signal_{i}.npy")
+
+    def _index(self) -> dict[str, Any]:
+        return {
+            "version": HISTORY_INDEX_VERSION,
+            "dt": self._dt,
+            "start": self._start,
+            "offset": self._offset,
+            "num_steps": self._num_steps,
+            "signals": [
+                [name, entity_id] for name, (entity_id, *_) in self._signals.items()
+            ],
+        }
+
+    def load(self) -> bool:
+        """Reads the index, returns False if there is no history for these signals"""
+        try:
+            index = load_json_object(os.path.join(self._path, HISTORY_INDEX_FILE), {})
+        except HomeAssistantError as ex:
+            _LOGGER.warning("Discarding unreadable history index: %s", ex)
+            return False
+        expected = self._index()
+        if any(index.get(key) != expected[key] for key in ("version", "dt", "signals")):
+            if index:
+                _LOGGER.debug("History is for other signals, discarding it")
+            return False
+        self._start = float(index["start"])
+        self._offset = int(index["offset"])
+        self._num_steps = int(index["num_steps"])
+        return True
+
+    def reset(self, start: float) -> None:
+        """Empties the history, the first sample appended will be at start"""
+        os.makedirs(self._path, exist_ok=True)
+        for i in range(len(self._signals)):
+            np.save(self._file(i), np.empty(0))
+        self._start, self._offset, self._num_steps = start, 0, 0
+        self._save_index()
+
+    def _save_index(self) -> None:
+        save_json(
+            os.path.join(self._path, HISTORY_INDEX_FILE),
+            self._index(),
+            atomic_writes=True,
+        )
+
+    def append(self, block: HistoryBlock) -> None:
+        """Appends the samples of a block that starts at end"""
+        if not block.num_steps:
+            return
+        if not np.isclose(block.times[0], self.end):
+            raise ValueError(
+                "Appended history must start at the end of the stored one."
+            )
+        rows = self._offset + self._num_steps
+        for i, name in enumerate(self._signals):
+            with open(self._file(i), "r+b") as f:
+                np.lib.format.read_magic(f)
+                np.lib.format.read_array_header_1_0(f)
+                data = f.tell() + rows * np.dtype(float).itemsize
+                f.seek(data)
+                f.write(np.ascontiguousarray(block[name], dtype=float).tobytes())
+                f.truncate()
+                # The header leaves room for the length to grow so it is rewritten in place
+                f.seek(0)
+                np.lib.format.write_array_header_1_0(
+                    f,
+                    {
+                        "descr": np.lib.format.dtype_to_descr(np.dtype(float)),
+                        "fortran_order": False,
+                        "shape": (rows + block.num_steps,),
+                    },
+                )
+        self._num_steps += block.num_steps
+        self._save_index()
+
+    def rewind(self, end: float) -> None:
+        """Drops the samples from end on, they are overwritten by the next append"""
+        self._num_steps = int(
+            np.clip(np.ceil((end - self.start) / self._dt), 0, self._num_steps)
+        )
+        self._save_index()
+
+    def trim(self, start: float) -> None:
+        """Drops the samples before start"""
+        dead = int(
+            np.clip(np.ceil((start - self.start) / self._dt), 0, self._num_steps)
+        )
+        self._offset += dead
+        self._num_steps -= dead
+        if self._offset > self._num_steps:
+            for i in range(len(self._signals)):
+                live = np.load(self._file(i), mmap_mode="r")[self._offset :]
+                tmp_path = f"{self._file(i)}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, live[: self._num_steps])
+                os.replace(tmp_path, self._file(i))
+            self._start = self.start
+            self._offset = 0
+        self._save_index()
+
+    def window(self, start: float, end: float) -> HistoryBlock:
+        """The stored samples from start up to end, backed by memory maps of the files"""
+        first = int(
+            np.clip(np.ceil((start - self.start) / self._dt), 0, self._num_steps)
+        )
+        last = int(
+            np.clip(np.ceil((end - self.start) / self._dt), first, self._num_steps)
+        )
+        rows = slice(self._offset + first, self._offset + last)
+        return HistoryBlock(
+            times=self.start + np.arange(first, last) * self._dt,
+            signals={
+                name: np.load(self._file(i), mmap_mode="r")[rows]
+                for i, name in enumerate(self._signals)
+            },
+        )
+
+
+def update_history(
+    hass: HomeAssistant,
+    signals: dict[str, Signal],
+    start: datetime,
+    end: datetime,
+    path: str,
+    dt: float = DEFAULT_TIME_STEP,
+) -> HistoryBlock:
+    """Brings the history stored at path up to end and trims it to start.
+
+    Only the samples after the stored ones, and the last HISTORY_MAX_GAP of those, are read from
+    the recorder, the whole window is read when nothing usable is stored.
+    """
+    first = np.ceil(start.timestamp() / dt) * dt
+    store = UniStatHistoryStore(path, signals, dt)
+    if not store.load() or store.start > first or store.end < first:
+        store.reset(first)
+    # Samples up to HISTORY_MAX_GAP before the end may still change as later readings arrive, and
+    # are only final when the readings up to HISTORY_MAX_GAP before them are read as well
+    overlap = np.ceil(HISTORY_MAX_GAP / dt) * dt
+    store.rewind(store.end - overlap)
+    if not store.num_steps:
+        store.reset(first)
+    read_from = store.end - overlap if store.num_steps else first
+    new = load_history(hass, signals, dt_util.utc_from_timestamp(read_from), end, dt)
+    _LOGGER.debug("Read %s history samples", new.num_steps)
+    store.append(new.since(store.end))
+    store.trim(first)
+    return store.window(first, end.timestamp())
+
+
+async def async_load_history(
+    hass: HomeAssistant,
+    model: UniStatSystemModel,
+    start: datetime,
+    end: datetime,
+    dt: float = DEFAULT_TIME_STEP,
+    cache_path: str | None = None,
+) -> HistoryBlock | None:
+    """Loads the history of every signal of the model in one executor job, returns None if the
+    recorder isn't available. With cache_path the history is kept in a UniStatHistoryStore there and
+    only the samples that aren't stored yet are read."""
+    if "recorder" not in hass.config.components:
+        _LOGGER.debug("Recorder is not available, no history")
+        return None
+    if cache_path is None:
+        return await get_instance(hass).async_add_executor_job(
+            load_history, hass, model_signals(model), start, end, dt
+        )
+    return await get_instance(hass).async_add_executor_job(
+        update_history, hass, model_signals(model), start, end, cache_path, dt
+    )
@@ -0,0 +1,551 @@
+"""Model parameter learning for UniStat."""
+
+import numpy as np
+import numpy.typing as npt
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Final
+
+from scipy.optimize import least_squares
+from scipy.stats import qmc
+
+from homeassistant.const import STATE_UNAVAILABLE, STATE_UNKNOWN
+from homeassistant.core import HomeAssistant
+
+from .const import CONF_AREAS
+from .history import (
+    SIGNAL_OUTSIDE_TEMP,
+    _control_value,
+    _float_state,
+    _model_entities,
+    _outside_temp,
+    async_load_history,
+    control_signal,
+    room_signal,
+)
+from .model_params import UniStatModelParams
+from .thermal_model import DEFAULT_TIME_STEP, UniStatSystemModel
+
+_LOGGER = logging.getLogger(__name__)
+
+LEARNING_WINDOW: Final = timedelta(days=14)
+LEARNING_SEGMENT_STEPS: Final = 72  # 6 hours of 5 minute steps
+LEARNING_MAX_EVALUATIONS: Final = 20
+LEARNING_PROCESSES: Final = min(4, os.cpu_count() or 1)
+LEARNING_SAMPLES: Final = 64  # Latin hypercube candidates screened by each fit
+LEARNING_REFINED_STARTS: Final = 4  # Best candidates that are fitted locally
+LEARNING_TIME_BUDGET: Final = 3600.0  # seconds
+LEARNING_CANCEL_POLL: Final = (
+    1.0  # seconds between checks for cancellation of pooled fits
+)
+
+ESTIMATOR_SENSOR_NOISE: Final = (
+    0.1  # K, standard deviation of a room temperature reading
+)
+ESTIMATOR_PRIOR: Final = (
+    0.2  # Relative standard deviation of a fresh parameter estimate
+)
+ESTIMATOR_DRIFT: Final = 0.002  # Relative parameter drift per update
+ESTIMATOR_SAVE_DELAY: Final = 3600  # seconds
+# Relative parameter change before the control model switches to the online estimate
+ESTIMATOR_ADOPT_TOLERANCE: Final = 0.01
+
+
+@dataclass(frozen=True)
+class TrainingData:
+    """Uniformly sampled training history, NaN marks missing samples."""
+
+    dt: float
+    outside_temps: npt.NDArray  # (num_steps,)
+    room_temps: npt.NDArray  # (num_steps, num_rooms)
+    controls: npt.NDArray  # (num_steps, num_controls)
+
+    @property
+    def num_steps(self) -> int:
+        return self.outside_temps.shape[0]
+
+
+def _segments(
+    model: UniStatSystemModel, data: TrainingData, length: int
+) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray]:
+    """Splits the history into segments that are each simulated from a measured initial state.
+
+    Returns initial states (S, num_states), controls (S, length, num_controls), outside
+    temperatures (S, length) and measured room temperatures (S, length, num_rooms) at the end of
+    each step. Segments with missing initial states or inputs are dropped.
+    """
+    num_segments = (data.num_steps - 1) // length
+    starts = np.arange(num_segments) * length
+    steps = starts[:, np.newaxis] + np.arange(length)
+
+    x0 = np.ones((num_segments, model.num_states))
+    x0[:, 0] = data.outside_temps[starts]
+    x0[:, 1 : model.model_params.num_rooms + 1] = data.room_temps[starts]
+    u = data.controls[steps]
+    t_out = data.outside_temps[steps]
+    measured = data.room_temps[steps + 1]
+
+    valid = (
+        np.all(np.isfinite(x0), axis=1)
+        & np.all(np.isfinite(u), axis=(1, 2))
+        & np.all(np.isfinite(t_out), axis=1)
+    )
+    return x0[valid], u[valid], t_out[valid], measured[valid]
+
+
+def _fit_segments(
+    model: UniStatSystemModel,
+    params: UniStatModelParams,
+    segments: tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray],
+    dt: float,
+    initial: npt.NDArray,
+    max_nfev: int,
+    cancel: threading.Event | None = None,
+) -> tuple[npt.NDArray, float]:
+    """Fits the parameter vector to the training segments from initial, returns the fitted vector
+    and the final cost. Setting cancel, or a multiprocessing Event, stops the fit at the next
+    iteration."""
+    x0, u, t_out, measured = segments
+    valid = np.isfinite(measured)
+    rooms = slice(1, params.num_rooms + 1)
+    bounds = params.param_bounds
+    last = {}
+
+    def evaluate(vector: npt.NDArray) -> tuple[npt.NDArray, npt.NDArray]:
+        key = vector.tobytes()
+        if key not in last:
+            last.clear()
+            _, outputs, jacobian = model.simulate_jacobian(
+                x0,
+                u,
+                dt,
+                outside_temps=t_out,
+                model_params=params.from_vector(vector),
+            )
+            residuals = outputs[:, 1:] - measured
+            last[key] = (residuals[valid], jacobian[:, 1:, rooms][valid])
+        return last[key]
+
+    def check_cancel(x: npt.NDArray) -> None:
+        if cancel is not None and cancel.is_set():
+            raise StopIteration
+
+    result = least_squares(
+        lambda v: evaluate(v)[0],
+        params.clip(initial),
+        jac=lambda v: evaluate(v)[1],
+        bounds=(bounds[:, 0], bounds[:, 1]),
+        method="dogbox",
+        x_scale="jac",
+        max_nfev=max_nfev,
+        callback=check_cancel,
+    )
+    _LOGGER.debug(
+        "Model fit finished after %s evaluations with cost %s: %s",
+        result.nfev,
+        result.cost,
+        result.message,
+    )
+    return params.clip(result.x), float(result.cost)
+
+
+def _training_segments(
+    model: UniStatSystemModel, data: TrainingData
+) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray]:
+    segments = _segments(model, data, LEARNING_SEGMENT_STEPS)
+    if segments[0].shape[0] == 0:
+        raise ValueError("Not enough complete training data to fit the model.")
+    return segments
+
+
+def fit_model_params(
+    model: UniStatSystemModel,
+    data: TrainingData,
+    initial_params: UniStatModelParams | None = None,
+    max_nfev: int = LEARNING_MAX_EVALUATIONS,
+) -> tuple[UniStatModelParams, float]:
+    """Fits the model parameters to the training data by bounded nonlinear least squares.
+
+    The fit starts from initial_params, or the model's current parameters, and uses the analytic
+    trajectory Jacobian. Returns the fitted parameters and the final cost.
+    """
+    params = initial_params or model.model_params
+    vector, cost = _fit_segments(
+        model,
+        params,
+        _training_segments(model, data),
+        data.dt,
+        params.to_vector(),
+        max_nfev,
+    )
+    return params.from_vector(vector), cost
+
+
+# Fitting problem of a process pool worker, attached to the parent's shared memory
+_worker_problem: tuple[SharedMemory, UniStatSystemModel, tuple, float, Any] | None = (
+    None
+)
+
+
+def _attach_problem(
+    name: str,
+    layout: list[tuple[tuple[int, ...], int]],
+    params: dict,
+    dt: float,
+    cancel: Any,
+) -> None:
+    """Process pool initializer, views the training segments in the shared memory block"""
+    global _worker_problem  # noqa: PLW0603
+    shm = SharedMemory(name=name, track=False)
+    segments = tuple(
+        np.ndarray(shape, dtype=float, buffer=shm.buf, offset=offset)
+        for shape, offset in layout
+    )
+    model_params = UniStatModelParams(**params)
+    model = UniStatSystemModel(model_params.conf_data, model_params)
+    _worker_problem = (shm, model, segments, dt, cancel)
+
+
+def _fit_start(initial: npt.NDArray, max_nfev: int) -> tuple[npt.NDArray, float]:
+    """Process pool task, fits from one start"""
+    _, model, segments, dt, cancel = _worker_problem
+    return _fit_segments(
+        model, model.model_params, segments, dt, initial, max_nfev, cancel
+    )
+
+
+@contextmanager
+def _fit_pool(
+    model: UniStatSystemModel,
+    segments: tuple[npt.NDArray, ...],
+    dt: float,
+    processes: int,
+    cancel: threading.Event | None = None,
+) -> Iterator[Callable[[npt.NDArray, int], list[tuple[npt.NDArray, float]]]]:
+    """Yields a function that fits from each of a stack of starts, returning the fitted vectors
+    and costs. With more than one process the starts are fitted in a process pool, the segments
+    are copied into one shared memory block that the workers map instead of receiving pickled
+    copies. Setting cancel stops the running fits at their next iteration."""
+    params = model.model_params
+    if processes <= 1:
+        yield lambda starts, max_nfev: [
+            _fit_segments(model, params, segments, dt, start, max_nfev, cancel)
+            for start in starts
+        ]
+        return
+
+    layout, size = [], 0
+    for segment in segments:
+        layout.append((segment.shape, size))
+        size += segment.size * np.dtype(float).itemsize
+    # Forking the threaded Home Assistant process isn't safe
+    context = multiprocessing.get_context("spawn")
+    # The workers can't see the caller's threading.Event, it is relayed to one of theirs
+    stop = context.Event()
+    shm = SharedMemory(create=True, size=max(size, 1))
+    try:
+        for segment, (shape, offset) in zip(segments, layout, strict=True):
+            np.ndarray(shape, dtype=float, buffer=shm.buf, offset=offset)[...] = segment
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=context,
+            initializer=_attach_problem,
+            initargs=(shm.name, layout, params.asdict(), dt, stop),
+        ) as pool:
+
+            def fit(
+                starts: npt.NDArray, max_nfev: int
+            ) -> list[tuple[npt.NDArray, float]]:
+                futures = [pool.submit(_fit_start, s, max_nfev) for s in starts]
+                pending = futures
+                while pending:
+                    if cancel is not None and cancel.is_set():
+                        stop.set()
+                    pending = wait(pending, timeout=LEARNING_CANCEL_POLL).not_done
+                return [future.result() for future in futures]
+
+            yield fit
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _latin_hypercube(
+    bounds: npt.NDArray, count: int, rng: np.random.Generator
+) -> npt.NDArray:
+    """Latin hypercube samples (count, num_params) inside the bounds. Parameters whose positive
+    bounds span a decade or more, like thermal masses and lags, are sampled log-uniformly."""
+    sample = qmc.LatinHypercube(d=bounds.shape[0], rng=rng).random(count)
+    low, high = bounds[:, 0], bounds[:, 1]
+    log = (low > 0) & (high >= 10 * low)
+    log_low = np.log(np.where(log, low, 1))
+    log_high = np.log(np.where(log, high, 1))
+    return np.where(
+        log,
+        np.exp(log_low + sample * (log_high - log_low)),
+        low + sample * (high - low),
+    )
+
+
+def _screen(
+    model: UniStatSystemModel,
+    segments: tuple[npt.NDArray, ...],
+    dt: float,
+    candidates: npt.NDArray,
+) -> npt.NDArray:
+    """Costs (N,) of N parameter vectors, simulated together over all segments"""
+    x0, u, t_out, measured = segments
+    _, outputs = model.simulate_ensemble(
+        candidates,
+        x0[np.newaxis],
+        u[np.newaxis],
+        dt,
+        outside_temps=t_out[np.newaxis],
+    )
+    residuals = np.where(np.isfinite(measured), outputs[..., 1:, :] - measured, 0)
+    costs = 0.5 * np.sum(residuals**2, axis=(1, 2, 3))
+    return np.where(np.isfinite(costs), costs, np.inf)
+
+
+def fit_model_params_multistart(
+    model: UniStatSystemModel,
+    data: TrainingData,
+    starts: npt.ArrayLike = (),
+    num_samples: int = LEARNING_SAMPLES,
+    max_nfev: int = LEARNING_MAX_EVALUATIONS,
+    processes: int = LEARNING_PROCESSES,
+    time_budget: float = LEARNING_TIME_BUDGET,
+    rng: np.random.Generator | None = None,
+    cancel: threading.Event | None = None,
+) -> tuple[UniStatModelParams, float]:
+    """Searches for the best fit of the model parameters from many starts and returns it with its
+    cost.
+
+    The candidates are the given start vectors (num_starts, num_params) and num_samples Latin
+    hypercube samples inside the parameter bounds. They are screened together in one batched
+    simulation and the best LEARNING_REFINED_STARTS are fitted in rounds of successive halving:
+    each round continues the fits of the survivors with twice the evaluations of the last and
+    drops the worse half, so the last survivor gets max_nfev evaluations in total. The search
+    returns the best fit so far once time_budget seconds have passed or cancel is set, setting
+    cancel also stops the running fits at their next iteration.
+
+    With more than one process the fits of a round run in a process pool, only the fitted vector
+    and cost of each start come back.
+    """
+    started = time.monotonic()
+    params = model.model_params
+    bounds = params.param_bounds
+    segments = _training_segments(model, data)
+    starts = np.asarray(starts, dtype=float).reshape(-1, params.num_params)
+    candidates = np.unique(
+        np.concatenate(
+            [
+                params.clip(starts),
+                _latin_hypercube(bounds, num_samples, rng or np.random.default_rng()),
+            ]
+        ),
+        axis=0,
+    )
+    if candidates.shape[0] == 0:
+        candidates = params.to_vector()[np.newaxis]
+
+    # Poor starts are dropped before any local fit
+    costs = _screen(model, segments, data.dt, candidates)
+    order = np.argsort(costs, kind="stable")[:LEARNING_REFINED_STARTS]
+    survivors = candidates[order]
+    _LOGGER.debug(
+        "Screened %s candidates, refining costs %s", len(candidates), costs[order]
+    )
+
+    num_rounds = int(np.ceil(np.log2(len(survivors)))) + 1
+    shares = 2.0 ** np.arange(num_rounds)
+    totals = np.ceil(max_nfev * np.cumsum(shares) / np.sum(shares))
+    evaluations = np.diff(totals, prepend=0).astype(int)
+    best, best_cost = survivors[0], float(costs[order[0]])
+    with _fit_pool(
+        model, segments, data.dt, min(processes, len(survivors)), cancel
+    ) as fit:
+        for nfev in evaluations:
+            results = sorted(fit(survivors, max(nfev, 1)), key=lambda result: result[1])
+            if results[0][1] < best_cost:
+                best, best_cost = results[0]
+            survivors = np.array(
+                [vector for vector, _ in results[: max(len(results) // 2, 1)]]
+            )
+            if cancel is not None and cancel.is_set():
+                _LOGGER.debug("Model fit was cancelled")
+                break
+            if time.monotonic() - started > time_budget:
+                _LOGGER.warning(
+                    "Model fit ran out of time, keeping the best fit so far"
+                )
+                break
+    _LOGGER.debug("Best of %s candidates has cost %s", len(candidates), best_cost)
+    return params.from_vector(best), best_cost
+
+
+class OnlineParamEstimator:
+    """Extended Kalman filter over the parameter vector, updated on each control tick.
+
+    The parameters follow a bounded random walk and each update observes the room temperatures
+    one step after a measured state and input. The measurement Jacobian is the first order
+    sensitivity dt * (dA/dp @ x + dB/dp @ u) of the room rows, so an update costs O(num_params^2)
+    plus one discretization instead of a refit of the whole history.
+    """
+
+    def __init__(
+        self,
+        model_params: UniStatModelParams,
+        covariance: npt.ArrayLike | None = None,
+    ):
+        self._model_params = model_params
+        bounds = model_params.param_bounds
+        vector = model_params.to_vector()
+        # Parameters starting at zero are scaled by the width of their bounds instead
+        self._scale = np.where(vector != 0, np.abs(vector), bounds[:, 1] - bounds[:, 0])
+        self._prior = (ESTIMATOR_PRIOR * self._scale) ** 2
+        if covariance is None:
+            covariance = np.diag(self._prior)
+        self._covariance = np.array(covariance, dtype=float)
+        if self._covariance.shape != (vector.size, vector.size):
+            raise ValueError("covariance does not match the number of parameters.")
+
+    @property
+    def model_params(self) -> UniStatModelParams:
+        return self._model_params
+
+    @property
+    def covariance(self) -> npt.NDArray:
+        covariance = self._covariance.view()
+        covariance.setflags(write=False)
+        return covariance
+
+    def update(
+        self,
+        model: UniStatSystemModel,
+        states: npt.NDArray,
+        controls: npt.NDArray,
+        room_temps: npt.NDArray,
+        dt: float,
+        observed: npt.ArrayLike | None = None,
+    ) -> float | None:
+        """Updates the estimate from room_temps measured dt seconds after states and controls.
+
+        Only the rooms in the observed mask with a finite temperature are observed, the others
+        don't constrain the update. Returns the RMS prediction error of the observed rooms before
+        the update, or None if the update was skipped because of missing measurements.
+        """
+        room_temps = np.asarray(room_temps, dtype=float)
+        observed = np.isfinite(room_temps) & (
+            True if observed is None else np.asarray(observed, dtype=bool)
+        )
+        values = np.concatenate([states, controls, [dt]])
+        if not np.all(np.isfinite(values)) or dt <= 0 or not np.any(observed):
+            return None
+
+        params = self._model_params
+        vector = params.vector
+        rooms = np.arange(1, params.num_rooms + 1)[observed]
+        ad, bd = model.discretize(dt, params)
+        error = room_temps[observed] - (ad @ states + bd @ controls)[rooms]
+
+        d_a, d_b = model._assemble_jacobian(vector)
+        h = dt * (d_a @ states + d_b @ controls)[:, rooms].T
+
+        # Unobservable parameters stop drifting once they are back at the prior uncertainty
+        drift = (ESTIMATOR_DRIFT * self._scale) ** 2
+        covariance = self._covariance + np.diag(
+            np.where(np.diag(self._covariance) < self._prior, drift, 0)
+        )
+        ph = covariance @ h.T
+        innovation = h @ ph + ESTIMATOR_SENSOR_NOISE**2 * np.eye(rooms.size)
+        gain = np.linalg.solve(innovation, ph.T).T
+        covariance -= gain @ ph.T
+        self._covariance = (covariance + covariance.T) / 2
+
+        vector = params.clip(vector + gain @ error)
+        self._model_params = params.from_vector(vector)
+        return float(np.sqrt(np.mean(error**2)))
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "parameters": self._model_params.to_vector().tolist(),
+            "covariance": self._covariance.tolist(),
+        }
+
+    @staticmethod
+    def from_dict(
+        model_params: UniStatModelParams, data: dict[str, Any] | None
+    ) -> "OnlineParamEstimator":
+        """Restores a checkpoint taken with as_dict, starting fresh if it doesn't fit the params"""
+        try:
+            return OnlineParamEstimator(
+                model_params.from_vector(np.array(data["parameters"], dtype=float)),
+                data["covariance"],
+            )
+        except (KeyError, TypeError, ValueError):
+            return OnlineParamEstimator(model_params)
+
+
+def read_current_state(
+    hass: HomeAssistant, model: UniStatSystemModel
+) -> tuple[npt.NDArray, npt.NDArray]:
+    """Reads the current model state (num_states,) and inputs (num_controls,) from hass.
+
+    Missing or unavailable values are NaN.
+    """
+    outside_entity, room_entities, _ = _model_entities(model)
+
+    def value(entity_id: str, convert) -> float:
+        state = hass.states.get(entity_id)
+        if state is None or state.state in (STATE_UNAVAILABLE, STATE_UNKNOWN):
+            return np.nan
+        return convert(state)
+
+    states = model.initial_state(
+        value(outside_entity, _outside_temp),
+        [value(e, _float_state) for e in room_entities],
+    )
+    controls = np.array(
+        [
+            value(eid, lambda s, m=mode: _control_value(s, m))
+            for eid, mode in model.control_outputs
+        ]
+    )
+    return states, controls
+
+
+async def async_load_training_data(
+    hass: HomeAssistant,
+    model: UniStatSystemModel,
+    start: datetime,
+    end: datetime,
+    dt: float = DEFAULT_TIME_STEP,
+    cache_path: str | None = None,
+) -> TrainingData | None:
+    """Loads the training history from the recorder, returns None if the recorder isn't available.
+    With cache_path only the history since the last load is read from the recorder."""
+    block = await async_load_history(hass, model, start, end, dt, cache_path)
+    if block is None:
+        return None
+
+    conf = model.model_params.conf_data
+    return TrainingData(
+        dt=dt,
+        outside_temps=block[SIGNAL_OUTSIDE_TEMP],
+        room_temps=np.stack([block[room_signal(r)] for r in conf[CONF_AREAS]], axis=-1),
+        controls=np.stack(
+            [block[control_signal(*output)] for output in model.control_outputs],
+            axis=-1,
+        ),
+    )
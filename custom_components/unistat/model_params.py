@@ -2,7 +2,7 @@ import numpy as np
 import numpy.typing as npt
 import logging
 
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, fields
 from typing import Final, Any
 from types import MappingProxyType
 from functools import cached_property
@@ -29,11 +29,61 @@ from .const import (
 _LOGGER = logging.getLogger(__name__)
 
 PARAM_VERSION: Final = 1
+PARAM_MINOR_VERSION: Final = 2
+
+STORE_MODEL_PARAMS: Final = "model_params"
+STORE_ESTIMATOR: Final = "estimator"
+
+# Cached properties that only depend on the config and the layout of the tunable fields, shared by
+# the parameters that from_vector derives
+_LAYOUT_CACHES: Final = (
+    "_tunable_fields",
+    "_field_slices",
+    "_non_constant_fields",
+    "_bounds_map",
+    "param_bounds",
+    "adjacency_matrix",
+    "wall_edges",
+    "outside_walls",
+    "num_params",
+    "standalone_appliances",
+    "central_appliances",
+)
+
+
+def _flatten(values) -> list:
+    """Flattens a config or parameter value, which may be a scalar or a (nested) list"""
+    if isinstance(values, str) or np.isscalar(values):
+        return [values]
+    out = []
+    for v in values:
+        out.extend(_flatten(v))
+    return out
+
+
+def _unflatten(template, values: list) -> Any:
+    """Inverse of _flatten, rebuilds the nesting of template from a flat list of values"""
+    values = iter(values)
+
+    def rebuild(t):
+        if isinstance(t, str) or np.isscalar(t):
+            return next(values)
+        return [rebuild(v) for v in t]
+
+    return rebuild(template)
 
 
 class UniStatModelParamsStore(Store):
+    """Stores the fitted model parameters and the online estimator state.
+
+    The stored data is {STORE_MODEL_PARAMS: ..., STORE_ESTIMATOR: ...}, either may be missing.
+    """
+
     async def _async_migrate_func(self, old_major_version, old_minor_version, old_data):
         """Migrate to the new version."""
+        if old_major_version == 1 and old_minor_version < 2:
+            # Version 1.1 stored the model parameters alone
+            return {STORE_MODEL_PARAMS: old_data}
         raise NotImplementedError
 
 
@@ -63,6 +113,17 @@ class UniStatModelParams:
             "internal_loads",
         )
 
+    @cached_property
+    def _field_slices(self) -> MappingProxyType[str, slice]:
+        """Slices of to_vector() that hold each tunable field"""
+        slices = {}
+        first = 0
+        for tf in self._tunable_fields:
+            last = first + len(_flatten(getattr(self, tf)))
+            slices[tf] = slice(first, last)
+            first = last
+        return MappingProxyType(slices)
+
     @cached_property
     def _non_constant_fields(self) -> tuple[str]:
         """Returns list of fields that contain time-varying parameters"""
@@ -129,10 +190,7 @@ class UniStatModelParams:
                 radiator_constants.append(
                     [DEFAULT_RADIATOR_CONSTANT] * ca["num_fixtures"]
                 )
-                radiator_rooms.append([])
-                for z in ca["zone_map"]:
-                    radiator_rooms[-1] = radiator_rooms[-1] + z
-                radiator_rooms[-1] = radiator_rooms[-1] + ca["common_rooms"]
+                radiator_rooms.append(ca["fixture_rooms"])
 
         hvac_vent_constants = []
         hvac_system = UniStatModelParams._coalesce_hvac(config_data, central_appliances)
@@ -161,7 +219,7 @@ class UniStatModelParams:
             radiator_rooms=radiator_rooms,
             radiator_constants=radiator_constants,
             internal_loads=internal_loads,
-            thermal_lag=DEFAULT_THERMAL_LAG,
+            thermal_lag=[DEFAULT_THERMAL_LAG],
             hvac_vent_constants=hvac_vent_constants,
         )
 
@@ -266,23 +324,22 @@ class UniStatModelParams:
     @staticmethod
     def _add_zoned_appliance_metadata(appliance: dict) -> dict:
         """Adds metadata to a boiler config"""
-        # Figure out how rooms are organized within zones
-        rooms = [set(app[CONF_AREAS]) for app in appliance[CONF_CONTROLS]]
+        # Figure out how rooms are organized within zones, in config order
+        rooms = [
+            list(dict.fromkeys(app[CONF_AREAS])) for app in appliance[CONF_CONTROLS]
+        ]
 
         # First find rooms that are heated on any zone call. These are called common rooms
-        common_rooms = set(rooms[0])
-        for r in rooms:
-            common_rooms &= r
+        common_rooms = [r for r in rooms[0] if all(r in z for z in rooms)]
 
         # Next find rooms that are zone specific
-        zone_specific_rooms = [list(r - common_rooms) for r in rooms]
+        zone_specific_rooms = [[r for r in z if r not in common_rooms] for z in rooms]
 
-        # Compute number of logical radiators or vents tied to this appliance
+        # One logical radiator or vent per room tied to this appliance
         # NOTE this need not be equal to the physical number of radiators, for instance if there
         # are two radiators in a room on the same zone that can't be controlled independently then it can be modeled as one radiator.
-        num_fixtures = int(
-            np.sum([len(z) for z in zone_specific_rooms]) + len(common_rooms)
-        )
+        fixture_rooms = list(dict.fromkeys(r for z in rooms for r in z))
+        num_fixtures = len(fixture_rooms)
 
         # Check if rooms other than the common rooms are on more than one zone
         for i, r in enumerate(zone_specific_rooms):
@@ -304,8 +361,9 @@ class UniStatModelParams:
             "num_zones": len(appliance[CONF_CONTROLS]),
             "num_fixtures": num_fixtures,
             "has_common_rooms": len(common_rooms) > 0,
-            "common_rooms": list(common_rooms),
-            "zone_map": [list(r) for r in rooms],
+            "common_rooms": common_rooms,
+            "zone_map": rooms,
+            "fixture_rooms": fixture_rooms,
         }
 
     @staticmethod
@@ -397,69 +455,116 @@ class UniStatModelParams:
     def from_vector(self, parameters: npt.NDArray) -> "UniStatModelParams":
         """Take in an array and update the UniStatModelParams.
 
-        The input parameters must match the size and ordering of the result of to_vector().
+        The input parameters must match the size and ordering of the result of to_vector(). The
+        result shares conf_data, the other untuned fields and the cached field layout with this
+        instance. A read-only view of parameters becomes its vector without a copy, so the caller
+        must not modify parameters afterwards. The tunable fields are derived from the vector when
+        they are first read.
         """
 
         if parameters.shape != (self.num_params,):
             raise ValueError("provided parameters are the wrong shape.")
 
-        data = self.asdict()
-
-        first = 0
-        for tf in self._tunable_fields:
-            last = first + np.size(data[tf])
-            data[tf] = parameters[first:last].tolist()
-            first = last
+        vector = np.asarray(parameters, dtype=float).view()
+        vector.flags.writeable = False
+        params = object.__new__(UniStatModelParams)
+        tunable = set(self._tunable_fields)
+        for f in fields(self):
+            if f.name not in tunable:
+                params.__dict__[f.name] = getattr(self, f.name)
+        for name in _LAYOUT_CACHES:
+            if name in self.__dict__:
+                params.__dict__[name] = self.__dict__[name]
+        # The nesting of the tunable fields comes from the instance that holds them as lists
+        params.__dict__["_template"] = self.__dict__.get("_template", self)
+        params.__dict__["vector"] = vector
+        return params
+
+    def __getattr__(self, name: str) -> Any:
+        """Derives a tunable field of parameters made by from_vector from their vector"""
+        template = self.__dict__.get("_template")
+        if template is None or name not in self._field_slices:
+            raise AttributeError(
+                f"'{type(self).__name__}' object has no attribute '{name}'"
+            )
+        value = _unflatten(
+            getattr(template, name), self.vector[self._field_slices[name]].tolist()
+        )
+        self.__dict__[name] = value
+        return value
 
-        return UniStatModelParams(**data)
+    @cached_property
+    def vector(self) -> npt.NDArray:
+        """Read-only view of the tunable parameters, ordered like to_vector()"""
+        vector = np.array(
+            [v for tf in self._tunable_fields for v in _flatten(getattr(self, tf))],
+            dtype=float,
+        )
+        vector.flags.writeable = False
+        return vector
 
     def to_vector(self) -> npt.NDArray:
         """Pack tunable parameters into a single vector"""
-        data = self.asdict()
-        parameters = [data[tf] for tf in self._tunable_fields]
-        return np.concat(parameters)
+        return self.vector.copy()
 
     @property
     def num_rooms(self) -> int:
         return len(self.conf_data[CONF_AREAS])
 
-    @property
+    @cached_property
     def num_params(self) -> int:
-        return self.to_vector().shape[0]
+        return self._field_slices[self._tunable_fields[-1]].stop
 
     @property
     def has_boiler(self) -> bool:
         return len(self.boiler_thermal_masses) > 0
 
-    @property
+    @cached_property
     def adjacency_matrix(self) -> npt.NDArray:
-        return np.array(self.conf_data["adjacency"])
+        """Read-only adjacency of the outside (node 0) and the rooms"""
+        adjacency = np.array(self.conf_data["adjacency"])
+        adjacency.flags.writeable = False
+        return adjacency
 
-    @property
-    def param_bounds(self) -> npt.NDArray:
-        """Provide optimization bounds for tunable parameters"""
-
-        data = self.asdict()
-        bounds_map = self._bounds_map
+    @cached_property
+    def wall_edges(self) -> npt.NDArray:
+        """Read-only (num_walls, 2) nodes joined by each wall, ordered like thermal_resistances"""
+        edges = np.stack(np.nonzero(self.adjacency_matrix), axis=1)
+        edges.flags.writeable = False
+        return edges
 
-        constraints_list = []
-        for tf in self._tunable_fields:
-            constraints_list.extend([bounds_map[tf]] * len(data[tf]))
+    @cached_property
+    def outside_walls(self) -> npt.NDArray:
+        """Read-only (num_walls,) mask of the walls to the outside"""
+        outside = self.wall_edges[:, 0] == 0
+        outside.flags.writeable = False
+        return outside
 
-        return np.array(constraints_list)
+    @cached_property
+    def param_bounds(self) -> npt.NDArray:
+        """Provide optimization bounds for tunable parameters, a read-only (num_params, 2) array of
+        lower and upper bounds aligned with to_vector()"""
+        bounds = np.empty((self.num_params, 2))
+        for tf, s in self._field_slices.items():
+            bounds[s] = self._bounds_map[tf]
+        bounds.flags.writeable = False
+        return bounds
 
     @property
     def in_bounds(self) -> bool:
         """Checks that all parameters are within bounds"""
-        data = self.asdict()
-        bounds_map = self._bounds_map
-
-        for tf in self._tunable_fields:
-            vals = np.array(data[tf])
-            bounds = bounds_map[tf]
-            if np.any((vals < bounds[0]) | (vals > bounds[1])):
-                return False
-        return True
+        return bool(self.vectors_in_bounds(self.vector))
+
+    def vectors_in_bounds(self, vectors: npt.ArrayLike) -> npt.NDArray:
+        """Checks parameter vectors (..., num_params) against the bounds, returns (...,) booleans"""
+        vectors = np.asarray(vectors, dtype=float)
+        bounds = self.param_bounds
+        return ~np.any((vectors < bounds[:, 0]) | (vectors > bounds[:, 1]), axis=-1)
+
+    def clip(self, vectors: npt.ArrayLike) -> npt.NDArray:
+        """Projects parameter vectors (..., num_params) onto the bounds"""
+        bounds = self.param_bounds
+        return np.clip(vectors, bounds[:, 0], bounds[:, 1])
 
     @property
     def self_consistent(self) -> bool:
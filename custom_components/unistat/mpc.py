@@ -0,0 +1,514 @@
+"""Model predictive control for UniStat."""
+
+import numpy as np
+import numpy.typing as npt
+import logging
+import threading
+
+from dataclasses import dataclass
+from itertools import product
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Final
+
+from homeassistant.components.climate import HVACMode
+
+from .const import CONF_APPLIANCE_TYPE, SWITCH_APPLIANCE_TYPES, ControlMode
+from .thermal_model import (
+    DEFAULT_TIME_STEP,
+    UniStatPredictionMatrices,
+    UniStatSystemModel,
+)
+
+if TYPE_CHECKING:
+    from .scheduler import UniStatScheduler
+
+_LOGGER = logging.getLogger(__name__)
+
+MPC_HORIZON_STEPS: Final = 36  # 3 hours of 5 minute steps
+# The same 3 hours with fine steps near term and coarse steps further out
+MPC_COMPRESSED_STEPS: Final = (300.0,) * 6 + (900.0,) * 4 + (1800.0,) * 3
+MPC_SWITCH_BLOCK: Final = (
+    1800.0  # seconds that a switch input is held in a compressed plan
+)
+MPC_COMPRESSION_THRESHOLD: Final = 8  # Compress the horizon from this many controls up
+# Explicit MPC is used up to this many rooms and controls
+EXPLICIT_MAX_ROOMS: Final = 3
+EXPLICIT_MAX_CONTROLS: Final = 4
+EXPLICIT_ERROR_GRID: Final = (
+    -3.0,
+    3.0,
+    7,
+)  # Room temperature minus setpoint (min, max, num)
+EXPLICIT_OUTSIDE_GRID: Final = (
+    -35.0,
+    15.0,
+    11,
+)  # Outside minus mean setpoint (min, max, num)
+MPC_MAX_ITERATIONS: Final = 500
+MPC_TOLERANCE: Final = 1e-6
+MPC_CONTROL_REGULARIZATION: Final = 1e-3
+# Weight of a kWh of heating or cooling relative to a squared degree of error per step
+MPC_ENERGY_WEIGHTS: Final = MappingProxyType(
+    {
+        ControlMode.COMFORT: 0.1,
+        ControlMode.ECO: 1.0,
+        ControlMode.BUDGET: 1.0,
+    }
+)
+
+
+def solve_box_qp(
+    hessian: npt.NDArray,
+    gradient: npt.NDArray,
+    lower: npt.NDArray,
+    upper: npt.NDArray,
+    initial: npt.NDArray,
+    lipschitz: float,
+    max_iterations: int = MPC_MAX_ITERATIONS,
+    tolerance: float = MPC_TOLERANCE,
+) -> tuple[npt.NDArray, int]:
+    """Minimizes 0.5 x'Hx + g'x subject to lower <= x <= upper.
+
+    Uses accelerated projected gradient (FISTA) with adaptive restarts, lipschitz is the largest
+    eigenvalue of the hessian. Each iteration is a single matrix-vector product, and a good initial
+    guess, such as the shifted previous solution, cuts the number of iterations substantially.
+    gradient and initial may carry leading batch dimensions to solve many QPs that share a
+    hessian at once. Returns the solution and the number of iterations taken.
+    """
+    x = np.clip(initial, lower, upper)
+    shape = np.broadcast_shapes(x.shape, np.shape(gradient))
+    # Rows of a batch are dropped from the iteration as they converge
+    x = np.broadcast_to(x, shape).reshape(-1, shape[-1]).copy()
+    gradient = np.broadcast_to(gradient, shape).reshape(-1, shape[-1])
+    active = np.arange(x.shape[0])
+    xa = x.copy()
+    y = x.copy()
+    t = np.ones((x.shape[0], 1))
+    step = 1 / lipschitz
+    for iteration in range(1, max_iterations + 1):
+        # The hessian is symmetric so this is hessian @ y for each row of y
+        x_new = np.clip(y - step * (y @ hessian + gradient[active]), lower, upper)
+        delta = x_new - xa
+        scale = np.maximum(1.0, np.linalg.norm(x_new, axis=-1))
+        converged = np.linalg.norm(delta, axis=-1) <= tolerance * scale
+        x[active] = x_new
+        if np.all(converged):
+            return x.reshape(shape), iteration
+        # Restart the acceleration wherever the momentum is pointing uphill
+        restart = np.sum((y - x_new) * delta, axis=-1, keepdims=True) > 0
+        t_new = np.where(restart, 1.0, (1 + np.sqrt(1 + 4 * t**2)) / 2)
+        y = np.where(restart, x_new, x_new + (t - 1) / t_new * delta)
+        keep = ~converged
+        active, xa, y, t = active[keep], x_new[keep], y[keep], t_new[keep]
+    return x.reshape(shape), max_iterations
+
+
+@dataclass(frozen=True)
+class MPCSolution:
+    """Optimal control plan over the horizon"""
+
+    steps: npt.NDArray  # (horizon,) step lengths in seconds
+    controls: npt.NDArray  # (horizon, num_controls)
+    room_temps: npt.NDArray  # (horizon, num_rooms), predicted at the end of each step
+    cost: float
+    iterations: int
+
+
+def _move_blocks(steps: npt.NDArray, block: float) -> npt.NDArray:
+    """Block index of each step, a new block starts every block seconds of the horizon"""
+    if block <= 0:
+        return np.arange(steps.shape[0])
+    starts = np.cumsum(steps) - steps
+    return np.unique(np.floor(starts / block), return_inverse=True)[1]
+
+
+class UniStatMPC:
+    """Condensed MPC over the model's control inputs.
+
+    The room temperatures over the horizon are an affine function of the stacked controls U, see
+    UniStatPredictionMatrices, so tracking the setpoints with an energy cost is a box constrained
+    QP in U alone. The prediction matrices come from the model, which is rebuilt whenever the
+    model parameters change, and each solve is warm started from the previous plan shifted by one
+    step.
+
+    dt may give one step length per horizon step for a grid that coarsens further out. With
+    switch_block, inputs of switch type appliances are held over blocks of that many seconds, so
+    U = M @ V for a 0/1 blocking matrix M and the QP is solved over the much shorter V.
+    """
+
+    def __init__(
+        self,
+        model: UniStatSystemModel,
+        horizon: int = MPC_HORIZON_STEPS,
+        dt: float | npt.ArrayLike = DEFAULT_TIME_STEP,
+        switch_block: float = 0,
+    ):
+        self._model = model
+        self._horizon = horizon
+        self._predictions = model.prediction_matrices(horizon, dt)
+        self._steps = self._predictions.steps
+        self._blocking = self._blocking_matrix(switch_block)
+        rows, columns = np.nonzero(self._blocking)
+        self._decision_controls = np.empty(self.num_decisions, dtype=int)
+        self._decision_controls[columns] = rows % model.num_controls
+        self._decision_steps = np.full(self.num_decisions, horizon)
+        np.minimum.at(self._decision_steps, columns, rows // model.num_controls)
+        self._gamma = np.ascontiguousarray(self._predictions.controls @ self._blocking)
+        self._hessians: dict[bytes, tuple[npt.NDArray, float]] = {}
+        self._last_solution: npt.NDArray | None = None
+
+    @staticmethod
+    def compressed(model: UniStatSystemModel) -> "UniStatMPC":
+        """Coarse grid and move blocked MPC, for houses with many controls or slow hosts"""
+        return UniStatMPC(
+            model,
+            len(MPC_COMPRESSED_STEPS),
+            MPC_COMPRESSED_STEPS,
+            switch_block=MPC_SWITCH_BLOCK,
+        )
+
+    @property
+    def model(self) -> UniStatSystemModel:
+        return self._model
+
+    @property
+    def horizon(self) -> int:
+        return self._horizon
+
+    @property
+    def num_decisions(self) -> int:
+        return self._blocking.shape[1]
+
+    @property
+    def decision_controls(self) -> npt.NDArray:
+        """Control index of each decision (num_decisions,)"""
+        return self._decision_controls
+
+    @property
+    def decision_steps(self) -> npt.NDArray:
+        """First horizon step that each decision is applied at (num_decisions,)"""
+        return self._decision_steps
+
+    @property
+    def predictions(self) -> UniStatPredictionMatrices:
+        return self._predictions
+
+    def _blocking_matrix(self, switch_block: float) -> npt.NDArray:
+        """Maps the decision vector to the stacked controls (horizon * num_controls, num_decisions)"""
+        num_controls = self._model.num_controls
+        columns = np.empty((self._horizon, num_controls), dtype=int)
+        first = 0
+        for k, c in enumerate(self._model._control_layout):
+            is_switch = c[CONF_APPLIANCE_TYPE] in SWITCH_APPLIANCE_TYPES
+            blocks = _move_blocks(self._steps, switch_block if is_switch else 0)
+            columns[:, k] = first + blocks
+            first += blocks[-1] + 1 if blocks.size else 0
+        blocking = np.zeros((self._horizon * num_controls, first))
+        blocking[np.arange(blocking.shape[0]), columns.reshape(-1)] = 1
+        return blocking
+
+    def _hessian(self, room_weights: npt.NDArray) -> tuple[npt.NDArray, float]:
+        """Hessian of the QP and its largest eigenvalue, cached per set of room weights"""
+        key = room_weights.tobytes()
+        if (cached := self._hessians.get(key)) is None:
+            weights = self._weights(room_weights)
+            hessian = 2 * (self._gamma.T @ (weights[:, np.newaxis] * self._gamma))
+            hessian += (
+                2 * MPC_CONTROL_REGULARIZATION * np.diag(np.sum(self._blocking, axis=0))
+            )
+            cached = (hessian, float(np.linalg.eigvalsh(hessian)[-1]))
+            self._hessians[key] = cached
+        return cached
+
+    def _weights(self, room_weights: npt.NDArray) -> npt.NDArray:
+        """Tracking weights of the stacked room temperatures, longer steps count for more"""
+        return np.outer(self._steps / DEFAULT_TIME_STEP, room_weights).reshape(-1)
+
+    def _warm_start(self) -> npt.NDArray:
+        """The last plan shifted forward by the first step, projected onto the decisions"""
+        if self._last_solution is None:
+            return np.zeros(self.num_decisions)
+        ends = np.cumsum(self._steps)
+        starts = ends - self._steps + self._steps[0]
+        # Repeat the final input past the end of the last plan
+        previous = np.minimum(
+            np.searchsorted(ends, starts, side="right"), self._horizon - 1
+        )
+        shifted = self._last_solution[previous].reshape(-1)
+        return (self._blocking.T @ shifted) / np.sum(self._blocking, axis=0)
+
+    def _problem(
+        self,
+        states: npt.ArrayLike,
+        setpoints: npt.ArrayLike,
+        room_weights: npt.ArrayLike | None,
+        outside_temps: npt.ArrayLike | None,
+        energy_weight: float,
+    ) -> tuple[npt.NDArray, ...]:
+        """QP terms for states (..., num_states), returns the tracking errors with all controls
+        off, their weights, the energy cost, the hessian, its largest eigenvalue and the gradient"""
+        num_rooms = self._model.model_params.num_rooms
+        x0 = np.asarray(states, dtype=float)
+        setpoints = np.broadcast_to(np.asarray(setpoints, dtype=float), (num_rooms,))
+        room_weights = np.ones(num_rooms) if room_weights is None else room_weights
+        room_weights = np.broadcast_to(
+            np.asarray(room_weights, dtype=float), (num_rooms,)
+        )
+        if outside_temps is not None:
+            outside_temps = np.asarray(outside_temps, dtype=float)
+            if outside_temps.shape[-1:] != (self._horizon,):
+                raise ValueError("outside_temps must have one value per horizon step.")
+
+        error = self._predictions.predict(x0, outside_temps=outside_temps) - setpoints
+        error = error.reshape(*error.shape[:-2], -1)
+        weights = self._weights(room_weights)
+
+        powers = np.abs([c["power"] for c in self._model._control_layout])
+        energy = energy_weight * np.outer(self._steps / 3600, powers).reshape(-1)
+        energy = self._blocking.T @ energy
+        hessian, lipschitz = self._hessian(np.ascontiguousarray(room_weights))
+        gradient = 2 * (weights * error) @ self._gamma + energy
+        return error, weights, energy, hessian, lipschitz, gradient
+
+    def solve(
+        self,
+        states: npt.ArrayLike,
+        setpoints: npt.ArrayLike,
+        room_weights: npt.ArrayLike | None = None,
+        outside_temps: npt.ArrayLike | None = None,
+        energy_weight: float = MPC_ENERGY_WEIGHTS[ControlMode.COMFORT],
+    ) -> MPCSolution:
+        """Plans the controls over the horizon from the current state.
+
+        setpoints (num_rooms,) are tracked with room_weights (num_rooms,), a weight of zero lets
+        a room float. outside_temps (horizon,) is the outside temperature forecast, by default the
+        current outside temperature is held. Heating and cooling energy is charged at
+        energy_weight per kWh.
+        """
+        error, weights, energy, hessian, lipschitz, gradient = self._problem(
+            states, setpoints, room_weights, outside_temps, energy_weight
+        )
+        decisions, iterations = solve_box_qp(
+            hessian,
+            gradient,
+            np.zeros(self.num_decisions),
+            np.ones(self.num_decisions),
+            self._warm_start(),
+            lipschitz,
+        )
+        controls = (self._blocking @ decisions).reshape(
+            self._horizon, self._model.num_controls
+        )
+        self._last_solution = controls
+
+        predicted = error + self._gamma @ decisions
+        cost = float(
+            np.sum(weights * predicted**2)
+            + energy @ decisions
+            + MPC_CONTROL_REGULARIZATION * np.sum(controls**2)
+        )
+        _LOGGER.debug("MPC solved in %s iterations with cost %s", iterations, cost)
+        return MPCSolution(
+            steps=self._steps,
+            controls=controls,
+            room_temps=predicted.reshape(self._horizon, -1) + setpoints,
+            cost=cost,
+            iterations=iterations,
+        )
+
+    def solve_batch(
+        self,
+        states: npt.ArrayLike,
+        setpoints: npt.ArrayLike,
+        room_weights: npt.ArrayLike | None = None,
+        outside_temps: npt.ArrayLike | None = None,
+        energy_weight: float = MPC_ENERGY_WEIGHTS[ControlMode.COMFORT],
+    ) -> npt.NDArray:
+        """Plans for a batch of states (..., num_states) at once, returns the controls
+        (..., horizon, num_controls).
+
+        The QPs share their hessian so they are solved together, without warm starts, and the
+        last plan used by solve() is left alone. outside_temps may be (..., horizon).
+        """
+        _, _, _, hessian, lipschitz, gradient = self._problem(
+            states, setpoints, room_weights, outside_temps, energy_weight
+        )
+        decisions, _ = solve_box_qp(
+            hessian,
+            gradient,
+            np.zeros(self.num_decisions),
+            np.ones(self.num_decisions),
+            np.zeros(self.num_decisions),
+            lipschitz,
+        )
+        return self.expand(decisions)
+
+    def expand(self, decisions: npt.NDArray) -> npt.NDArray:
+        """Controls (..., horizon, num_controls) of decisions (..., num_decisions)"""
+        controls = decisions @ self._blocking.T
+        return controls.reshape(
+            *controls.shape[:-1], self._horizon, self._model.num_controls
+        )
+
+    def first_controls(self, solution: MPCSolution) -> dict[str, dict[HVACMode, float]]:
+        """The first step of a plan keyed by control entity and mode"""
+        return self.controls_by_entity(solution.controls[0])
+
+    def controls_by_entity(
+        self, controls: npt.NDArray
+    ) -> dict[str, dict[HVACMode, float]]:
+        """Model inputs (num_controls,) keyed by control entity and mode"""
+        out = {}
+        for (eid, mode), value in zip(self._model.control_outputs, controls):
+            out.setdefault(eid, {})[mode] = float(value)
+        return out
+
+
+class UniStatExplicitMPC:
+    """Explicit MPC for small houses, the control law is tabulated offline.
+
+    The model is unchanged by a common shift of every temperature, so for fixed setpoint offsets
+    between rooms, room weights and energy weight the first step of the plan only depends on the
+    room temperature errors and the outside temperature relative to the mean setpoint. The table
+    holds the first step on a regular grid of those. Instead of the exact piecewise affine
+    partition into regions, a lookup locates the grid cell of the point and interpolates
+    multilinearly between its corners, so no QP is solved at runtime. Points outside the grid are
+    clamped to it. The outside temperature is held over the horizon, there is no forecast
+    dimension, as the online controllers plan without a forecast too.
+
+    Without a scheduler the grid is solved as one batch of relaxed QPs. With a scheduler, whose
+    MPC is mpc, each point holds the first step of its on/off schedule, a lookup rounds switch
+    controls to on or off and holds the switches that haven't been on or off for their minimum
+    time.
+    """
+
+    def __init__(
+        self,
+        mpc: UniStatMPC,
+        offsets: npt.ArrayLike,
+        room_weights: npt.ArrayLike | None = None,
+        energy_weight: float = MPC_ENERGY_WEIGHTS[ControlMode.COMFORT],
+        scheduler: "UniStatScheduler | None" = None,
+        cancel: threading.Event | None = None,
+    ):
+        model = mpc.model
+        num_rooms = model.model_params.num_rooms
+        offsets = np.broadcast_to(np.asarray(offsets, dtype=float), (num_rooms,))
+        # Only the offsets between the setpoints matter
+        offsets = offsets - np.mean(offsets)
+        self._mpc = mpc
+        self._key = self.key(offsets, room_weights, energy_weight)
+        self._axes = [np.linspace(*EXPLICIT_ERROR_GRID)] * num_rooms + [
+            np.linspace(*EXPLICIT_OUTSIDE_GRID)
+        ]
+        self._lower = np.array([a[0] for a in self._axes])
+        self._spacing = np.array([a[1] - a[0] for a in self._axes])
+        self._shape = np.array([a.size for a in self._axes])
+        self._corners = np.array(list(product((0, 1), repeat=self._shape.size)))
+        self._switch = np.array(
+            [
+                c[CONF_APPLIANCE_TYPE] in SWITCH_APPLIANCE_TYPES
+                for c in model._control_layout
+            ],
+            dtype=bool,
+        )
+        self._scheduled = scheduler is not None
+        self._min_times = (
+            (scheduler.min_on_time, scheduler.min_off_time) if scheduler else (0, 0)
+        )
+
+        grid = np.stack(np.meshgrid(*self._axes, indexing="ij"), axis=-1)
+        states = np.ones((*grid.shape[:-1], model.num_states))
+        states[..., 0] = grid[..., -1]
+        states[..., 1 : num_rooms + 1] = grid[..., :-1] + offsets
+        if scheduler is None:
+            controls = mpc.solve_batch(
+                states, offsets, room_weights, None, energy_weight
+            )[..., 0, :]
+        else:
+            # Neighbouring points are scheduled one after the other, each warm starts the next
+            flat = states.reshape(-1, model.num_states)
+            controls = np.zeros((flat.shape[0], model.num_controls))
+            for i, x in enumerate(flat):
+                if cancel is not None and cancel.is_set():
+                    break
+                schedule = scheduler.solve(
+                    x, offsets, room_weights, None, energy_weight
+                )
+                controls[i] = schedule.controls[0]
+            controls = controls.reshape(*states.shape[:-1], model.num_controls)
+        self._table = np.ascontiguousarray(controls)
+        self._table.setflags(write=False)
+
+    @staticmethod
+    def key(
+        setpoints: npt.ArrayLike,
+        room_weights: npt.ArrayLike | None,
+        energy_weight: float,
+    ) -> bytes:
+        """Identifies the setpoint offsets and weights that a table was built for, a common shift
+        of every setpoint keeps the key"""
+        setpoints = np.asarray(setpoints, dtype=float)
+        weights = np.ones_like(setpoints) if room_weights is None else room_weights
+        return np.concatenate(
+            [setpoints - np.mean(setpoints), np.broadcast_to(weights, setpoints.shape)]
+            + [[energy_weight]]
+        ).tobytes()
+
+    @property
+    def mpc(self) -> UniStatMPC:
+        return self._mpc
+
+    @property
+    def model(self) -> UniStatSystemModel:
+        return self._mpc.model
+
+    @property
+    def table(self) -> npt.NDArray:
+        """First step controls (num_error_points, ..., num_outside_points, num_controls)"""
+        return self._table
+
+    def matches(
+        self,
+        setpoints: npt.ArrayLike,
+        room_weights: npt.ArrayLike | None,
+        energy_weight: float,
+    ) -> bool:
+        return self._key == self.key(setpoints, room_weights, energy_weight)
+
+    def lookup(
+        self,
+        states: npt.ArrayLike,
+        setpoints: npt.ArrayLike,
+        current: npt.ArrayLike | None = None,
+        elapsed: npt.ArrayLike | None = None,
+    ) -> npt.NDArray:
+        """Interpolated first step controls (num_controls,) for the current state. current and
+        elapsed are the current inputs and the seconds since they changed, as for
+        UniStatScheduler.solve."""
+        x = np.asarray(states, dtype=float)
+        setpoints = np.asarray(setpoints, dtype=float)
+        point = np.empty(self._shape.size)
+        point[:-1] = x[1 : point.size] - setpoints
+        point[-1] = x[0] - np.mean(setpoints)
+
+        coords = np.clip((point - self._lower) / self._spacing, 0, self._shape - 1)
+        cell = np.minimum(coords.astype(int), self._shape - 2)
+        frac = coords - cell
+        weights = np.prod(np.where(self._corners, frac, 1 - frac), axis=1)
+        controls = np.clip(weights @ self._table[tuple((cell + self._corners).T)], 0, 1)
+        if not self._scheduled:
+            return controls
+
+        controls[self._switch] = np.round(controls[self._switch])
+        if current is not None and elapsed is not None:
+            value = np.asarray(current, dtype=float)
+            on = value > 0.5
+            minimum = np.where(on, *self._min_times)
+            held = (
+                self._switch
+                & np.isfinite(value)
+                & (np.asarray(elapsed, dtype=float) < minimum)
+            )
+            controls[held] = on[held]
+        return controls
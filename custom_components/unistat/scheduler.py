@@ -0,0 +1,214 @@
+"""On/off scheduling for UniStat."""
+
+import numpy as np
+import numpy.typing as npt
+import logging
+import threading
+import time
+
+from dataclasses import dataclass
+from typing import Final
+
+from .const import (
+    CONF_APPLIANCE_TYPE,
+    SWITCH_APPLIANCE_TYPES,
+    ControlMode,
+)
+from .mpc import MPC_ENERGY_WEIGHTS, MPC_SWITCH_BLOCK, UniStatMPC, solve_box_qp
+from .thermal_model import UniStatSystemModel
+
+_LOGGER = logging.getLogger(__name__)
+
+# Minimum time that a switch appliance stays on or off, no longer than MPC_SWITCH_BLOCK so that
+# plans made of whole blocks always respect it
+SCHEDULER_MIN_ON_TIME: Final = 600.0
+SCHEDULER_MIN_OFF_TIME: Final = 600.0
+SCHEDULER_MAX_NODES: Final = 5000
+SCHEDULER_TIME_LIMIT: Final = 60.0  # seconds, well inside the 5 minute control interval
+SCHEDULER_GAP: Final = (
+    1e-3  # Relative gap to the best schedule below which nodes are pruned
+)
+SCHEDULER_INTEGRALITY: Final = 1e-3
+
+
+@dataclass(frozen=True)
+class Schedule:
+    """On/off schedule over the horizon"""
+
+    steps: npt.NDArray  # (horizon,) step lengths in seconds
+    controls: npt.NDArray  # (horizon, num_controls), switch controls are 0 or 1
+    room_temps: npt.NDArray  # (horizon, num_rooms), predicted at the end of each step
+    cost: float
+    nodes: int
+    optimal: bool  # False if the search was cut short by the node or time limit
+
+
+class UniStatScheduler:
+    """Branch and bound scheduler for switch type appliances.
+
+    Boiler zone calls, HVAC heat and cool calls, space heaters and window ACs are either on or off,
+    rounding a relaxed plan makes them chatter. The scheduler solves the compressed MPC with their
+    decisions restricted to 0 or 1, each held over a block of MPC_SWITCH_BLOCK seconds, other
+    controls stay continuous. An appliance is held in its current state until it has been on or off
+    for its minimum time. Zones of a central appliance are scheduled independently, there is no
+    rule keeping a boiler's first zone open: the config has no primary zone, and the boiler couples
+    its zones through the model dynamics.
+
+    Each node fixes some binary decisions through their bounds and is bounded from below by the
+    relaxed QP, warm started from its parent. Nodes that can't beat the best schedule found so far
+    are pruned and relaxations are cached by their fixings. The search is depth first towards the
+    rounded relaxation, so a good schedule is found early, and stops at SCHEDULER_MAX_NODES nodes
+    or SCHEDULER_TIME_LIMIT.
+    """
+
+    def __init__(
+        self,
+        model: UniStatSystemModel,
+        min_on_time: float = SCHEDULER_MIN_ON_TIME,
+        min_off_time: float = SCHEDULER_MIN_OFF_TIME,
+    ):
+        if max(min_on_time, min_off_time) > MPC_SWITCH_BLOCK:
+            raise ValueError("Minimum on and off times can't exceed MPC_SWITCH_BLOCK.")
+        self._mpc = UniStatMPC.compressed(model)
+        self._min_on_time = min_on_time
+        self._min_off_time = min_off_time
+        controls = self._mpc.decision_controls
+        is_switch = np.array(
+            [
+                c[CONF_APPLIANCE_TYPE] in SWITCH_APPLIANCE_TYPES
+                for c in model._control_layout
+            ],
+            dtype=bool,
+        )
+        self._binary = is_switch[controls]
+        steps = self._mpc.predictions.steps
+        starts = np.cumsum(steps) - steps
+        self._decision_starts = starts[self._mpc.decision_steps]
+        self._last_decisions = np.zeros(self._mpc.num_decisions)
+
+    @property
+    def mpc(self) -> UniStatMPC:
+        return self._mpc
+
+    @property
+    def model(self) -> UniStatSystemModel:
+        return self._mpc.model
+
+    @property
+    def min_on_time(self) -> float:
+        return self._min_on_time
+
+    @property
+    def min_off_time(self) -> float:
+        return self._min_off_time
+
+    def _dwell_bounds(
+        self, current: npt.ArrayLike | None, elapsed: npt.ArrayLike | None
+    ) -> tuple[npt.NDArray, npt.NDArray]:
+        """Bounds that hold switches in their current state until their minimum time is up"""
+        lower = np.zeros(self._mpc.num_decisions)
+        upper = np.ones(self._mpc.num_decisions)
+        if current is None or elapsed is None:
+            return lower, upper
+        controls = self._mpc.decision_controls
+        value = np.asarray(current, dtype=float)[controls]
+        on = value > 0.5
+        minimum = np.where(on, self._min_on_time, self._min_off_time)
+        remaining = minimum - np.asarray(elapsed, dtype=float)[controls]
+        held = self._binary & np.isfinite(value) & (self._decision_starts < remaining)
+        lower[held] = upper[held] = on[held]
+        return lower, upper
+
+    def solve(
+        self,
+        states: npt.ArrayLike,
+        setpoints: npt.ArrayLike,
+        room_weights: npt.ArrayLike | None = None,
+        outside_temps: npt.ArrayLike | None = None,
+        energy_weight: float = MPC_ENERGY_WEIGHTS[ControlMode.COMFORT],
+        current: npt.ArrayLike | None = None,
+        elapsed: npt.ArrayLike | None = None,
+        cancel: threading.Event | None = None,
+    ) -> Schedule:
+        """Schedules the controls over the compressed horizon from the current state.
+
+        The arguments are those of UniStatMPC.solve, current (num_controls,) is the current input
+        of each control and elapsed (num_controls,) the seconds since it last changed, unknown
+        inputs are NaN. Setting cancel stops the search early, like the node and time limits.
+        """
+        error, weights, _, hessian, lipschitz, gradient = self._mpc._problem(
+            states, setpoints, room_weights, outside_temps, energy_weight
+        )
+        cache: dict[bytes, tuple[npt.NDArray, float]] = {}
+
+        def relax(lower, upper, initial) -> tuple[npt.NDArray, float]:
+            key = lower.tobytes() + upper.tobytes()
+            if (cached := cache.get(key)) is None:
+                x, _ = solve_box_qp(hessian, gradient, lower, upper, initial, lipschitz)
+                cached = (x, float(0.5 * x @ hessian @ x + gradient @ x))
+                cache[key] = cached
+            return cached
+
+        def complete(lower, upper, x) -> tuple[npt.NDArray, float]:
+            """Rounds the free binary decisions and re-solves the continuous ones"""
+            lower, upper = lower.copy(), upper.copy()
+            values = np.round(np.clip(x, lower, upper))
+            free = self._binary & (lower < upper)
+            lower[free] = upper[free] = values[free]
+            return relax(lower, upper, x)
+
+        lower, upper = self._dwell_bounds(current, elapsed)
+        deadline = time.monotonic() + SCHEDULER_TIME_LIMIT
+        x, bound = relax(lower, upper, self._last_decisions)
+        best, best_cost = complete(lower, upper, x)
+        stack = [(lower, upper, x, bound)]
+        nodes = 0
+        while (
+            stack
+            and nodes < SCHEDULER_MAX_NODES
+            and time.monotonic() < deadline
+            and not (cancel and cancel.is_set())
+        ):
+            lower, upper, x, bound = stack.pop()
+            if bound >= best_cost - SCHEDULER_GAP * abs(best_cost):
+                continue
+            nodes += 1
+            free = self._binary & (lower < upper)
+            fraction = np.where(free, np.minimum(x - lower, upper - x), 0)
+            if not np.any(fraction > SCHEDULER_INTEGRALITY):
+                candidate, cost = complete(lower, upper, x)
+                if cost < best_cost:
+                    best, best_cost = candidate, cost
+                continue
+
+            # Branch on the most fractional decision, the side it leans to is searched first
+            i = int(np.argmax(fraction))
+            preferred = float(np.round(x[i]))
+            for value in (1 - preferred, preferred):
+                child_lower, child_upper = lower.copy(), upper.copy()
+                child_lower[i] = child_upper[i] = value
+                child, child_bound = relax(child_lower, child_upper, x)
+                if child_bound < best_cost - SCHEDULER_GAP * abs(best_cost):
+                    stack.append((child_lower, child_upper, child, child_bound))
+
+        # A cancelled search is discarded, it doesn't warm start the next one
+        if not (cancel and cancel.is_set()):
+            self._last_decisions = best
+        controls = self._mpc.expand(best)
+        cost = best_cost + float(np.sum(weights * error**2))
+        _LOGGER.debug(
+            "Scheduled in %s nodes with cost %s, %s relaxations",
+            nodes,
+            cost,
+            len(cache),
+        )
+        return Schedule(
+            steps=self._mpc.predictions.steps,
+            controls=controls,
+            room_temps=self._mpc.predictions.predict(
+                np.asarray(states, dtype=float), controls, outside_temps
+            ),
+            cost=cost,
+            nodes=nodes,
+            optimal=not stack,
+        )
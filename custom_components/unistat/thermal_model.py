@@ -2,21 +2,223 @@ import numpy as np
 import numpy.typing as npt
 import logging
 
-from typing import Any
+from dataclasses import dataclass
+from typing import Any, Final
 from functools import cached_property
+from collections import OrderedDict
 
+from scipy import sparse
+from scipy.linalg import expm
+from scipy.sparse.linalg import expm as sparse_expm
 
-from .model_params import UniStatModelParams
+from homeassistant.components.climate import HVACMode
+from homeassistant.const import CONF_NAME
+
+from .const import (
+    CONF_AREAS,
+    CONF_CONTROLS,
+    CONF_APPLIANCE_TYPE,
+    CONF_COOLING_POWER,
+    CONF_HEATING_POWER,
+    CONF_CENTRAL_APPLIANCE,
+    CONF_CONTROL_APPLIANCES,
+    CentralApplianceType,
+    ControlApplianceType,
+)
+from .model_params import UniStatModelParams, _flatten
 
 _LOGGER = logging.getLogger(__name__)
 
+DEFAULT_TIME_STEP: Final = 300.0  # seconds, matches the control interval
+DISCRETIZATION_CACHE_SIZE: Final = 64
+SPARSE_ROOM_THRESHOLD: Final = 40  # Use sparse matrices from this many rooms up
+SPARSE_DROP_TOLERANCE: Final = 1e-12
+
+
+def _propagate(ad: npt.NDArray, forcing: npt.NDArray) -> npt.NDArray:
+    """Computes y[k] = sum_{j<=k} ad^(k-j) @ forcing[j] for all k at once.
+
+    This is a Hillis-Steele prefix scan, it takes ceil(log2(num_steps)) batched matrix products
+    rather than one small product per time step. Leading dimensions of ad and forcing broadcast,
+    forcing is (..., num_steps, n) and ad is (..., n, n).
+    """
+    y = np.array(forcing, dtype=float)
+    num_steps = y.shape[-2]
+    power = np.array(ad, dtype=float)
+    shift = 1
+    while shift < num_steps:
+        y[..., shift:, :] += y[..., :-shift, :] @ np.swapaxes(power, -1, -2)
+        shift *= 2
+        if shift < num_steps:
+            power = power @ power
+    return y
+
+
+def _simulate_discrete(
+    ad: npt.NDArray,
+    bd: npt.NDArray,
+    x0: npt.NDArray,
+    u: npt.NDArray,
+    outside_temps: npt.NDArray | None = None,
+) -> npt.NDArray:
+    """Simulates x[k+1] = ad @ x[k] + bd @ u[k], returning the trajectory including x0.
+
+    Leading (batch) dimensions of ad (..., n, n), bd (..., n, m), x0 (..., n),
+    u (..., num_steps, m) and outside_temps (..., num_steps) broadcast against each other.
+    """
+    num_steps = u.shape[-2]
+    batch = np.broadcast_shapes(
+        ad.shape[:-2],
+        bd.shape[:-2],
+        x0.shape[:-1],
+        u.shape[:-2],
+        () if outside_temps is None else outside_temps.shape[:-1],
+    )
+    n = ad.shape[-1]
+
+    forcing = np.zeros((*batch, num_steps, n))
+    forcing += np.einsum("...tm,...nm->...tn", u, bd)
+    x0 = np.broadcast_to(x0, (*batch, n)).copy()
+    if outside_temps is not None:
+        # Treat the outside column of Ad as an input so the outside state can be driven
+        forcing += outside_temps[..., np.newaxis] * ad[..., np.newaxis, :, 0]
+        ad = ad.copy()
+        ad[..., :, 0] = 0
+        x0[..., 0] = outside_temps[..., 0]
+
+    if num_steps > 0:
+        forcing[..., 0, :] += np.einsum("...ij,...j->...i", ad, x0)
+    trajectory = np.empty((*batch, num_steps + 1, n))
+    trajectory[..., 0, :] = x0
+    trajectory[..., 1:, :] = _propagate(ad, forcing)
+    if outside_temps is not None and num_steps > 0:
+        trajectory[..., 1:-1, 0] = outside_temps[..., 1:]
+        trajectory[..., -1, 0] = outside_temps[..., -1]
+    return trajectory
+
+
+def _simulate_sparse(
+    ad: sparse.csr_array,
+    bd: sparse.csr_array,
+    x0: npt.NDArray,
+    u: npt.NDArray,
+    outside_temps: npt.NDArray | None = None,
+) -> npt.NDArray:
+    """Sparse counterpart of _simulate_discrete for one set of matrices.
+
+    Input forcing is computed for all steps in one product, each step then costs one sparse
+    matrix product, which scales with the number of walls rather than rooms squared. Leading
+    (batch) dimensions of x0, u and outside_temps broadcast and are stepped together.
+    """
+    num_steps, num_controls = u.shape[-2:]
+    n = x0.shape[-1]
+    batch = np.broadcast_shapes(
+        x0.shape[:-1],
+        u.shape[:-2],
+        () if outside_temps is None else outside_temps.shape[:-1],
+    )
+    u = np.broadcast_to(u, (*batch, num_steps, num_controls)).reshape(-1, num_controls)
+    forcing = (bd @ u.T).T.reshape(-1, num_steps, n)
+    x0 = np.broadcast_to(x0, (*batch, n)).reshape(-1, n).copy()
+    if outside_temps is not None:
+        # Treat the outside column of Ad as an input so the outside state can be driven
+        t_out = np.broadcast_to(outside_temps, (*batch, num_steps)).reshape(
+            -1, num_steps
+        )
+        forcing += t_out[..., np.newaxis] * ad[:, [0]].toarray()[:, 0]
+        keep = np.ones(ad.shape[1])
+        keep[0] = 0
+        ad = ad @ sparse.diags_array(keep)
+        x0[:, 0] = t_out[:, 0]
+
+    trajectory = np.empty((x0.shape[0], num_steps + 1, n))
+    trajectory[:, 0] = x0
+    for k in range(num_steps):
+        trajectory[:, k + 1] = (ad @ trajectory[:, k].T).T + forcing[:, k]
+    if outside_temps is not None and num_steps > 0:
+        trajectory[:, 1:-1, 0] = t_out[:, 1:]
+        trajectory[:, -1, 0] = t_out[:, -1]
+    return trajectory.reshape(*batch, num_steps + 1, n)
+
+
+def _propagate_sparse(ad: sparse.csr_array, forcing: npt.NDArray) -> npt.NDArray:
+    """Sparse counterpart of _propagate, one sparse matrix product per time step"""
+    shape = forcing.shape
+    forcing = forcing.reshape(-1, *shape[-2:])
+    y = np.empty(forcing.shape)
+    y[:, 0] = forcing[:, 0]
+    for k in range(1, shape[-2]):
+        y[:, k] = (ad @ y[:, k - 1].T).T + forcing[:, k]
+    return y.reshape(shape)
+
+
+def _matrix_powers(a: npt.NDArray, count: int) -> npt.NDArray:
+    """Returns a^0 ... a^(count - 1) stacked (count, n, n).
+
+    The block of powers found so far is multiplied by the next repeated square, so this takes
+    ceil(log2(count)) batched products instead of count sequential ones.
+    """
+    powers = np.empty((max(count, 1), *a.shape))
+    powers[0] = np.eye(a.shape[0])
+    square = a
+    filled = 1
+    while filled < count:
+        step = min(filled, count - filled)
+        powers[filled : filled + step] = powers[:step] @ square
+        filled += step
+        if filled < count:
+            square = square @ square
+    return powers[:count]
+
+
+@dataclass(frozen=True)
+class UniStatPredictionMatrices:
+    """Condensed room temperature predictions over a horizon of steps.
+
+    The room temperatures at the end of each step, Y (horizon * num_rooms,), are
+    Y = free @ x0 + controls @ U + outside @ outside_temps, where U (horizon * num_controls,) is
+    the stacked inputs and the outside temperature column of Ad is treated as an input like in
+    simulate(), so the outside state of x0 is ignored. All arrays are C contiguous and read-only.
+    """
+
+    steps: npt.NDArray  # (horizon,) step lengths in seconds
+    horizon: int
+    free: npt.NDArray  # (horizon * num_rooms, num_states)
+    controls: npt.NDArray  # (horizon * num_rooms, horizon * num_controls)
+    outside: npt.NDArray  # (horizon * num_rooms, horizon)
+
+    def predict(
+        self,
+        states: npt.NDArray,
+        controls: npt.NDArray | None = None,
+        outside_temps: npt.NDArray | None = None,
+    ) -> npt.NDArray:
+        """Predicted room temperatures (..., horizon, num_rooms).
+
+        states (..., num_states), controls (..., horizon, num_controls) and outside_temps
+        (..., horizon) may carry leading batch dimensions. Controls default to all off and the
+        outside temperature to its value in states.
+        """
+        x0 = np.array(states, dtype=float)
+        if outside_temps is None:
+            outside_temps = np.repeat(x0[..., :1], self.horizon, axis=-1)
+        x0[..., 0] = 0
+        y = x0 @ self.free.T + np.asarray(outside_temps) @ self.outside.T
+        if controls is not None:
+            controls = np.asarray(controls, dtype=float)
+            y = y + controls.reshape(*controls.shape[:-2], -1) @ self.controls.T
+        return y.reshape(*y.shape[:-1], self.horizon, -1)
+
 
 class UniStatSystemModel:
     def __init__(
         self,
         config_data,
         model_params: UniStatModelParams | dict[str, Any] | None = None,
+        use_sparse: bool | None = None,
     ):
+        """use_sparse selects sparse matrix assembly and simulation, by default it is used for
+        houses with at least SPARSE_ROOM_THRESHOLD rooms."""
         # If no model params are provided initialize the model based on the config
         self._model_params = model_params
         if not self._model_params:
@@ -41,63 +243,624 @@ class UniStatSystemModel:
             self._model_params = UniStatModelParams.from_conf(config_data)
 
         # self._ss_model = control.ss(self.A, self.B, self.C, self.D)
+        self._discretization_cache: OrderedDict[
+            tuple[bytes, float, bool], tuple[Any, Any]
+        ] = OrderedDict()
+        self._prediction_cache: dict[bytes, UniStatPredictionMatrices] = {}
+        if use_sparse is None:
+            use_sparse = self._model_params.num_rooms >= SPARSE_ROOM_THRESHOLD
+        self._use_sparse = use_sparse
 
-    def simulate(self, states, controls) -> tuple[npt.NDArray, npt.NDArray]:
-        raise NotImplementedError
+    def simulate(
+        self,
+        states: npt.ArrayLike,
+        controls: npt.ArrayLike,
+        dt: float = DEFAULT_TIME_STEP,
+        outside_temps: npt.ArrayLike | None = None,
+        model_params: UniStatModelParams | None = None,
+    ) -> tuple[npt.NDArray, npt.NDArray]:
+        """Simulates the model forward from an initial state.
+
+        states is the initial state vector (num_states,) and controls is a (num_steps, num_controls)
+        array of inputs that are held constant over each time step of length dt seconds. If
+        outside_temps (num_steps,) is provided it overrides the outside temperature at each step,
+        otherwise the outside temperature is held at its initial value. model_params overrides the
+        model's own parameters, it must share the model's config.
+
+        Returns the state trajectory (num_steps + 1, num_states), including the initial state, and
+        the corresponding outputs (num_steps + 1, num_rooms).
+        """
+        x0 = np.asarray(states, dtype=float)
+        u = np.asarray(controls, dtype=float).reshape(-1, self.num_controls)
+        if x0.shape != (self.num_states,):
+            raise ValueError(
+                f"states must have shape ({self.num_states},), got {x0.shape}."
+            )
+        t_out = self._check_outside_temps(outside_temps, u.shape[0])
+
+        if self.use_sparse:
+            ad, bd = self.discretize_sparse(dt, model_params)
+            trajectory = _simulate_sparse(ad, bd, x0, u, t_out)
+        else:
+            ad, bd = self.discretize(dt, model_params)
+            trajectory = _simulate_discrete(ad, bd, x0, u, t_out)
+
+        return trajectory, trajectory @ self.C.T
+
+    def simulate_ensemble(
+        self,
+        parameters: npt.ArrayLike,
+        states: npt.ArrayLike,
+        controls: npt.ArrayLike,
+        dt: float = DEFAULT_TIME_STEP,
+        outside_temps: npt.ArrayLike | None = None,
+    ) -> tuple[npt.NDArray, npt.NDArray]:
+        """Simulates N parameter vectors at once.
+
+        parameters is a (N, num_params) array ordered like UniStatModelParams.to_vector(). states
+        may be shared (num_states,) or per member (N, num_states), likewise controls may be
+        (num_steps, num_controls) or (N, num_steps, num_controls). outside_temps is shared.
+        Several trajectories per member, such as data segments, are simulated by giving states
+        (1 or N, ..., num_states), controls (1 or N, ..., num_steps, num_controls) and
+        outside_temps (1 or N, ..., num_steps) the trajectory dimensions after the member one.
+
+        Sparse models discretize and simulate each member with sparse matrices in turn.
+
+        Returns trajectories (N, num_steps + 1, num_states) and outputs (N, num_steps + 1, num_rooms).
+        """
+        vectors = np.atleast_2d(np.asarray(parameters, dtype=float))
+        if vectors.ndim != 2 or vectors.shape[1] != self.model_params.num_params:
+            raise ValueError("parameters must have shape (N, num_params).")
+        x0 = np.asarray(states, dtype=float)
+        u = np.asarray(controls, dtype=float)
+        if x0.shape[-1] != self.num_states or u.shape[-1] != self.num_controls:
+            raise ValueError("states or controls have the wrong shape.")
+        t_out = self._check_outside_temps(outside_temps, u.shape[-2])
+
+        if self.use_sparse:
+
+            def member(values: npt.NDArray | None, ndim: int, i: int):
+                if values is None or values.ndim == ndim:
+                    return values
+                return values[i if values.shape[0] > 1 else 0]
+
+            trajectory = np.stack(
+                [
+                    _simulate_sparse(
+                        *self.discretize_sparse(
+                            dt, self.model_params.from_vector(vector)
+                        ),
+                        member(x0, 1, i),
+                        member(u, 2, i),
+                        member(t_out, 1, i),
+                    )
+                    for i, vector in enumerate(vectors)
+                ]
+            )
+            return trajectory, trajectory @ self.C.T
+
+        ad, bd = self._discretize_batch(vectors, dt)
+        extra = max(x0.ndim - 1, u.ndim - 2, 0 if t_out is None else t_out.ndim - 1) - 1
+        if extra > 0:
+            # Each member's matrices are shared by its trajectories
+            ad = ad.reshape(ad.shape[:1] + (1,) * extra + ad.shape[1:])
+            bd = bd.reshape(bd.shape[:1] + (1,) * extra + bd.shape[1:])
+        trajectory = _simulate_discrete(ad, bd, x0, u, t_out)
+
+        return trajectory, trajectory @ self.C.T
+
+    def simulate_jacobian(
+        self,
+        states: npt.ArrayLike,
+        controls: npt.ArrayLike,
+        dt: float = DEFAULT_TIME_STEP,
+        outside_temps: npt.ArrayLike | None = None,
+        model_params: UniStatModelParams | None = None,
+    ) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray]:
+        """Simulates the model along with the sensitivity of the trajectory to the parameters.
+
+        Arguments match simulate(), except that states (..., num_states), controls
+        (..., num_steps, num_controls) and outside_temps (..., num_steps) may carry leading batch
+        dimensions to simulate several trajectories, such as data segments, at once. The discrete
+        sensitivity equations
+        S[k+1] = Ad @ S[k] + dAd/dp @ x[k] + dBd/dp @ u[k] are solved with closed form derivatives
+        of A and B and the Frechet derivative of the matrix exponential, so the cost is roughly that
+        of two simulations regardless of the number of parameters.
+
+        Sparse models simulate and propagate the sensitivities with the sparse Ad, the derivatives
+        of Ad and Bd themselves are dense.
+
+        Returns the trajectory (..., num_steps + 1, num_states), outputs
+        (..., num_steps + 1, num_rooms) and d(trajectory)/d(parameters)
+        (..., num_steps + 1, num_states, num_params) with parameters ordered like to_vector().
+        Parameters that do not enter the model have zero columns.
+        """
+        params = model_params or self.model_params
+        x0 = np.asarray(states, dtype=float)
+        u = np.asarray(controls, dtype=float)
+        if x0.shape[-1:] != (self.num_states,):
+            raise ValueError(
+                f"states must have shape (..., {self.num_states}), got {x0.shape}."
+            )
+        if u.ndim < 2 or u.shape[-1] != self.num_controls:
+            raise ValueError("controls must have shape (..., num_steps, num_controls).")
+        t_out = self._check_outside_temps(outside_temps, u.shape[-2])
+
+        if self.use_sparse:
+            ad, bd = self.discretize_sparse(dt, params)
+            trajectory = _simulate_sparse(ad, bd, x0, u, t_out)
+            propagate = _propagate_sparse
+        else:
+            ad, bd = self.discretize(dt, params)
+            trajectory = _simulate_discrete(ad, bd, x0, u, t_out)
+            propagate = _propagate
+
+        d_ad, d_bd = self._discretize_jacobian(params.vector, dt)
+        forcing = np.einsum("pij,...tj->...pti", d_ad, trajectory[..., :-1, :])
+        forcing = forcing + np.einsum("pij,...tj->...pti", d_bd, u)
+        # The outside state never depends on the parameters so Ad can propagate it unmodified
+        jacobian = np.zeros((*trajectory.shape, params.num_params))
+        jacobian[..., 1:, :, :] = np.moveaxis(propagate(ad, forcing), -3, -1)
+
+        return trajectory, trajectory @ self.C.T, jacobian
+
+    @staticmethod
+    def _check_outside_temps(
+        outside_temps: npt.ArrayLike | None, num_steps: int
+    ) -> npt.NDArray | None:
+        if outside_temps is None:
+            return None
+        t_out = np.asarray(outside_temps, dtype=float)
+        if t_out.shape[-1:] != (num_steps,):
+            raise ValueError("outside_temps must have one value per time step.")
+        return t_out
+
+    def discretize(
+        self, dt: float, model_params: UniStatModelParams | None = None
+    ) -> tuple[npt.NDArray, npt.NDArray]:
+        """Zero-order hold discretization of the continuous model, returns read-only (Ad, Bd)
+
+        Results are kept in a bounded LRU cache keyed by the parameter vector and dt, so revisited
+        parameters skip the matrix exponential. model_params must share the model's config.
+        """
+        params = model_params or self.model_params
+        vector = params.vector
+
+        def compute():
+            ad, bd = self._discretize_batch(vector[np.newaxis], dt)
+            ad, bd = ad[0], bd[0]
+            ad.setflags(write=False)
+            bd.setflags(write=False)
+            return ad, bd
+
+        return self._cached((vector.tobytes(), float(dt), False), compute)
+
+    def discretize_sparse(
+        self, dt: float, model_params: UniStatModelParams | None = None
+    ) -> tuple[sparse.csr_array, sparse.csr_array]:
+        """Sparse zero-order hold discretization, returns CSR (Ad, Bd)
+
+        Entries smaller than SPARSE_DROP_TOLERANCE are dropped, heat only spreads a few walls per
+        time step so Ad stays sparse. Results share the discretize cache and must not be modified.
+        """
+        params = model_params or self.model_params
+        vector = params.vector
+
+        def compute():
+            a, b = self._assemble_sparse(vector)
+            n = self.num_states
+            m = sparse.vstack(
+                [
+                    sparse.hstack([a, b]),
+                    sparse.csr_array((self.num_controls, n + self.num_controls)),
+                ],
+                format="csc",
+            )
+            em = sparse.csr_array(sparse_expm(m * dt))
+            em.data[np.abs(em.data) < SPARSE_DROP_TOLERANCE] = 0
+            em.eliminate_zeros()
+            return em[:n, :n], em[:n, n:]
+
+        return self._cached((vector.tobytes(), float(dt), True), compute)
+
+    def _cached(self, key: tuple[bytes, float, bool], compute) -> tuple[Any, Any]:
+        """Bounded LRU lookup in the discretization cache"""
+        if (cached := self._discretization_cache.get(key)) is not None:
+            self._discretization_cache.move_to_end(key)
+            return cached
+
+        value = compute()
+        self._discretization_cache[key] = value
+        if len(self._discretization_cache) > DISCRETIZATION_CACHE_SIZE:
+            self._discretization_cache.popitem(last=False)
+        return value
+
+    def _discretize_batch(
+        self, vectors: npt.NDArray, dt: float
+    ) -> tuple[npt.NDArray, npt.NDArray]:
+        """Discretizes a stack of parameter vectors with a single batched matrix exponential"""
+        a, b = self._assemble(vectors)
+        n = self.num_states
+        m = np.zeros((vectors.shape[0], n + self.num_controls, n + self.num_controls))
+        m[:, :n, :n] = a
+        m[:, :n, n:] = b
+        em = expm(m * dt)
+        return em[:, :n, :n], em[:, :n, n:]
+
+    def _discretize_jacobian(
+        self, vector: npt.NDArray, dt: float
+    ) -> tuple[npt.NDArray, npt.NDArray]:
+        """Derivatives of (Ad, Bd) w.r.t. each parameter, (num_params, n, n) and (num_params, n, m)
+
+        The Frechet derivative of expm(M) in direction E is the upper right block of
+        expm([[M, E], [0, M]]), all parameters are handled by one batched exponential.
+        """
+        a, b = self._assemble(vector[np.newaxis])
+        d_a, d_b = self._assemble_jacobian(vector)
+        n = self.num_states
+        k = n + self.num_controls
+        num_params = vector.shape[0]
+
+        active = np.flatnonzero(np.any(d_a, axis=(1, 2)) | np.any(d_b, axis=(1, 2)))
+        blocks = np.zeros((active.size, 2 * k, 2 * k))
+        blocks[:, :n, :n] = a[0]
+        blocks[:, :n, n:k] = b[0]
+        blocks[:, k:, k:] = blocks[:, :k, :k]
+        blocks[:, :n, k : k + n] = d_a[active]
+        blocks[:, :n, k + n :] = d_b[active]
+        frechet = expm(blocks * dt)[:, :k, k:]
+
+        d_ad = np.zeros((num_params, n, n))
+        d_bd = np.zeros((num_params, n, self.num_controls))
+        d_ad[active] = frechet[:, :n, :n]
+        d_bd[active] = frechet[:, :n, n:]
+        return d_ad, d_bd
+
+    def _assemble_jacobian(
+        self, vector: npt.NDArray
+    ) -> tuple[npt.NDArray, npt.NDArray]:
+        """Closed form derivatives of A and B w.r.t. each parameter in to_vector() order"""
+        slices = self.model_params._field_slices
+        fields = {tf: vector[s] for tf, s in slices.items()}
+        a, b = self._assemble(vector[np.newaxis])
+        a, b = a[0], b[0]
+        masses = fields["room_thermal_masses"]
+        n = self.num_states
+
+        d_a = np.zeros((vector.shape[0], n, n))
+        d_b = np.zeros((vector.shape[0], n, self.num_controls))
+
+        # Each wall resistance adds flow between its two nodes, the outside row stays zero
+        first, second = self.model_params.wall_edges.T
+        scale = np.zeros(n)
+        scale[1 : self.model_params.num_rooms + 1] = 1 / masses
+        walls = np.arange(
+            slices["thermal_resistances"].start, slices["thermal_resistances"].stop
+        )
+        d_a[walls, first, second] = scale[first]
+        d_a[walls, second, first] = scale[second]
+        d_a[walls, first, first] = -scale[first]
+        d_a[walls, second, second] = -scale[second]
+
+        # Each room row of A and B is divided by that room's thermal mass
+        for r, p in enumerate(
+            range(
+                slices["room_thermal_masses"].start, slices["room_thermal_masses"].stop
+            )
+        ):
+            d_a[p, r + 1] = -a[r + 1] / masses[r]
+            d_b[p, r + 1] = -b[r + 1] / masses[r]
+
+        if self.model_params.estimate_internal_loads:
+            loads = slices["internal_loads"]
+            rooms = np.arange(1, self.model_params.num_rooms + 1)
+            d_a[np.arange(loads.start, loads.stop), rooms, -1] = 1 / masses
+
+        # Boiler output is split between radiators in proportion to their constants
+        radiators = slices["radiator_constants"].start
+        for k, c in enumerate(self._control_layout):
+            if c["radiators"] is None:
+                continue
+            weights = fields["radiator_constants"][c["radiators"]]
+            total = np.sum(weights)
+            for i, f in enumerate(c["radiators"]):
+                d_share = -c["power"] * weights / total**2
+                d_share[i] += c["power"] / total
+                d_b[radiators + f, c["rooms"], k] += d_share * scale[c["rooms"]]
+
+        return d_a, d_b
+
+    def prediction_matrices(
+        self, horizon: int, dt: float | npt.ArrayLike = DEFAULT_TIME_STEP
+    ) -> UniStatPredictionMatrices:
+        """Stacked prediction matrices over horizon steps, built once per model.
+
+        dt is either a single step length in seconds or one per step, for a horizon that gets
+        coarser further out. On a uniform grid the powers of Ad come from repeated squaring and the
+        control matrix is the block Toeplitz arrangement of the impulse responses C @ Ad^k @ Bd,
+        which are only computed once. A non-uniform grid propagates the responses step by step,
+        each distinct step length is discretized once through the discretization cache.
+        """
+        steps = np.broadcast_to(np.asarray(dt, dtype=float), (horizon,))
+        key = steps.tobytes()
+        if (cached := self._prediction_cache.get(key)) is not None:
+            return cached
+
+        rooms = slice(1, self.model_params.num_rooms + 1)
+        num_rooms = self.model_params.num_rooms
+        if horizon > 0 and np.all(steps == steps[0]):
+            ad_in, inputs = self._prediction_step(steps[0])
+            powers = _matrix_powers(ad_in, horizon + 1)[:, rooms]
+            responses = powers[:-1] @ inputs  # (horizon, num_rooms, num_controls + 1)
+
+            # Block (k, j) holds the response after k - j steps, blocks above the diagonal are zero
+            lag = np.arange(horizon)[:, np.newaxis] - np.arange(horizon)
+            blocks = responses[np.maximum(lag, 0)]
+            blocks *= (lag >= 0)[..., np.newaxis, np.newaxis]
+            blocks = blocks.transpose(0, 2, 1, 3)  # (k, room, j, input)
+            free = powers[1:]
+        else:
+            n = self.num_states
+            blocks = np.zeros((horizon, num_rooms, horizon, self.num_controls + 1))
+            free = np.zeros((horizon, num_rooms, n))
+            response = np.zeros((n, horizon, self.num_controls + 1))
+            transition = np.eye(n)
+            for k, step in enumerate(steps):
+                ad_in, inputs = self._prediction_step(step)
+                response[:, :k] = np.einsum("ij,jkm->ikm", ad_in, response[:, :k])
+                response[:, k] = inputs
+                transition = ad_in @ transition
+                blocks[k] = response[rooms]
+                free[k] = transition[rooms]
+
+        def frozen(a, shape):
+            a = np.ascontiguousarray(a).reshape(shape)
+            a.setflags(write=False)
+            return a
+
+        steps = steps.copy()
+        steps.setflags(write=False)
+        matrices = UniStatPredictionMatrices(
+            steps=steps,
+            horizon=horizon,
+            free=frozen(free, (horizon * num_rooms, self.num_states)),
+            controls=frozen(
+                blocks[..., :-1], (horizon * num_rooms, horizon * self.num_controls)
+            ),
+            outside=frozen(blocks[..., -1], (horizon * num_rooms, horizon)),
+        )
+        self._prediction_cache[key] = matrices
+        return matrices
+
+    def _prediction_step(self, dt: float) -> tuple[npt.NDArray, npt.NDArray]:
+        """Ad with the outside column moved into the inputs, returns (Ad, [Bd, outside column])"""
+        ad, bd = self.discretize(dt)
+        ad_in = np.array(ad)
+        ad_in[:, 0] = 0
+        return ad_in, np.concatenate([bd, ad[:, [0]]], axis=1)
+
+    def initial_state(
+        self, outside_temp: float, room_temps: npt.ArrayLike
+    ) -> npt.NDArray:
+        """Builds a state vector from the outside and room temperatures"""
+        state = np.ones(self.num_states)
+        state[0] = outside_temp
+        state[1 : self.model_params.num_rooms + 1] = room_temps
+        return state
 
     @property
     def model_params(self):
         return self._model_params
 
+    @property
+    def use_sparse(self) -> bool:
+        return self._use_sparse
+
+    @property
+    def num_states(self) -> int:
+        """Outside temperature, room temperatures, plus a constant state for internal loads"""
+        return (
+            self.model_params.num_rooms
+            + 1
+            + int(self.model_params.estimate_internal_loads)
+        )
+
+    @property
+    def num_controls(self) -> int:
+        return len(self.control_outputs)
+
+    @cached_property
+    def control_outputs(self) -> tuple[tuple[str, HVACMode], ...]:
+        """Model inputs as (control entity_id, mode) pairs, in the column order of B"""
+        return tuple((c[CONF_CONTROLS], c["mode"]) for c in self._control_layout)
+
+    def _radiator_index(self) -> dict[str, dict[str, int]]:
+        """Index into the flattened radiator_constants of each room's radiator, by boiler name"""
+        params = self.model_params
+        boilers = [
+            ca[CONF_NAME]
+            for ca in params.central_appliances
+            if ca[CONF_APPLIANCE_TYPE] == CentralApplianceType.HydroBoiler
+        ]
+        rooms, constants = params.radiator_rooms, params.radiator_constants
+        if rooms and isinstance(rooms[0], str):
+            # A single boiler may be given unnested
+            rooms, constants = [rooms], [constants]
+        index, first = {}, 0
+        for name, boiler_rooms, boiler_constants in zip(
+            boilers, rooms, constants, strict=False
+        ):
+            count = len(_flatten(boiler_constants))
+            index[name] = {
+                r: first + i
+                for i, r in enumerate(dict.fromkeys(_flatten(boiler_rooms)))
+                if i < count
+            }
+            first += count
+        return index
+
+    @cached_property
+    def _control_layout(self) -> list[dict[str, Any]]:
+        """Resolves each configured control into its appliance type, the rooms it heats or cools
+        and its power in kW"""
+        conf = self.model_params.conf_data
+        room_idx = {r: i + 1 for i, r in enumerate(conf[CONF_AREAS])}
+        centrals = {ca[CONF_NAME]: ca for ca in self.model_params.central_appliances}
+        radiators = self._radiator_index()
+
+        layout = []
+        for control, app in zip(conf[CONF_CONTROLS], conf[CONF_CONTROL_APPLIANCES]):
+            if CONF_CENTRAL_APPLIANCE in app:
+                source = centrals.get(app[CONF_CENTRAL_APPLIANCE], {})
+            else:
+                source = dict(app)
+                UniStatModelParams._standardize_power(source)
+
+            room_names = _flatten(app[CONF_AREAS])
+            rooms = [room_idx[r] for r in room_names]
+            # Boiler output is shared between the zone's radiators
+            is_boiler = app[CONF_APPLIANCE_TYPE] == ControlApplianceType.BoilerZoneCall
+            boiler_radiators = radiators.get(app.get(CONF_CENTRAL_APPLIANCE), {})
+            has_radiators = all(r in boiler_radiators for r in room_names)
+            modes = (
+                (HVACMode.HEAT, CONF_HEATING_POWER, 1),
+                (HVACMode.COOL, CONF_COOLING_POWER, -1),
+            )
+            for mode, key, sign in modes:
+                if key not in source:
+                    continue
+                layout.append(
+                    {
+                        CONF_CONTROLS: control,
+                        CONF_APPLIANCE_TYPE: app[CONF_APPLIANCE_TYPE],
+                        "mode": mode,
+                        "power": sign * source[key] / 1000,
+                        "rooms": rooms,
+                        "radiators": [boiler_radiators[r] for r in room_names]
+                        if is_boiler and has_radiators
+                        else None,
+                    }
+                )
+            if not any(key in source for _, key, _ in modes):
+                _LOGGER.error("No heating or cooling power found for %s", control)
+        return layout
+
     @cached_property
     def A(self):
         """Generates the A matrix based on system parameters"""
+        return self._assemble(self.model_params.vector[np.newaxis])[0][0]
 
-        # Only regenerate matrix if needed
-        resistance_matrix = np.zeros_like(self.model_params.adjacency_matrix)
-        resistance_matrix[self.model_params.adjacency_matrix] = (
-            self.model_params.thermal_resistances
-        )
-        resistance_matrix = resistance_matrix + np.flip(resistance_matrix)
+    @cached_property
+    def B(self):
+        """Generates the B matrix based on system parameters."""
+        return self._assemble(self.model_params.vector[np.newaxis])[1][0]
+
+    def _assemble(self, vectors: npt.NDArray) -> tuple[npt.NDArray, npt.NDArray]:
+        """Builds stacked A (N, n, n) and B (N, n, m) from (N, num_params) parameter vectors"""
+        fields = {
+            tf: vectors[:, s] for tf, s in self.model_params._field_slices.items()
+        }
+        num = vectors.shape[0]
+        first, second = self.model_params.wall_edges.T
+        size = self.model_params.num_rooms + 1
+        rooms = slice(1, size)
+
+        resistance_matrix = np.zeros((num, size, size))
+        resistance_matrix[:, first, second] = fields["thermal_resistances"]
+        resistance_matrix += np.swapaxes(resistance_matrix, 1, 2)
 
-        # populate eye
-        eye_vals = -np.sum(resistance_matrix, axis=0) * -1
-        eye = np.eye(resistance_matrix.shape[0], dtype=bool)
-        a = resistance_matrix
-        a[eye] = eye_vals
+        # populate eye, heat flows out of each node through all of its connections
+        a = np.zeros((num, self.num_states, self.num_states))
+        a[:, :size, :size] = resistance_matrix
+        diag = np.arange(size)
+        a[:, diag, diag] = -np.sum(resistance_matrix, axis=2)
 
         # First row is the outside, outside thermal mass is effectively infinite so zero the first row
-        a[0, :] = np.zeros_like(a[0, :])
+        a[:, 0, :] = 0
 
         if self.model_params.estimate_internal_loads:
-            # If there's a load in the room then add a final column to include this static load
-            a = np._c[a, self.model_params.internal_loads]
+            # If there's a load in the room then add a final column to include this static load,
+            # driven by a constant state whose row is zero
+            a[:, rooms, -1] = fields["internal_loads"]
 
-        # Divide the other rows by the thermal mass
-        temp = a[1:, :].T / self.model_params.room_thermal_masses
-        a[1:, :] = temp.T
+        b = np.zeros((num, self.num_states, self.num_controls))
+        for k, c in enumerate(self._control_layout):
+            if c["radiators"] is None:
+                weights = np.ones((num, len(c["rooms"])))
+            else:
+                weights = fields["radiator_constants"][:, c["radiators"]]
+            b[:, c["rooms"], k] = (
+                c["power"] * weights / np.sum(weights, axis=1)[:, None]
+            )
+
+        # Divide the room rows by the thermal mass
+        masses = fields["room_thermal_masses"][:, :, np.newaxis]
+        a[:, rooms, :] /= masses
+        b[:, rooms, :] /= masses
 
-        return a
+        return a, b
 
     @cached_property
-    def B(self):
-        """Generates the B matrix based on system parameters."""
+    def A_sparse(self) -> sparse.csr_array:
+        """Sparse (CSR) A matrix, nonzeros scale with the number of walls"""
+        return self._assemble_sparse(self.model_params.vector)[0]
 
-        num_rooms = len(self.model_params.rooms)
-        num_controls = len(self.model_params.heat_outputs) + len(
-            self.model_params.cooling_outputs
-        )
+    @cached_property
+    def B_sparse(self) -> sparse.csr_array:
+        """Sparse (CSR) B matrix"""
+        return self._assemble_sparse(self.model_params.vector)[1]
+
+    def _assemble_sparse(
+        self, vector: npt.NDArray
+    ) -> tuple[sparse.csr_array, sparse.csr_array]:
+        """Builds CSR A and B directly from the upper triangular adjacency indices"""
+        fields = {tf: vector[s] for tf, s in self.model_params._field_slices.items()}
+        n = self.num_states
+        num_rooms = self.model_params.num_rooms
+
+        # Each wall couples its two nodes, nonzeros are ordered like thermal_resistances
+        first, second = self.model_params.wall_edges.T
+        g = fields["thermal_resistances"]
+        rows = np.r_[first, second, first, second]
+        cols = np.r_[second, first, first, second]
+        vals = np.r_[g, g, -g, -g]
+
+        if self.model_params.estimate_internal_loads:
+            rows = np.r_[rows, np.arange(1, num_rooms + 1)]
+            cols = np.r_[cols, np.full(num_rooms, n - 1)]
+            vals = np.r_[vals, fields["internal_loads"]]
+
+        # Outside row stays empty, room rows are divided by the thermal mass
+        scale = np.zeros(n)
+        scale[1 : num_rooms + 1] = 1 / fields["room_thermal_masses"]
+        a = sparse.coo_array((vals * scale[rows], (rows, cols)), shape=(n, n)).tocsr()
+        a.eliminate_zeros()
 
-        b = np.zeros_like((num_rooms + 1, num_controls))
+        b_rows, b_cols, b_vals = [], [], []
+        for k, c in enumerate(self._control_layout):
+            if c["radiators"] is None:
+                weights = np.ones(len(c["rooms"]))
+            else:
+                weights = fields["radiator_constants"][c["radiators"]]
+            b_rows.extend(c["rooms"])
+            b_cols.extend([k] * len(c["rooms"]))
+            b_vals.extend(c["power"] * weights / np.sum(weights))
+        b_rows = np.array(b_rows, dtype=int)
+        b = sparse.coo_array(
+            (np.array(b_vals) * scale[b_rows], (b_rows, b_cols)),
+            shape=(n, self.num_controls),
+        ).tocsr()
 
-        return b
+        return a, b
 
     @cached_property
     def C(self):
-        """Generates the C matrix based on system parameters."""
-        return 1
+        """Generates the C matrix based on system parameters, room temperatures are observed."""
+        c = np.zeros((self.model_params.num_rooms, self.num_states))
+        c[:, 1 : self.model_params.num_rooms + 1] = np.eye(self.model_params.num_rooms)
+        return c
 
     @cached_property
     def D(self):
-        """Generates the D matrix based on system parameters."""
-        return 0
+        """Generates the D matrix based on system parameters, there is no direct feedthrough."""
+        return np.zeros((self.model_params.num_rooms, self.num_controls))
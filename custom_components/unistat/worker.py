@@ -0,0 +1,122 @@
+"""Compute worker for UniStat."""
+
+import asyncio
+import logging
+import threading
+
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Final
+
+_LOGGER = logging.getLogger(__name__)
+
+# Enough for a daily fit to run alongside the control solves, NumPy releases the GIL in the heavy
+# linear algebra
+WORKER_THREADS: Final = 2
+
+
+class ComputeCancelled(Exception):
+    """The job was replaced by a newer job of the same kind, or the worker shut down."""
+
+
+class UniStatWorker:
+    """Runs the CPU heavy model building, fitting and solving off the event loop.
+
+    Jobs are keyed by what they compute and only the latest job of a key matters: a new job drops
+    the previous one if it hasn't started, and asks it to stop if it is running and cancellable.
+    Cancellable targets take a threading.Event keyword argument cancel that they check
+    periodically. The caller of a replaced job gets ComputeCancelled instead of a stale result.
+    A job starts only once the previous job of its key has returned, so targets sharing state
+    never run concurrently.
+    """
+
+    def __init__(self, max_workers: int = WORKER_THREADS):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="unistat_worker"
+        )
+        self._jobs: dict[str, tuple[Future, threading.Event]] = {}
+        # Completes once the latest job of a key and every job before it have returned
+        self._tails: dict[str, Future] = {}
+
+    async def async_run(
+        self,
+        key: str,
+        target: Callable[..., Any],
+        *args: Any,
+        cancellable: bool = False,
+    ) -> Any:
+        """Runs target(*args) in the worker and returns its result, replacing the job of the same
+        key. Raises ComputeCancelled if this job is replaced in turn before it finishes."""
+        self.cancel(key)
+        cancel = threading.Event()
+        call = (
+            partial(target, *args, cancel=cancel)
+            if cancellable
+            else partial(target, *args)
+        )
+        future: Future = Future()
+        finished: Future = Future()
+        self._jobs[key] = (future, cancel)
+        previous = self._tails.get(key)
+        self._tails[key] = finished
+        if previous is None:
+            self._start(future, finished, call)
+        else:
+            # A replaced job that is still running finishes first
+            previous.add_done_callback(lambda _: self._start(future, finished, call))
+        try:
+            result = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if not cancel.is_set():
+                # The caller went away, its job is of no use to anyone
+                cancel.set()
+                raise
+            raise ComputeCancelled(f"{key} was replaced") from None
+        finally:
+            if self._jobs.get(key, (None,))[0] is future:
+                del self._jobs[key]
+        if cancel.is_set():
+            raise ComputeCancelled(f"{key} was replaced")
+        return result
+
+    def _start(self, future: Future, finished: Future, call: Callable[[], Any]) -> None:
+        """Queues a job once the previous job of its key has returned"""
+        if future.cancelled():
+            finished.set_result(None)
+            return
+        try:
+            self._executor.submit(self._run, future, finished, call)
+        except RuntimeError:
+            # The worker shut down while the previous job was running
+            future.cancel()
+            finished.set_result(None)
+
+    @staticmethod
+    def _run(future: Future, finished: Future, call: Callable[[], Any]) -> None:
+        try:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = call()
+            except BaseException as err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+        finally:
+            finished.set_result(None)
+
+    def cancel(self, key: str) -> None:
+        """Cancels the job of a key, if there is one"""
+        if (job := self._jobs.pop(key, None)) is None:
+            return
+        future, cancel = job
+        cancel.set()
+        if future.cancel():
+            _LOGGER.debug("Dropped %s before it started", key)
+
+    def shutdown(self) -> None:
+        """Cancels every job and stops the worker threads once the running jobs return"""
+        for key in list(self._jobs):
+            self.cancel(key)
+        self._executor.shutdown(wait=False, cancel_futures=True)
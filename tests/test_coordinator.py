@@ -0,0 +1,293 @@
+"""Test the UniStat coordinators."""
+
+import asyncio
+from datetime import timedelta
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from pytest_homeassistant_custom_component.common import (
+    MockConfigEntry,
+    async_fire_time_changed,
+)
+
+from homeassistant.components.climate import (
+    ATTR_CURRENT_TEMPERATURE,
+    ATTR_HVAC_MODE,
+    ATTR_TEMPERATURE,
+    DOMAIN as CLIMATE_DOMAIN,
+    SERVICE_SET_HVAC_MODE,
+    SERVICE_SET_TEMPERATURE,
+    HVACMode,
+)
+from homeassistant.const import ATTR_ENTITY_ID, CONF_TEMPERATURE_UNIT
+from homeassistant.core import HomeAssistant, State
+from homeassistant.helpers.event import async_track_state_change_event
+from homeassistant.util import dt as dt_util
+from homeassistant.util.unit_conversion import TemperatureConverter
+
+from custom_components.unistat.coordinator import (
+    CONTROL_RESOLVE_COOLDOWN,
+    SENSOR_WRITE_DELAY,
+)
+from custom_components.unistat.const import (
+    CONF_ROOM_SETTINGS,
+    CONF_TEMP_ENTITY,
+    CONF_WEATHER_ENTITY,
+    DOMAIN,
+)
+from custom_components.unistat.history import room_signal
+from custom_components.unistat.learning import OnlineParamEstimator
+from custom_components.unistat.model_params import STORE_ESTIMATOR
+
+from .test_init import mydata  # noqa: F401
+
+
+async def test_control_updates_estimator(hass: HomeAssistant, mydata) -> None:  # noqa: F811
+    """Test that each control tick updates and checkpoints the online estimator."""
+    config_entry = MockConfigEntry(data=mydata, domain=DOMAIN, options={})
+    config_entry.add_to_hass(hass)
+    assert await hass.config_entries.async_setup(config_entry.entry_id)
+    await hass.async_block_till_done()
+
+    hass.states.async_set(mydata[CONF_WEATHER_ENTITY], "sunny", {"temperature": 5})
+    for room in mydata[CONF_ROOM_SETTINGS].values():
+        hass.states.async_set(room[CONF_TEMP_ENTITY], "20")
+    hass.states.async_set("switch.spaceheater1", "on")
+    hass.states.async_set("switch.spaceheater2", "off")
+    await hass.async_block_till_done()
+
+    coordinator = config_entry.runtime_data.coordinator_control
+    initial = coordinator.estimator.model_params.to_vector()
+    data = await coordinator._async_update_data()
+    assert "model_error" not in data
+
+    later = dt_util.utcnow() + timedelta(minutes=5)
+    with patch("homeassistant.util.dt.utcnow", return_value=later):
+        data = await coordinator._async_update_data()
+    assert data["model_error"] > 0
+    assert not np.array_equal(coordinator.estimator.model_params.to_vector(), initial)
+
+    checkpoint = config_entry.runtime_data.parameter_store._data["data_func"]()
+    assert checkpoint[STORE_ESTIMATOR] == coordinator.estimator.as_dict()
+
+    await hass.async_block_till_done(wait_background_tasks=True)
+    assert await hass.config_entries.async_unload(config_entry.entry_id)
+    await hass.async_block_till_done()
+
+
+async def test_control_reload_during_adopt(hass: HomeAssistant, mydata) -> None:  # noqa: F811
+    """Test that reloading the fitted model doesn't cancel adopting the online estimate."""
+    config_entry = MockConfigEntry(data=mydata, domain=DOMAIN, options={})
+    config_entry.add_to_hass(hass)
+    assert await hass.config_entries.async_setup(config_entry.entry_id)
+    await hass.async_block_till_done()
+
+    hass.states.async_set(mydata[CONF_WEATHER_ENTITY], "sunny", {"temperature": 5})
+    for room in mydata[CONF_ROOM_SETTINGS].values():
+        hass.states.async_set(room[CONF_TEMP_ENTITY], "20")
+    hass.states.async_set("switch.spaceheater1", "on")
+    hass.states.async_set("switch.spaceheater2", "off")
+    await hass.async_block_till_done()
+    coordinator = config_entry.runtime_data.coordinator_control
+    fitted = coordinator.model_params
+    await coordinator._async_update_data()
+
+    # An estimate far from the control model is adopted on the next tick
+    coordinator._estimator = OnlineParamEstimator(
+        fitted.from_vector(fitted.clip(fitted.to_vector() * 1.5))
+    )
+    later = dt_util.utcnow() + timedelta(minutes=5)
+    with patch("homeassistant.util.dt.utcnow", return_value=later):
+        data, _ = await asyncio.gather(
+            coordinator._async_update_data(), coordinator.async_update_model()
+        )
+    assert data["model_error"] > 0
+    # The reload kept the fitted parameters and restored the checkpointed estimate
+    assert np.array_equal(coordinator._fitted_params.to_vector(), fitted.to_vector())
+    estimate = coordinator.estimator.model_params.to_vector()
+    assert np.array_equal(coordinator.model_params.to_vector(), estimate)
+
+    await hass.async_block_till_done(wait_background_tasks=True)
+    assert await hass.config_entries.async_unload(config_entry.entry_id)
+    await hass.async_block_till_done()
+
+
+async def test_control_plans_with_mpc(hass: HomeAssistant, mydata) -> None:  # noqa: F811
+    """Test that rooms with a target temperature get a control plan."""
+    config_entry = MockConfigEntry(data=mydata, domain=DOMAIN, options={})
+    config_entry.add_to_hass(hass)
+    assert await hass.config_entries.async_setup(config_entry.entry_id)
+    await hass.async_block_till_done()
+
+    hass.states.async_set(mydata[CONF_WEATHER_ENTITY], "sunny", {"temperature": 5})
+    for room in mydata[CONF_ROOM_SETTINGS].values():
+        hass.states.async_set(room[CONF_TEMP_ENTITY], "18")
+    await hass.async_block_till_done()
+    coordinator = config_entry.runtime_data.coordinator_control
+
+    # Every room is off until a mode is set
+    data = await coordinator._async_update_data()
+    assert "control_plan" not in data
+
+    await hass.services.async_call(
+        CLIMATE_DOMAIN,
+        SERVICE_SET_HVAC_MODE,
+        {ATTR_ENTITY_ID: "climate.unistat_kitchen", ATTR_HVAC_MODE: HVACMode.AUTO},
+        blocking=True,
+    )
+    data = await coordinator._async_update_data()
+    assert not data["sensor_failure"]
+    target = hass.states.get("climate.unistat_kitchen").attributes[ATTR_TEMPERATURE]
+    assert data["control_error"] == pytest.approx(target - 18)
+    assert data["control_plan"]["switch.spaceheater1"][HVACMode.HEAT] > 0
+    # Switched appliances are scheduled online while the explicit table is built
+    assert "schedule_optimal" in data
+    await hass.async_block_till_done(wait_background_tasks=True)
+    assert coordinator._explicit is not None
+
+    data = await coordinator._async_update_data()
+    assert "schedule_optimal" not in data
+    assert data["control_plan"]["switch.spaceheater1"][HVACMode.HEAT] == 1
+
+    await hass.async_block_till_done(wait_background_tasks=True)
+    assert await hass.config_entries.async_unload(config_entry.entry_id)
+    await hass.async_block_till_done()
+
+
+async def test_control_buffers_readings(hass: HomeAssistant, mydata) -> None:  # noqa: F811
+    """Test that the control state comes from the buffered readings and a silent sensor's room
+    floats."""
+    config_entry = MockConfigEntry(data=mydata, domain=DOMAIN, options={})
+    config_entry.add_to_hass(hass)
+    assert await hass.config_entries.async_setup(config_entry.entry_id)
+    await hass.async_block_till_done()
+
+    hass.states.async_set(mydata[CONF_WEATHER_ENTITY], "sunny", {"temperature": 5})
+    for temp in ("19", "20", "21"):
+        for room in mydata[CONF_ROOM_SETTINGS].values():
+            hass.states.async_set(room[CONF_TEMP_ENTITY], temp)
+    await hass.async_block_till_done()
+
+    coordinator = config_entry.runtime_data.coordinator_control
+    room = next(iter(mydata[CONF_ROOM_SETTINGS]))
+    _, values = coordinator.readings(room_signal(room)).latest()
+    assert np.array_equal(values, [19, 20, 21])
+    for entity_id in ("climate.unistat_kitchen", "climate.unistat_bedroom"):
+        await hass.services.async_call(
+            CLIMATE_DOMAIN,
+            SERVICE_SET_HVAC_MODE,
+            {ATTR_ENTITY_ID: entity_id, ATTR_HVAC_MODE: HVACMode.AUTO},
+            blocking=True,
+        )
+    data = await coordinator._async_update_data()
+    assert not data["sensor_failure"]
+    target = hass.states.get("climate.unistat_kitchen").attributes[ATTR_TEMPERATURE]
+    assert data["control_error"] == pytest.approx(target - 21)
+
+    # Only the bedroom sensor keeps reporting, the silent kitchen floats
+    later = dt_util.utcnow() + timedelta(hours=12)
+    bedroom = mydata[CONF_ROOM_SETTINGS]["bedroom"][CONF_TEMP_ENTITY]
+    coordinator.async_process_sensor_state(State(bedroom, "18", last_updated=later))
+    with patch("homeassistant.util.dt.utcnow", return_value=later):
+        data = await coordinator._async_update_data()
+    assert not data["sensor_failure"]
+    target = hass.states.get("climate.unistat_bedroom").attributes[ATTR_TEMPERATURE]
+    assert data["control_error"] == pytest.approx(target - 18)
+
+    await hass.async_block_till_done(wait_background_tasks=True)
+    assert await hass.config_entries.async_unload(config_entry.entry_id)
+    await hass.async_block_till_done()
+
+
+async def test_control_coalesces_sensor_writes(hass: HomeAssistant, mydata) -> None:  # noqa: F811
+    """Test that a burst of sensor changes is buffered but written to the entity once."""
+    config_entry = MockConfigEntry(data=mydata, domain=DOMAIN, options={})
+    config_entry.add_to_hass(hass)
+    assert await hass.config_entries.async_setup(config_entry.entry_id)
+    await hass.async_block_till_done()
+
+    coordinator = config_entry.runtime_data.coordinator_control
+    sensor = mydata[CONF_ROOM_SETTINGS]["kitchen"][CONF_TEMP_ENTITY]
+    writes = []
+    async_track_state_change_event(
+        hass,
+        "climate.unistat_kitchen",
+        lambda event: writes.append(event.data["new_state"]),
+    )
+    for temp in ("19", "20", "bad", "21"):
+        hass.states.async_set(sensor, temp)
+    await hass.async_block_till_done()
+
+    _, values = coordinator.readings(room_signal("kitchen")).latest()
+    assert np.array_equal(values, [19, 20, 21])
+    assert not writes
+
+    async_fire_time_changed(
+        hass, dt_util.utcnow() + timedelta(seconds=SENSOR_WRITE_DELAY + 1)
+    )
+    await hass.async_block_till_done()
+    assert len(writes) == 1
+    expected = TemperatureConverter.convert(
+        21, mydata[CONF_TEMPERATURE_UNIT], hass.config.units.temperature_unit
+    )
+    assert writes[0].attributes[ATTR_CURRENT_TEMPERATURE] == pytest.approx(
+        expected, abs=0.1
+    )
+
+    await hass.async_block_till_done(wait_background_tasks=True)
+    assert await hass.config_entries.async_unload(config_entry.entry_id)
+    await hass.async_block_till_done()
+
+
+async def test_control_resolves_on_events(hass: HomeAssistant, mydata) -> None:  # noqa: F811
+    """Test that setpoint and temperature changes re-solve early, at most once per cooldown."""
+    config_entry = MockConfigEntry(data=mydata, domain=DOMAIN, options={})
+    config_entry.add_to_hass(hass)
+    assert await hass.config_entries.async_setup(config_entry.entry_id)
+    await hass.async_block_till_done()
+
+    coordinator = config_entry.runtime_data.coordinator_control
+    sensor = mydata[CONF_ROOM_SETTINGS]["kitchen"][CONF_TEMP_ENTITY]
+    hass.states.async_set(sensor, "20")
+    await hass.async_block_till_done()
+    now = dt_util.utcnow()
+
+    async def solves_after(action) -> int:
+        nonlocal now
+        with patch.object(
+            coordinator, "_async_update_data", return_value={}
+        ) as update_data:
+            await action()
+            await hass.async_block_till_done()
+            now += timedelta(seconds=CONTROL_RESOLVE_COOLDOWN + 1)
+            async_fire_time_changed(hass, now)
+            await hass.async_block_till_done()
+        return update_data.call_count
+
+    async def set_temperatures():
+        for temperature in (20, 21, 22, 23):
+            await hass.services.async_call(
+                CLIMATE_DOMAIN,
+                SERVICE_SET_TEMPERATURE,
+                {
+                    ATTR_ENTITY_ID: "climate.unistat_kitchen",
+                    ATTR_TEMPERATURE: temperature,
+                },
+                blocking=True,
+            )
+
+    async def small_change():
+        hass.states.async_set(sensor, "20.5")
+
+    async def jump():
+        hass.states.async_set(sensor, "23")
+
+    # The first change solves right away, the rest of the burst once after the cooldown
+    assert await solves_after(set_temperatures) == 2
+    assert await solves_after(small_change) == 0
+    assert await solves_after(jump) == 1
+
+    await hass.async_block_till_done(wait_background_tasks=True)
+    assert await hass.config_entries.async_unload(config_entry.entry_id)
+    await hass.async_block_till_done()
@@ -0,0 +1,228 @@
+"""Test loading the recorded history."""
+
+from datetime import timedelta
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from freezegun.api import FrozenDateTimeFactory
+from pytest_homeassistant_custom_component.components.recorder.common import (
+    async_wait_recording_done,
+)
+
+from homeassistant.components.recorder import Recorder, history
+from homeassistant.const import STATE_OFF, STATE_ON
+from homeassistant.core import HomeAssistant
+from homeassistant.util import dt as dt_util
+
+from custom_components.unistat import history as unistat_history
+from custom_components.unistat.history import (
+    HISTORY_DIR,
+    HistoryBlock,
+    RingBuffer,
+    UniStatHistoryStore,
+    SIGNAL_OUTSIDE_TEMP,
+    async_load_history,
+    control_signal,
+    model_signals,
+    resample,
+    room_signal,
+)
+from custom_components.unistat.thermal_model import UniStatSystemModel
+
+from .test_thermal_model import conf_simple
+
+
+@pytest.fixture
+def mock_recorder_before_hass(async_test_recorder) -> None:
+    """Set up the recorder before hass."""
+
+
+def test_model_signals():
+    model = UniStatSystemModel(conf_simple())
+    signals = model_signals(model)
+    assert signals[SIGNAL_OUTSIDE_TEMP][0] == "weather.forecast_home"
+    assert signals[room_signal("room_1")][0] == "sensor.room_1_temp"
+    for entity_id, mode in model.control_outputs:
+        assert signals[control_signal(entity_id, mode)][0] == entity_id
+    assert len(signals) == 1 + 3 + model.num_controls
+
+
+def test_history_store(tmp_path):
+    model = UniStatSystemModel(conf_simple())
+    signals = model_signals(model)
+    path = str(tmp_path / HISTORY_DIR)
+
+    def block(first: int, last: int) -> HistoryBlock:
+        times = np.arange(first, last) * 300.0
+        return HistoryBlock(times, {name: times + i for i, name in enumerate(signals)})
+
+    store = UniStatHistoryStore(path, signals, 300)
+    assert not store.load()
+    store.reset(0)
+    store.append(block(0, 10))
+    store.append(block(10, 25))
+    with pytest.raises(ValueError):
+        store.append(block(30, 31))
+
+    store = UniStatHistoryStore(path, signals, 300)
+    assert store.load()
+    assert store.num_steps == 25
+    window = store.window(3000, 4500)
+    assert isinstance(window[SIGNAL_OUTSIDE_TEMP], np.memmap)
+    assert np.array_equal(window.times, np.arange(10, 15) * 300.0)
+    assert np.array_equal(window[room_signal("room_0")], window.times + 1)
+
+    # Dropping most of the samples compacts the files
+    store.trim(6000)
+    store.append(block(25, 27))
+    store = UniStatHistoryStore(path, signals, 300)
+    assert store.load()
+    assert (store.start, store.num_steps) == (6000, 7)
+    assert np.load(f"{path}/signal_0.npy").shape == (7,)
+    window = store.window(0, 1e9)
+    assert np.array_equal(window.times, np.arange(20, 27) * 300.0)
+    assert np.array_equal(window[SIGNAL_OUTSIDE_TEMP], window.times)
+
+    # Different signals don't use the stored history
+    other = model_signals(UniStatSystemModel(conf_simple(2)))
+    assert not UniStatHistoryStore(path, other, 300).load()
+    assert not UniStatHistoryStore(path, signals, 60).load()
+
+
+def test_resample():
+    times = np.array([0.0, 100.0, 200.0, 300.0, 10000.0])
+    values = np.array([1.0, 3.0, np.nan, 5.0, 7.0])
+    grid = np.array([-50.0, 0.0, 50.0, 150.0, 250.0, 400.0, 9000.0, 10100.0])
+
+    held = resample(times, values, grid)
+    assert np.allclose(held, [np.nan, 1, 1, 3, np.nan, 5, 5, 7], equal_nan=True)
+    interpolated = resample(times, values, grid, linear=True)
+    expected = [np.nan, 1, 2, 3, np.nan, 5 + 2 / 97, 5 + 174 / 97, 7]
+    assert np.allclose(interpolated, expected, equal_nan=True)
+
+    # Readings too far apart, or too old, are gaps
+    stale = resample(times, values, grid, linear=True, max_gap=1000)
+    assert np.allclose(stale, expected[:5] + [np.nan] * 2 + [7], equal_nan=True)
+    assert np.isnan(resample(times, values, grid, max_gap=1000)[6])
+    assert np.all(np.isnan(resample(np.empty(0), np.empty(0), grid)))
+
+    # Months of one minute samples in a single pass
+    grid = np.arange(0, 90 * 86400, 60.0)
+    times = np.sort(np.random.default_rng(0).uniform(0, grid[-1], 20000))
+    out = resample(times, np.sin(times), grid, linear=True)
+    assert out.shape == grid.shape
+    assert np.all(np.isfinite(out[grid > times[0]]))
+
+
+async def test_load_history(
+    hass: HomeAssistant, recorder_mock: Recorder, freezer: FrozenDateTimeFactory
+):
+    model = UniStatSystemModel(conf_simple())
+    # On the sample grid
+    start = (dt_util.utcnow() + timedelta(hours=1)).replace(
+        minute=0, second=0, microsecond=0
+    )
+    freezer.move_to(start - timedelta(minutes=10))
+    hass.states.async_set("weather.forecast_home", "sunny", {"temperature": 5})
+    for i in range(3):
+        hass.states.async_set(f"sensor.room_{i}_temp", "20")
+    hass.states.async_set("switch.spaceheater1", STATE_OFF)
+    await async_wait_recording_done(hass)
+
+    freezer.move_to(start + timedelta(minutes=10))
+    hass.states.async_set("sensor.room_0_temp", "21")
+    hass.states.async_set("sensor.room_2_temp", "unavailable")
+    hass.states.async_set("switch.spaceheater1", STATE_ON)
+    await async_wait_recording_done(hass)
+
+    block = await async_load_history(
+        hass, model, start, start + timedelta(minutes=20), 300
+    )
+    assert block is not None
+    assert block.num_steps == 4
+    assert np.allclose(block[SIGNAL_OUTSIDE_TEMP], 5)
+    # Temperatures are interpolated between readings, controls are held. The state at the start
+    # of the window counts as a reading at the start
+    assert np.allclose(block[room_signal("room_0")], [20, 20.5, 21, 21])
+    assert np.allclose(block[room_signal("room_1")], 20)
+    assert np.all(np.isnan(block[room_signal("room_2")][2:]))
+    heater = block[control_signal("switch.spaceheater1", "heat")]
+    assert np.allclose(heater, [0, 0, 1, 1])
+    assert np.array_equal(
+        block.valid(room_signal("room_2")), [True, True, False, False]
+    )
+    # Never recorded
+    assert np.all(np.isnan(block[control_signal("switch.window_ac1", "cool")]))
+
+
+async def test_update_history(
+    hass: HomeAssistant,
+    recorder_mock: Recorder,
+    freezer: FrozenDateTimeFactory,
+    tmp_path,
+):
+    model = UniStatSystemModel(conf_simple())
+    path = str(tmp_path / "unistat" / HISTORY_DIR)
+    # On the sample grid
+    start = (dt_util.utcnow() + timedelta(hours=1)).replace(
+        minute=0, second=0, microsecond=0
+    )
+    for minutes in range(1, 90, 5):
+        freezer.move_to(start + timedelta(minutes=minutes))
+        hass.states.async_set("sensor.room_0_temp", str(20 + minutes / 60))
+    await async_wait_recording_done(hass)
+    end = start + timedelta(minutes=60)
+    later = timedelta(minutes=30)
+
+    with (
+        patch.object(unistat_history, "HISTORY_MAX_GAP", 900),
+        patch.object(
+            history, "get_significant_states", wraps=history.get_significant_states
+        ) as fetch,
+    ):
+        first = await async_load_history(hass, model, start, end, 300, path)
+        assert fetch.call_args.args[1] == start
+        # Later on only the samples near the end are read again and the window moves along
+        second = await async_load_history(
+            hass, model, start + later, end + later, 300, path
+        )
+        # The last 900 s are rewritten from readings up to 900 s before them
+        assert fetch.call_args.args[1] == end - timedelta(seconds=1800)
+        expected = await async_load_history(
+            hass, model, start + later, end + later, 300
+        )
+
+    assert first.num_steps == 12
+    assert second.num_steps == 12
+    assert np.array_equal(second.times, first.times + 1800)
+    # Away from the start of the window, where the start state counts as a reading
+    temps = second[room_signal("room_0")]
+    assert np.allclose(temps[3:], expected[room_signal("room_0")][3:])
+    assert np.allclose(temps, 20 + (second.times - start.timestamp()) / 3600)
+
+    # Another model reads the whole window again
+    other = UniStatSystemModel(conf_simple(2))
+    with patch.object(
+        history, "get_significant_states", wraps=history.get_significant_states
+    ) as fetch:
+        await async_load_history(hass, other, start, end, 300, path)
+        assert fetch.call_args.args[1] == start
+
+
+def test_ring_buffer():
+    buffer = RingBuffer(4)
+    assert len(buffer) == 0
+    assert buffer.latest()[0].size == 0
+    for i in range(6):
+        buffer.append(i * 10.0, i)
+
+    times, values = buffer.latest()
+    assert len(buffer) == 4
+    assert np.array_equal(times, [20, 30, 40, 50])
+    assert np.array_equal(values, [2, 3, 4, 5])
+    # Windows are views, not copies
+    assert np.shares_memory(values, buffer.latest(2)[1])
+    assert np.array_equal(buffer.latest(2)[1], [4, 5])
+    buffer.append(60.0, 6)
+    assert np.array_equal(buffer.latest()[1], [3, 4, 5, 6])
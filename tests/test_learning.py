@@ -0,0 +1,236 @@
+import threading
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from custom_components.unistat import learning
+from custom_components.unistat.learning import (
+    LEARNING_REFINED_STARTS,
+    LEARNING_SEGMENT_STEPS,
+    OnlineParamEstimator,
+    TrainingData,
+    fit_model_params,
+    fit_model_params_multistart,
+)
+from custom_components.unistat.thermal_model import UniStatSystemModel
+
+from .test_thermal_model import conf_simple
+
+
+def make_training_data(model: UniStatSystemModel, num_steps: int, seed: int = 0):
+    """Simulates a day of history with switching controls and a varying outside temperature"""
+    rng = np.random.default_rng(seed)
+    controls = (rng.uniform(0, 1, (num_steps, model.num_controls)) > 0.7).astype(float)
+    outside_temps = 5 + 5 * np.sin(np.linspace(0, 2 * np.pi, num_steps))
+    x0 = model.initial_state(outside_temps[0], rng.uniform(18, 22, 3))
+    _, outputs = model.simulate(x0, controls, outside_temps=outside_temps)
+    return TrainingData(
+        dt=300,
+        outside_temps=outside_temps,
+        room_temps=outputs[:-1],
+        controls=controls,
+    )
+
+
+@pytest.fixture
+def true_model():
+    model = UniStatSystemModel(conf_simple())
+    vector = model.model_params.to_vector()
+    vector[model.model_params._field_slices["room_thermal_masses"]] = [800, 1200, 1500]
+    vector[model.model_params._field_slices["thermal_resistances"]] *= 1.5
+    params = model.model_params.from_vector(vector)
+    return UniStatSystemModel(params.conf_data, params)
+
+
+def test_fit_recovers_params(true_model: UniStatSystemModel):
+    data = make_training_data(true_model, 289)
+    initial = UniStatSystemModel(true_model.model_params.conf_data)
+
+    fitted, cost = fit_model_params(initial, data, max_nfev=200)
+
+    assert fitted.in_bounds
+    assert cost < 1e-6
+    # Only rooms with an appliance have an identifiable thermal mass
+    expected = true_model.model_params.to_vector()
+    for field in ("room_thermal_masses", "thermal_resistances"):
+        idx = fitted._field_slices[field]
+        assert np.allclose(
+            fitted.to_vector()[idx][[0, 2]], expected[idx][[0, 2]], rtol=1e-3
+        )
+
+
+def test_fit_warm_start(true_model: UniStatSystemModel):
+    data = make_training_data(true_model, 289, seed=1)
+    vector = true_model.model_params.to_vector() * 1.05
+    initial = true_model.model_params.from_vector(vector)
+
+    _, cost = fit_model_params(true_model, data, initial_params=initial)
+
+    assert cost < 1e-6
+
+
+def test_fit_ignores_missing_data(true_model: UniStatSystemModel):
+    data = make_training_data(true_model, 289)
+    room_temps = data.room_temps.copy()
+    room_temps[10:20, 1] = np.nan
+    controls = data.controls.copy()
+    controls[LEARNING_SEGMENT_STEPS + 5] = np.nan
+    data = TrainingData(data.dt, data.outside_temps, room_temps, controls)
+
+    fitted, cost = fit_model_params(true_model, data)
+
+    assert np.isfinite(cost)
+    assert np.allclose(fitted.to_vector(), true_model.model_params.to_vector())
+
+
+def test_fit_not_enough_data(true_model: UniStatSystemModel):
+    data = make_training_data(true_model, LEARNING_SEGMENT_STEPS)
+    with pytest.raises(ValueError):
+        fit_model_params(true_model, data)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_fit_multistart(true_model: UniStatSystemModel, processes: int):
+    data = make_training_data(true_model, 289)
+    initial = UniStatSystemModel(true_model.model_params.conf_data)
+    bounds = initial.model_params.param_bounds
+    far = bounds[:, 0] + 0.9 * (bounds[:, 1] - bounds[:, 0])
+
+    fitted, cost = fit_model_params_multistart(
+        initial,
+        data,
+        [far],
+        num_samples=16,
+        processes=processes,
+        rng=np.random.default_rng(0),
+    )
+
+    assert fitted.in_bounds
+    assert cost < 1e-6
+
+
+def test_fit_multistart_time_budget(true_model: UniStatSystemModel):
+    data = make_training_data(true_model, 289)
+    initial = UniStatSystemModel(true_model.model_params.conf_data)
+
+    # Out of time after the first round of fits, which still improve on the screened starts
+    with patch.object(learning, "_fit_segments", wraps=learning._fit_segments) as fit:
+        fitted, cost = fit_model_params_multistart(
+            initial, data, time_budget=0, processes=1, rng=np.random.default_rng(0)
+        )
+    assert fit.call_count == LEARNING_REFINED_STARTS
+    assert fitted.in_bounds
+    assert np.isfinite(cost)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_fit_multistart_cancel(true_model: UniStatSystemModel, processes: int):
+    data = make_training_data(true_model, 289)
+    initial = UniStatSystemModel(true_model.model_params.conf_data)
+    cancel = threading.Event()
+    cancel.set()
+
+    # Every fit stops at its first iteration, far from the fit an uncancelled search finds
+    fitted, cost = fit_model_params_multistart(
+        initial,
+        data,
+        max_nfev=200,
+        processes=processes,
+        rng=np.random.default_rng(0),
+        cancel=cancel,
+    )
+    assert fitted.in_bounds
+    assert 1 < cost < np.inf
+
+
+def test_latin_hypercube():
+    bounds = np.array([[0.0, 2.0], [100.0, 10000.0], [-1.0, 1.0]])
+    samples = learning._latin_hypercube(bounds, 10, np.random.default_rng(0))
+
+    assert samples.shape == (10, 3)
+    assert np.all((samples >= bounds[:, 0]) & (samples <= bounds[:, 1]))
+    # One sample in each of the equal strata, which are logarithmic for the mass like parameter
+    strata = np.stack(
+        [
+            samples[:, 0] / 2,
+            np.log(samples[:, 1] / 100) / np.log(100),
+            (samples[:, 2] + 1) / 2,
+        ],
+        axis=1,
+    )
+    for column in np.floor(strata * 10).T:
+        assert sorted(column) == list(range(10))
+
+
+class TestOnlineParamEstimator:
+    def run(self, estimator, true_model, num_steps, seed=0):
+        data = make_training_data(true_model, num_steps + 1, seed=seed)
+        x = true_model.initial_state(data.outside_temps[0], data.room_temps[0])
+        errors = []
+        for k in range(num_steps):
+            x[0] = data.outside_temps[k]
+            x[1:4] = data.room_temps[k]
+            errors.append(
+                estimator.update(
+                    true_model, x.copy(), data.controls[k], data.room_temps[k + 1], 300
+                )
+            )
+        return np.array(errors)
+
+    def test_tracks_change(self, true_model: UniStatSystemModel):
+        initial = UniStatSystemModel(true_model.model_params.conf_data).model_params
+        estimator = OnlineParamEstimator(initial)
+
+        errors = self.run(estimator, true_model, 288 * 2)
+
+        assert estimator.model_params.in_bounds
+        assert np.mean(errors[-50:]) < 0.2 * np.mean(errors[:50])
+        masses = estimator.model_params.room_thermal_masses
+        assert masses[0] == pytest.approx(800, rel=0.05)
+        assert masses[2] == pytest.approx(1500, rel=0.05)
+
+    def test_skips_missing(self, true_model: UniStatSystemModel):
+        estimator = OnlineParamEstimator(true_model.model_params)
+        x = true_model.initial_state(0, [20, np.nan, 20])
+        u = np.zeros(true_model.num_controls)
+        assert estimator.update(true_model, x, u, np.full(3, 20.0), 300) is None
+        assert np.array_equal(
+            estimator.model_params.to_vector(), true_model.model_params.to_vector()
+        )
+
+    def test_stale_room(self, true_model: UniStatSystemModel):
+        initial = UniStatSystemModel(true_model.model_params.conf_data).model_params
+        estimator = OnlineParamEstimator(initial)
+        x = true_model.initial_state(5, [20, 19, 21])
+        u = np.ones(true_model.num_controls)
+        ad, bd = true_model.discretize(300)
+        measured = (ad @ x + bd @ u)[1:4]
+        measured[1] = np.nan
+
+        # The measured rooms still update the estimate
+        error = estimator.update(true_model, x, u, measured, 300, [True, True, False])
+        assert error is not None and np.isfinite(error)
+        assert not np.array_equal(
+            estimator.model_params.to_vector(), initial.to_vector()
+        )
+
+        unobserved = OnlineParamEstimator(initial)
+        assert unobserved.update(true_model, x, u, measured, 300, [False] * 3) is None
+
+    def test_checkpoint(self, true_model: UniStatSystemModel):
+        estimator = OnlineParamEstimator(true_model.model_params)
+        self.run(estimator, true_model, 10)
+
+        restored = OnlineParamEstimator.from_dict(
+            true_model.model_params, estimator.as_dict()
+        )
+        assert np.array_equal(restored.covariance, estimator.covariance)
+        assert np.array_equal(
+            restored.model_params.to_vector(), estimator.model_params.to_vector()
+        )
+
+        fresh = OnlineParamEstimator.from_dict(true_model.model_params, {"x": 1})
+        assert np.array_equal(
+            fresh.model_params.to_vector(), true_model.model_params.to_vector()
+        )
@@ -2,7 +2,13 @@ import pytest
 import numpy as np
 
 from custom_components.unistat.const import ControlApplianceType, CentralApplianceType
-from custom_components.unistat.model_params import UniStatModelParams
+from custom_components.unistat.model_params import (
+    PARAM_MINOR_VERSION,
+    PARAM_VERSION,
+    STORE_MODEL_PARAMS,
+    UniStatModelParams,
+    UniStatModelParamsStore,
+)
 from homeassistant.const import CONF_NAME, UnitOfPower
 
 
@@ -229,6 +235,65 @@ class TestUniStatModelParams_OffNominal:
             MODEL_PARAMS_FULL.from_vector(initial[1:])
 
 
+def test_bounds_vectorized():
+    params = MODEL_PARAMS_FULL
+    bounds = params.param_bounds
+    assert bounds is params.param_bounds
+    with pytest.raises(ValueError):
+        bounds[0, 0] = 0
+
+    vectors = np.stack([params.to_vector()] * 3)
+    vectors[1, 0] = -1e9
+    vectors[2, -1] = 1e9
+    assert params.vectors_in_bounds(vectors).tolist() == [True, False, False]
+    clipped = params.clip(vectors)
+    assert np.all(params.vectors_in_bounds(clipped))
+    assert clipped[1, 0] == bounds[0, 0]
+    assert clipped[2, -1] == bounds[-1, 1]
+    # Derived parameters share the bounds
+    assert params.from_vector(clipped[1]).param_bounds is bounds
+
+
+def test_adjacency_structures():
+    params = MODEL_PARAMS_FULL
+    adjacency = np.array(params.conf_data["adjacency"])
+    assert np.array_equal(params.adjacency_matrix, adjacency)
+    assert params.adjacency_matrix is params.adjacency_matrix
+
+    edges = params.wall_edges
+    assert edges.shape == (len(params.thermal_resistances), 2)
+    assert np.all(adjacency[edges[:, 0], edges[:, 1]] == 1)
+    assert np.array_equal(params.outside_walls, edges[:, 0] == 0)
+    for structure in (params.adjacency_matrix, edges, params.outside_walls):
+        with pytest.raises(ValueError):
+            structure[0] = 0
+    assert params.from_vector(params.to_vector()).wall_edges is edges
+
+
+def test_from_vector_shares_structure():
+    vector = MODEL_PARAMS_FULL.to_vector() * 2
+    derived = MODEL_PARAMS_FULL.from_vector(vector)
+
+    assert derived.conf_data is MODEL_PARAMS_FULL.conf_data
+    assert derived._field_slices is MODEL_PARAMS_FULL._field_slices
+    # The tunable fields are derived from the vector when first read
+    assert "radiator_constants" not in derived.__dict__
+    assert derived.radiator_constants == [0.2, 0.4]
+    assert derived.radiator_constants is derived.radiator_constants
+    assert derived.asdict()["radiator_constants"] == [0.2, 0.4]
+    # The vector is a read-only view of the input, not a copy
+    assert np.shares_memory(derived.vector, vector)
+    assert derived.vector is derived.vector
+    again = derived.from_vector(derived.vector)
+    assert again.boiler_thermal_masses == derived.boiler_thermal_masses
+    with pytest.raises(ValueError):
+        derived.vector[0] = 1
+    # to_vector is a copy that callers may change
+    changed = derived.to_vector()
+    changed[0] = 1
+    assert derived.vector[0] != 1
+
+
 class TestUniStatModelParams_from_conf:
     def test_has_boiler(self):
         model_params = UniStatModelParams.from_conf(conf_with_boiler())
@@ -275,6 +340,7 @@ class TestUniStatModelParams_from_conf:
                 "has_common_rooms": False,
                 "common_rooms": [],
                 "zone_map": [["kitchen"], ["bedroom"]],
+                "fixture_rooms": ["kitchen", "bedroom"],
             }
         ]
 
@@ -286,6 +352,7 @@ class TestUniStatModelParams_from_conf:
         assert not model_params.has_boiler
         assert model_params.num_rooms == 3
         assert model_params.central_appliances == []
+        assert model_params.from_vector(model_params.to_vector()) == model_params
         assert model_params.standalone_appliances == {
             ControlApplianceType.SpaceHeater: [
                 {
@@ -324,3 +391,12 @@ class TestUniStatModelParams_from_conf:
     def test_my_house(self):
         # TODO implement test
         assert False
+
+
+async def test_store_migrate_v1_1(hass):
+    store = UniStatModelParamsStore(
+        hass, version=PARAM_VERSION, minor_version=PARAM_MINOR_VERSION, key="test"
+    )
+    old_data = MODEL_PARAMS_MIN.asdict()
+    migrated = await store._async_migrate_func(1, 1, old_data)
+    assert migrated == {STORE_MODEL_PARAMS: old_data}
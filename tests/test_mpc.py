@@ -0,0 +1,176 @@
+import numpy as np
+import pytest
+
+from scipy.optimize import minimize
+
+from homeassistant.components.climate import HVACMode
+
+from custom_components.unistat.const import ControlMode
+from custom_components.unistat.mpc import (
+    MPC_COMPRESSED_STEPS,
+    MPC_ENERGY_WEIGHTS,
+    UniStatExplicitMPC,
+    UniStatMPC,
+    solve_box_qp,
+)
+from custom_components.unistat.scheduler import UniStatScheduler
+from custom_components.unistat.thermal_model import UniStatSystemModel
+
+from .test_thermal_model import conf_simple
+
+
+@pytest.fixture
+def mpc():
+    return UniStatMPC(UniStatSystemModel(conf_simple()))
+
+
+def test_solve_box_qp():
+    rng = np.random.default_rng(0)
+    m = rng.normal(size=(20, 20))
+    hessian = m @ m.T + np.eye(20)
+    gradient = rng.normal(size=20) * 10
+    lower, upper = np.zeros(20), np.ones(20)
+
+    x, iterations = solve_box_qp(
+        hessian,
+        gradient,
+        lower,
+        upper,
+        np.zeros(20),
+        np.linalg.eigvalsh(hessian)[-1],
+        max_iterations=5000,
+        tolerance=1e-10,
+    )
+
+    expected = minimize(
+        lambda v: 0.5 * v @ hessian @ v + gradient @ v,
+        np.zeros(20),
+        jac=lambda v: hessian @ v + gradient,
+        bounds=list(zip(lower, upper)),
+        method="L-BFGS-B",
+        options={"ftol": 1e-15, "gtol": 1e-12},
+    )
+    assert iterations < 5000
+    assert np.allclose(x, expected.x, atol=1e-5)
+
+
+class TestUniStatMPC:
+    def test_prediction_matches_simulate(self, mpc: UniStatMPC):
+        x0 = mpc.model.initial_state(5, [18, 20, 24])
+        t_out = np.linspace(5, 0, mpc.horizon)
+        solution = mpc.solve(x0, 21, outside_temps=t_out)
+        assert solution.controls.shape == (mpc.horizon, mpc.model.num_controls)
+        assert np.all((solution.controls >= 0) & (solution.controls <= 1))
+
+        _, outputs = mpc.model.simulate(x0, solution.controls, outside_temps=t_out)
+        assert np.allclose(outputs[1:], solution.room_temps)
+
+    def test_heats_and_cools(self, mpc: UniStatMPC):
+        x0 = mpc.model.initial_state(15, [18, 21, 25])
+        solution = mpc.solve(x0, 21)
+        plan = mpc.first_controls(solution)
+        assert plan["switch.spaceheater1"][HVACMode.HEAT] == pytest.approx(1)
+        assert plan["switch.window_ac1"][HVACMode.COOL] == pytest.approx(1)
+
+        # A room with no weight is left to float
+        solution = mpc.solve(x0, 21, room_weights=[1, 1, 0])
+        assert np.allclose(solution.controls[:, 1], 0)
+
+    def test_warm_start(self, mpc: UniStatMPC):
+        x0 = mpc.model.initial_state(5, [20.5, 21, 21.5])
+        cold = mpc.solve(x0, 21)
+        warm = mpc.solve(x0, 21)
+        assert warm.iterations < cold.iterations
+        assert warm.cost == pytest.approx(cold.cost, rel=1e-3)
+
+    def test_bad_outside_temps(self, mpc: UniStatMPC):
+        x0 = mpc.model.initial_state(5, [20, 21, 22])
+        with pytest.raises(ValueError):
+            mpc.solve(x0, 21, outside_temps=np.zeros(mpc.horizon + 1))
+
+
+class TestUniStatMPC_compressed:
+    def test_move_blocking(self, mpc: UniStatMPC):
+        compressed = UniStatMPC.compressed(mpc.model)
+        assert compressed.horizon == len(MPC_COMPRESSED_STEPS)
+        # Both appliances are switches, held for half an hour at a time
+        assert compressed.num_decisions == 2 * 6
+        assert mpc.num_decisions == mpc.horizon * mpc.model.num_controls
+
+        x0 = mpc.model.initial_state(5, [18, 21, 24])
+        solution = compressed.solve(x0, 21)
+        assert np.all(solution.controls[:6] == solution.controls[0])
+        assert np.all(solution.controls[6:8] == solution.controls[6])
+
+        expected = mpc.model.prediction_matrices(
+            compressed.horizon, MPC_COMPRESSED_STEPS
+        ).predict(x0, solution.controls)
+        assert np.allclose(solution.room_temps, expected)
+        # The coarse plan agrees with the full one on what to do now
+        full = mpc.solve(x0, 21)
+        assert np.allclose(solution.controls[0], full.controls[0], atol=0.05)
+
+    def test_warm_start(self, mpc: UniStatMPC):
+        compressed = UniStatMPC.compressed(mpc.model)
+        x0 = mpc.model.initial_state(5, [20.5, 21, 21.5])
+        cold = compressed.solve(x0, 21)
+        warm = compressed.solve(x0, 21)
+        assert warm.iterations <= cold.iterations
+        assert warm.cost == pytest.approx(cold.cost, rel=1e-3)
+
+
+class TestUniStatExplicitMPC:
+    @pytest.fixture
+    def explicit(self):
+        mpc = UniStatMPC(UniStatSystemModel(conf_simple(num_rooms=2)))
+        return UniStatExplicitMPC(mpc, [21, 20])
+
+    def test_table(self, explicit: UniStatExplicitMPC):
+        model = explicit.mpc.model
+        assert explicit.table.shape == (7, 7, 11, model.num_controls)
+        # Grid points reproduce the online solution, relative to the setpoints
+        x0 = model.initial_state(-5 + 20.5, [-1 + 21, 2 + 20])
+        expected = explicit.mpc.solve_batch(x0, [21, 20])[0]
+        assert np.allclose(explicit.lookup(x0, [21, 20]), expected, atol=1e-4)
+
+    def test_interpolation(self, explicit: UniStatExplicitMPC):
+        model = explicit.mpc.model
+        rng = np.random.default_rng(8)
+        errors = []
+        for _ in range(50):
+            x0 = model.initial_state(rng.uniform(-10, 15), rng.uniform(18, 23, 2))
+            expected = explicit.mpc.solve_batch(x0, [21, 20])[0]
+            controls = explicit.lookup(x0, [21, 20])
+            assert np.all((controls >= 0) & (controls <= 1))
+            errors.append(np.abs(controls - expected))
+        assert np.mean(errors) < 0.1
+
+    def test_shift_invariant(self, explicit: UniStatExplicitMPC):
+        model = explicit.mpc.model
+        x0 = model.initial_state(3.3, [19.2, 21.7])
+        shifted = model.initial_state(5.3, [21.2, 23.7])
+        assert np.allclose(
+            explicit.lookup(x0, [21, 20]), explicit.lookup(shifted, [23, 22])
+        )
+        assert explicit.matches([23, 22], None, MPC_ENERGY_WEIGHTS[ControlMode.COMFORT])
+        assert not explicit.matches(
+            [23, 21], None, MPC_ENERGY_WEIGHTS[ControlMode.COMFORT]
+        )
+
+    def test_scheduled(self):
+        scheduler = UniStatScheduler(UniStatSystemModel(conf_simple(num_rooms=2)))
+        explicit = UniStatExplicitMPC(scheduler.mpc, [21, 20], scheduler=scheduler)
+        model = explicit.model
+        # Grid points hold the first step of the on/off schedule
+        x0 = model.initial_state(-5 + 20.5, [-1 + 21, 2 + 20])
+        expected = scheduler.solve(x0, [21, 20]).controls[0]
+        controls = explicit.lookup(x0, [21, 20])
+        assert np.array_equal(controls, expected)
+        assert set(np.unique(controls)) <= {0, 1}
+
+        # Switches keep their state until the minimum on or off time has passed
+        held = explicit.lookup(x0, [21, 20], 1 - controls, [0, 0])
+        assert np.array_equal(held, 1 - controls)
+        elapsed = [scheduler.min_on_time, scheduler.min_off_time]
+        free = explicit.lookup(x0, [21, 20], 1 - controls, elapsed)
+        assert np.array_equal(free, controls)
@@ -0,0 +1,106 @@
+from itertools import product
+
+import numpy as np
+import pytest
+
+from homeassistant.const import CONF_NAME, CONF_UNIT_OF_MEASUREMENT, UnitOfPower
+
+from custom_components.unistat.const import CONF_HEATING_POWER
+from custom_components.unistat.mpc import MPC_SWITCH_BLOCK
+from custom_components.unistat.scheduler import UniStatScheduler
+from custom_components.unistat.thermal_model import UniStatSystemModel
+
+from .config_gen import (
+    ConfigParams,
+    make_boiler,
+    make_expected,
+    make_main_conf,
+    make_multiroom_sensors,
+    make_zonevalve,
+)
+from .test_thermal_model import conf_common_rooms, conf_simple
+
+
+def conf_boiler_zones(num_zones=3):
+    """One room per zone and no common rooms"""
+    rooms = [f"room_{i}" for i in range(num_zones)]
+    controls = [f"switch.zone{i}_valve" for i in range(num_zones)]
+    boiler = make_boiler()
+    boiler[1][CONF_HEATING_POWER] = 3000.0
+    boiler[1][CONF_UNIT_OF_MEASUREMENT] = UnitOfPower.WATT
+    params = ConfigParams(
+        main_conf=make_main_conf(rooms, controls),
+        room_sensors=make_multiroom_sensors(rooms),
+        control_appliances=[
+            make_zonevalve(
+                [rooms[i]], central_appliance=(boiler[1][CONF_NAME] if i > 0 else None)
+            )
+            for i in range(num_zones)
+        ],
+        central_appliances=[boiler],
+    )
+    return make_expected(params)
+
+
+@pytest.fixture
+def scheduler():
+    return UniStatScheduler(UniStatSystemModel(conf_boiler_zones()))
+
+
+class TestUniStatScheduler:
+    def test_matches_enumeration(self, scheduler: UniStatScheduler):
+        x0 = scheduler.model.initial_state(0, [18, 21, 17])
+        schedule = scheduler.solve(x0, 20)
+
+        assert schedule.optimal
+        assert np.all((schedule.controls == 0) | (schedule.controls == 1))
+        # Enumerate every schedule
+        error, weights, _, hessian, _, gradient = scheduler.mpc._problem(
+            x0, 20, None, None, 0.1
+        )
+        v = np.array(list(product((0, 1), repeat=scheduler.mpc.num_decisions)), float)
+        costs = 0.5 * np.einsum("ij,jk,ik->i", v, hessian, v) + v @ gradient
+        expected = np.min(costs) + np.sum(weights * error**2)
+        assert schedule.cost == pytest.approx(expected, rel=1e-6)
+
+    def test_zones_independent(self, scheduler: UniStatScheduler):
+        # Only the last room is cold, so only its zone is called to begin with
+        x0 = scheduler.model.initial_state(0, [21, 21, 16])
+        schedule = scheduler.solve(x0, [20, 20, 20])
+        assert schedule.controls[0, 2] == 1
+        assert np.all(schedule.controls[0, :2] == 0)
+
+    def test_central_appliance_zones(self):
+        # Both zones share a boiler and a common room, the boiler couples them through the model
+        scheduler = UniStatScheduler(UniStatSystemModel(conf_common_rooms()))
+        x0 = scheduler.model.initial_state(0, [16, 21, 21])
+        schedule = scheduler.solve(x0, 20)
+
+        assert schedule.optimal
+        error, weights, _, hessian, _, gradient = scheduler.mpc._problem(
+            x0, 20, None, None, 0.1
+        )
+        v = np.array(list(product((0, 1), repeat=scheduler.mpc.num_decisions)), float)
+        costs = 0.5 * np.einsum("ij,jk,ik->i", v, hessian, v) + v @ gradient
+        expected = np.min(costs) + np.sum(weights * error**2)
+        assert schedule.cost == pytest.approx(expected, rel=1e-6)
+        # Only the zone of the cold room is called, the other zone isn't needed to open it
+        assert np.array_equal(schedule.controls[0], [1, 0])
+
+    def test_minimum_times(self):
+        scheduler = UniStatScheduler(UniStatSystemModel(conf_simple()))
+        x0 = scheduler.model.initial_state(24, [24, 24, 24])
+
+        # A warm house turns the heater off unless it has only just come on
+        assert np.all(scheduler.solve(x0, 20).controls[:, 0] == 0)
+        held = scheduler.solve(x0, 20, current=[1, 0], elapsed=[60, 3600])
+        steps = np.cumsum(held.steps) - held.steps
+        assert np.all(held.controls[steps < MPC_SWITCH_BLOCK, 0] == 1)
+        assert np.all(held.controls[steps >= MPC_SWITCH_BLOCK, 0] == 0)
+        free = scheduler.solve(x0, 20, current=[1, 0], elapsed=[3600, 3600])
+        assert np.all(free.controls[:, 0] == 0)
+
+    def test_minimum_times_fit_blocks(self):
+        model = UniStatSystemModel(conf_simple())
+        with pytest.raises(ValueError):
+            UniStatScheduler(model, min_on_time=2 * MPC_SWITCH_BLOCK)
@@ -0,0 +1,390 @@
+import pytest
+import numpy as np
+
+from scipy.linalg import expm
+
+from homeassistant.const import CONF_NAME, CONF_UNIT_OF_MEASUREMENT, UnitOfPower
+
+from custom_components.unistat.const import CONF_ADJACENCY, CONF_HEATING_POWER
+from custom_components.unistat.thermal_model import (
+    DISCRETIZATION_CACHE_SIZE,
+    SPARSE_ROOM_THRESHOLD,
+    UniStatSystemModel,
+    _matrix_powers,
+)
+
+
+from .config_gen import (
+    ConfigParams,
+    make_adjacency,
+    make_boiler,
+    make_expected,
+    make_main_conf,
+    make_multiroom_sensors,
+    make_spaceheater,
+    make_window_ac,
+    make_zonevalve,
+)
+
+
+def conf_simple(num_rooms=3, use_adjacency=False):
+    rooms = [f"room_{i}" for i in range(num_rooms)]
+    controls = ["switch.spaceheater1", "switch.window_ac1"]
+    params = ConfigParams(
+        main_conf=make_main_conf(rooms, controls, use_adjacency=use_adjacency),
+        room_sensors=make_multiroom_sensors(rooms),
+        control_appliances=[make_spaceheater(rooms[0]), make_window_ac(rooms[-1])],
+        adjacency=make_adjacency(rooms) if use_adjacency else [],
+    )
+    conf = make_expected(params)
+    if use_adjacency:
+        # Every room needs a path to the outside
+        conf["adjacency"][0][1:] = [1] * num_rooms
+    return conf
+
+
+def conf_common_rooms():
+    """Two boiler zones that both heat room c"""
+    rooms = ["a", "b", "c"]
+    controls = ["switch.zone1_valve", "switch.zone2_valve"]
+    boiler = make_boiler()
+    boiler[1][CONF_HEATING_POWER] = 3000.0
+    boiler[1][CONF_UNIT_OF_MEASUREMENT] = UnitOfPower.WATT
+    name = boiler[1][CONF_NAME]
+    params = ConfigParams(
+        main_conf=make_main_conf(rooms, controls),
+        room_sensors=make_multiroom_sensors(rooms),
+        control_appliances=[
+            make_zonevalve(["a", "c"], central_appliance=name),
+            make_zonevalve(["b", "c"], central_appliance=name),
+        ],
+        central_appliances=[boiler],
+    )
+    return make_expected(params)
+
+
+def reference_simulate(model, x0, u, dt):
+    """Straightforward per-step simulation to compare against"""
+    n = model.num_states
+    m = np.zeros((n + model.num_controls, n + model.num_controls))
+    m[:n, :n] = model.A
+    m[:n, n:] = model.B
+    em = expm(m * dt)
+    x = [x0]
+    for k in range(u.shape[0]):
+        x.append(em[:n, :n] @ x[-1] + em[:n, n:] @ u[k])
+    return np.array(x)
+
+
+@pytest.fixture
+def model():
+    return UniStatSystemModel(conf_simple())
+
+
+class TestUniStatSystemModel_simulate:
+    def test_shapes(self, model: UniStatSystemModel):
+        x0 = model.initial_state(0, [20, 21, 22])
+        u = np.zeros((10, model.num_controls))
+        states, outputs = model.simulate(x0, u)
+        assert model.num_controls == 2
+        assert states.shape == (11, model.num_states)
+        assert outputs.shape == (11, 3)
+        assert np.array_equal(outputs[0], [20, 21, 22])
+
+    @pytest.mark.parametrize("num_steps", [1, 2, 7, 64, 100])
+    def test_matches_stepwise(self, model: UniStatSystemModel, num_steps):
+        rng = np.random.default_rng(0)
+        x0 = model.initial_state(-5, [20, 21, 22])
+        u = rng.uniform(0, 1, (num_steps, model.num_controls))
+        states, _ = model.simulate(x0, u, dt=300)
+        assert np.allclose(states, reference_simulate(model, x0, u, 300))
+
+    def test_equilibrium(self, model: UniStatSystemModel):
+        x0 = model.initial_state(20, [20, 20, 20])
+        states, _ = model.simulate(x0, np.zeros((50, model.num_controls)))
+        assert np.allclose(states, 20)
+
+    def test_heating_and_cooling(self, model: UniStatSystemModel):
+        x0 = model.initial_state(20, [20, 20, 20])
+        _, outputs = model.simulate(x0, np.ones((12, model.num_controls)))
+        assert outputs[-1, 0] > 20
+        assert outputs[-1, -1] < 20
+
+    def test_outside_temps(self, model: UniStatSystemModel):
+        x0 = model.initial_state(20, [20, 20, 20])
+        u = np.zeros((24, model.num_controls))
+        t_out = np.linspace(20, 0, 24)
+        states, outputs = model.simulate(x0, u, outside_temps=t_out)
+        assert np.array_equal(states[:-1, 0], t_out)
+        assert np.all(np.diff(outputs, axis=0) <= 1e-9)
+
+        # A constant outside temperature matches the undriven simulation
+        driven, _ = model.simulate(x0, u, outside_temps=np.full(24, 20.0))
+        assert np.allclose(driven, model.simulate(x0, u)[0])
+
+    def test_adjacency(self):
+        model = UniStatSystemModel(conf_simple(num_rooms=6, use_adjacency=True))
+        assert model.model_params.conf_data[CONF_ADJACENCY]
+        # Heat flows conserve energy so rows of A sum to zero
+        assert np.allclose(np.sum(model.A, axis=1), 0)
+        assert np.all(np.diag(model.A)[1:] < 0)
+
+    def test_bad_state_shape(self, model: UniStatSystemModel):
+        with pytest.raises(ValueError):
+            model.simulate(np.zeros(2), np.zeros((1, model.num_controls)))
+
+    def test_common_rooms(self):
+        model = UniStatSystemModel(conf_common_rooms())
+        params = model.model_params
+        assert params.radiator_rooms == [["a", "c", "b"]]
+        assert params.central_appliances[0]["num_fixtures"] == 3
+        # The common room has one radiator shared by both zones
+        assert [c["radiators"] for c in model._control_layout] == [[0, 1], [2, 1]]
+
+        x0 = model.initial_state(0, [18, 18, 18])
+        states, _ = model.simulate(x0, np.ones((10, model.num_controls)))
+        assert np.all(states[-1, 1:4] > 18)
+
+
+class TestUniStatSystemModel_discretize:
+    def test_cache_hit(self, model: UniStatSystemModel):
+        ad, bd = model.discretize(300)
+        assert model.discretize(300)[0] is ad
+        assert model.discretize(300.0)[1] is bd
+        assert model.discretize(60)[0] is not ad
+        assert not ad.flags.writeable
+
+    def test_other_params(self, model: UniStatSystemModel):
+        vector = model.model_params.to_vector()
+        vector[1] *= 2  # First room thermal mass
+        params = model.model_params.from_vector(vector)
+        ad, _ = model.discretize(300, params)
+        assert not np.allclose(ad, model.discretize(300)[0])
+        assert model.discretize(300, model.model_params.from_vector(vector))[0] is ad
+
+    def test_cache_bounded(self, model: UniStatSystemModel):
+        for dt in range(1, DISCRETIZATION_CACHE_SIZE + 10):
+            model.discretize(dt)
+        assert len(model._discretization_cache) == DISCRETIZATION_CACHE_SIZE
+
+
+class TestUniStatSystemModel_simulate_ensemble:
+    def perturbed(self, model: UniStatSystemModel, num: int):
+        rng = np.random.default_rng(1)
+        vector = model.model_params.to_vector()
+        return vector * rng.uniform(0.5, 1.5, (num, vector.size))
+
+    def test_matches_individual(self, model: UniStatSystemModel):
+        vectors = self.perturbed(model, 5)
+        x0 = model.initial_state(0, [20, 21, 22])
+        u = np.random.default_rng(2).uniform(0, 1, (30, model.num_controls))
+        t_out = np.linspace(0, 5, 30)
+        states, outputs = model.simulate_ensemble(vectors, x0, u, outside_temps=t_out)
+        assert states.shape == (5, 31, model.num_states)
+        assert outputs.shape == (5, 31, 3)
+        for i, v in enumerate(vectors):
+            expected, _ = model.simulate(
+                x0,
+                u,
+                outside_temps=t_out,
+                model_params=model.model_params.from_vector(v),
+            )
+            assert np.allclose(states[i], expected)
+
+    def test_per_member_inputs(self, model: UniStatSystemModel):
+        vectors = self.perturbed(model, 3)
+        x0 = np.stack([model.initial_state(0, [t] * 3) for t in (18, 20, 22)])
+        u = np.zeros((3, 10, model.num_controls))
+        u[1] = 1
+        states, _ = model.simulate_ensemble(vectors, x0, u)
+        for i in range(3):
+            expected, _ = model.simulate(
+                x0[i], u[i], model_params=model.model_params.from_vector(vectors[i])
+            )
+            assert np.allclose(states[i], expected)
+
+    def test_trajectories_per_member(self, model: UniStatSystemModel):
+        vectors = self.perturbed(model, 3)
+        rng = np.random.default_rng(3)
+        x0 = np.stack([model.initial_state(t, [20, 21, 22]) for t in (0, 5)])
+        u = rng.uniform(0, 1, (2, 10, model.num_controls))
+        t_out = rng.uniform(0, 5, (2, 10))
+        states, _ = model.simulate_ensemble(
+            vectors, x0[np.newaxis], u[np.newaxis], outside_temps=t_out[np.newaxis]
+        )
+        assert states.shape == (3, 2, 11, model.num_states)
+        for i, j in np.ndindex(3, 2):
+            expected, _ = model.simulate(
+                x0[j],
+                u[j],
+                outside_temps=t_out[j],
+                model_params=model.model_params.from_vector(vectors[i]),
+            )
+            assert np.allclose(states[i, j], expected)
+
+    def test_bad_shape(self, model: UniStatSystemModel):
+        vectors = self.perturbed(model, 2)[:, 1:]
+        x0 = model.initial_state(0, [20, 21, 22])
+        with pytest.raises(ValueError):
+            model.simulate_ensemble(vectors, x0, np.zeros((1, model.num_controls)))
+
+
+class TestUniStatSystemModel_sparse:
+    @pytest.fixture
+    def models(self):
+        conf = conf_simple(num_rooms=8, use_adjacency=True)
+        return UniStatSystemModel(conf), UniStatSystemModel(conf, use_sparse=True)
+
+    def test_auto_select(self, models):
+        dense, sparse_model = models
+        assert not dense.use_sparse
+        assert sparse_model.use_sparse
+        assert UniStatSystemModel(
+            conf_simple(num_rooms=SPARSE_ROOM_THRESHOLD)
+        ).use_sparse
+
+    def test_assembly_matches_dense(self, models):
+        dense, sparse_model = models
+        assert np.allclose(sparse_model.A_sparse.toarray(), dense.A)
+        assert np.allclose(sparse_model.B_sparse.toarray(), dense.B)
+        assert sparse_model.A_sparse.nnz < dense.A.size
+
+    def test_discretize_matches_dense(self, models):
+        dense, sparse_model = models
+        ad, bd = sparse_model.discretize_sparse(300)
+        assert np.allclose(ad.toarray(), dense.discretize(300)[0], atol=1e-10)
+        assert np.allclose(bd.toarray(), dense.discretize(300)[1], atol=1e-10)
+        assert sparse_model.discretize_sparse(300)[0] is ad
+
+    def test_simulate_matches_dense(self, models):
+        dense, sparse_model = models
+        rng = np.random.default_rng(3)
+        x0 = dense.initial_state(0, rng.uniform(18, 22, 8))
+        u = rng.uniform(0, 1, (50, dense.num_controls))
+        t_out = np.linspace(0, -10, 50)
+        expected, _ = dense.simulate(x0, u, outside_temps=t_out)
+        states, outputs = sparse_model.simulate(x0, u, outside_temps=t_out)
+        assert np.allclose(states, expected, atol=1e-8)
+        assert outputs.shape == (51, 8)
+
+    def test_ensemble_matches_dense(self, models):
+        dense, sparse_model = models
+        rng = np.random.default_rng(6)
+        vector = dense.model_params.to_vector()
+        vectors = vector * rng.uniform(0.5, 1.5, (3, vector.size))
+        x0 = np.stack([dense.initial_state(t, rng.uniform(18, 22, 8)) for t in (0, 5)])
+        u = rng.uniform(0, 1, (2, 20, dense.num_controls))
+        t_out = rng.uniform(-5, 5, (2, 20))
+        args = (vectors, x0[np.newaxis], u[np.newaxis])
+        expected, _ = dense.simulate_ensemble(*args, outside_temps=t_out[np.newaxis])
+        states, _ = sparse_model.simulate_ensemble(
+            *args, outside_temps=t_out[np.newaxis]
+        )
+        assert states.shape == (3, 2, 21, dense.num_states)
+        assert np.allclose(states, expected, atol=1e-8)
+
+    def test_jacobian_matches_dense(self, models):
+        dense, sparse_model = models
+        rng = np.random.default_rng(7)
+        x0 = np.stack([dense.initial_state(t, rng.uniform(18, 22, 8)) for t in (0, 5)])
+        u = rng.uniform(0, 1, (2, 20, dense.num_controls))
+        t_out = np.linspace(0, -10, 20)
+        expected = dense.simulate_jacobian(x0, u, outside_temps=t_out)
+        result = sparse_model.simulate_jacobian(x0, u, outside_temps=t_out)
+        for value, reference in zip(result, expected):
+            assert value.shape == reference.shape
+            assert np.allclose(value, reference, atol=1e-8)
+
+
+class TestUniStatSystemModel_simulate_jacobian:
+    def finite_difference(self, model, x0, u, t_out, step=1e-6):
+        vector = model.model_params.to_vector()
+        cols = []
+        for p in range(vector.size):
+            h = step * max(abs(vector[p]), 1)
+            hi, lo = vector.copy(), vector.copy()
+            hi[p] += h
+            lo[p] -= h
+            states, _ = model.simulate_ensemble(
+                np.stack([hi, lo]), x0, u, outside_temps=t_out
+            )
+            cols.append((states[0] - states[1]) / (2 * h))
+        return np.stack(cols, axis=-1)
+
+    @pytest.mark.parametrize("use_adjacency", [False, True])
+    def test_matches_finite_difference(self, use_adjacency):
+        model = UniStatSystemModel(
+            conf_simple(num_rooms=4, use_adjacency=use_adjacency)
+        )
+        rng = np.random.default_rng(4)
+        x0 = model.initial_state(0, rng.uniform(18, 22, 4))
+        u = rng.uniform(0, 1, (40, model.num_controls))
+        t_out = np.linspace(0, 10, 40)
+        states, outputs, jacobian = model.simulate_jacobian(x0, u, outside_temps=t_out)
+        assert np.allclose(states, model.simulate(x0, u, outside_temps=t_out)[0])
+        assert outputs.shape == (41, 4)
+        assert jacobian.shape == (41, model.num_states, model.model_params.num_params)
+        expected = self.finite_difference(model, x0, u, t_out)
+        assert np.allclose(jacobian, expected, rtol=1e-4, atol=1e-6)
+
+    def test_internal_loads(self):
+        from .test_model_params import MODEL_PARAMS_NO_BOILER
+
+        params = MODEL_PARAMS_NO_BOILER
+        model = UniStatSystemModel(params.conf_data, params)
+        x0 = model.initial_state(5, [20, 21, 22])
+        u = np.full((20, model.num_controls), 0.5)
+        _, _, jacobian = model.simulate_jacobian(x0, u)
+        expected = self.finite_difference(model, x0, u, None)
+        assert np.allclose(jacobian, expected, rtol=1e-4, atol=1e-6)
+        # Internal loads only ever warm a room
+        loads = params._field_slices["internal_loads"]
+        assert np.all(jacobian[-1, 1:4, loads] >= 0)
+
+
+class TestUniStatSystemModel_prediction_matrices:
+    @pytest.mark.parametrize("horizon", [1, 5, 36])
+    def test_matches_simulate(self, horizon):
+        model = UniStatSystemModel(conf_simple(num_rooms=5, use_adjacency=True))
+        rng = np.random.default_rng(5)
+        x0 = model.initial_state(3, rng.uniform(18, 22, 5))
+        u = rng.uniform(0, 1, (horizon, model.num_controls))
+        t_out = rng.uniform(-5, 5, horizon)
+
+        predictions = model.prediction_matrices(horizon)
+        _, outputs = model.simulate(x0, u, outside_temps=t_out)
+        assert np.allclose(predictions.predict(x0, u, t_out), outputs[1:])
+        _, outputs = model.simulate(x0, np.zeros_like(u))
+        assert np.allclose(predictions.predict(x0), outputs[1:])
+
+    def test_layout(self, model: UniStatSystemModel):
+        predictions = model.prediction_matrices(12, dt=600)
+        assert model.prediction_matrices(12, dt=600.0) is predictions
+        assert predictions.controls.shape == (12 * 3, 12 * model.num_controls)
+        assert predictions.controls.flags.c_contiguous
+        assert not predictions.free.flags.writeable
+        # Inputs can't affect earlier steps
+        assert np.all(predictions.controls[:3, model.num_controls :] == 0)
+
+    def test_matrix_powers(self):
+        a = np.random.default_rng(6).uniform(-0.5, 0.5, (4, 4))
+        powers = _matrix_powers(a, 11)
+        for k in range(11):
+            assert np.allclose(powers[k], np.linalg.matrix_power(a, k))
+
+    def test_non_uniform_steps(self, model: UniStatSystemModel):
+        steps = np.array([300.0, 300, 900, 900, 1800])
+        rng = np.random.default_rng(7)
+        x0 = model.initial_state(3, [19, 20, 21])
+        u = rng.uniform(0, 1, (5, model.num_controls))
+        t_out = rng.uniform(-5, 5, 5)
+
+        expected = [x0]
+        for k, dt in enumerate(steps):
+            states, _ = model.simulate(expected[-1], u[k : k + 1], dt, t_out[k : k + 1])
+            expected.append(states[-1])
+        predictions = model.prediction_matrices(5, steps)
+        assert np.array_equal(predictions.steps, steps)
+        assert np.allclose(
+            predictions.predict(x0, u, t_out), np.array(expected)[1:, 1:4]
+        )
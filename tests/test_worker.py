@@ -0,0 +1,97 @@
+"""Test the compute worker."""
+
+import asyncio
+import threading
+
+import pytest
+
+from custom_components.unistat.worker import ComputeCancelled, UniStatWorker
+
+
+@pytest.fixture
+def worker():
+    worker = UniStatWorker(max_workers=1)
+    yield worker
+    worker.shutdown()
+
+
+async def test_runs_off_loop(worker: UniStatWorker):
+    loop_thread = threading.get_ident()
+    assert await worker.async_run("job", threading.get_ident) != loop_thread
+    assert await worker.async_run("job", pow, 2, 10) == 1024
+
+
+async def test_replaces_pending_job(worker: UniStatWorker):
+    release = threading.Event()
+    calls = []
+
+    def record(value):
+        calls.append(value)
+        return value
+
+    # Keeps the only thread busy so the next jobs wait
+    busy = asyncio.ensure_future(worker.async_run("busy", release.wait, 10))
+    await asyncio.sleep(0)
+    stale = asyncio.ensure_future(worker.async_run("solve", record, "stale"))
+    await asyncio.sleep(0)
+    fresh = asyncio.ensure_future(worker.async_run("solve", record, "fresh"))
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await fresh == "fresh"
+    with pytest.raises(ComputeCancelled):
+        await stale
+    assert await busy
+    # The replaced job never ran
+    assert calls == ["fresh"]
+
+
+async def test_cancels_running_job(worker: UniStatWorker):
+    started = threading.Event()
+
+    def search(limit, cancel: threading.Event):
+        started.set()
+        cancel.wait(limit)
+        return cancel.is_set()
+
+    stale = asyncio.ensure_future(
+        worker.async_run("solve", search, 10, cancellable=True)
+    )
+    await asyncio.get_running_loop().run_in_executor(None, started.wait, 10)
+    fresh = asyncio.ensure_future(
+        worker.async_run("solve", search, 0, cancellable=True)
+    )
+
+    with pytest.raises(ComputeCancelled):
+        await stale
+    assert not await fresh
+
+
+async def test_runs_one_job_per_key():
+    worker = UniStatWorker(max_workers=2)
+    started = threading.Event()
+    release = threading.Event()
+    running = []
+
+    def solve(value):
+        running.append(value)
+        started.set()
+        release.wait(10)
+        assert running == [value]
+        running.remove(value)
+        return value
+
+    # A replaced job that can't be cancelled keeps running, the new job waits for it
+    stale = asyncio.ensure_future(worker.async_run("solve", solve, "stale"))
+    await asyncio.get_running_loop().run_in_executor(None, started.wait, 10)
+    fresh = asyncio.ensure_future(worker.async_run("solve", solve, "fresh"))
+    await asyncio.sleep(0.1)
+    assert running == ["stale"]
+    release.set()
+
+    try:
+        assert await fresh == "fresh"
+        with pytest.raises(ComputeCancelled):
+            await stale
+    finally:
+        worker.shutdown()